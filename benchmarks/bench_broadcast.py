@@ -0,0 +1,81 @@
+"""Load test: broadcast to N users through the outbox against a flood-limited fake Bot API.
+
+The fake API rejects anything over 30 messages/second overall or 1/second per
+chat with a 429, like Telegram does. The report shows the delivery rate the
+outbox achieved and how many sends were rejected. Ideally that is close to
+NOTIFY_RATE_PER_SECOND with almost no 429s.
+
+Run from the repository root:
+    python benchmarks/bench_broadcast.py [users] [rate_per_second]
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456:benchmark-token"
+
+from fake_bot_api import DEFAULT_FLOOD_LIMITS, run_fake_bot_api
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run(users: int):
+    import main
+
+    await main.start_services()
+    try:
+        async with main.db.pool.write() as conn:
+            await conn.executemany("INSERT INTO users (tg_id, username, full_name, created) VALUES (?, ?, ?, ?)",
+                                   [(10_000 + i, f"user{i}", f"User {i}", "2024-01-01T00:00:00")
+                                    for i in range(users)])
+        start = time.time()
+        broadcast_id, total = await main.db.create_broadcast("Benchmark", 0)
+        main.notifications.wake()
+        while True:
+            await asyncio.sleep(0.5)
+            progress = await main.db.get_broadcast_progress(broadcast_id)
+            if not progress["pending"]:
+                break
+        return progress, time.time() - start
+    finally:
+        await main.stop_services()
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    if len(sys.argv) > 2:
+        os.environ["NOTIFY_RATE_PER_SECOND"] = sys.argv[2]
+
+    replies = multiprocessing.Value("i", 0)
+    last_reply = multiprocessing.Value("d", 0.0)
+    rejected = multiprocessing.Value("i", 0)
+    port = free_port()
+    api = multiprocessing.Process(target=run_fake_bot_api, daemon=True,
+                                  args=(port, replies, last_reply, rejected, DEFAULT_FLOOD_LIMITS))
+    api.start()
+    time.sleep(0.5)
+
+    os.environ.update(BOT_TOKEN=TOKEN, TELEGRAM_API_SERVER=f"http://127.0.0.1:{port}")
+    sys.path.insert(0, ROOT)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            progress, elapsed = asyncio.run(run(users))
+    finally:
+        api.terminate()
+
+    print(f"recipients {progress['total']}, sent {progress['sent']}, failed {progress['failed']}")
+    print(f"{progress['sent'] / elapsed:.1f} msg/s over {elapsed:.1f}s, {rejected.value} rejected with 429")
+
+
+if __name__ == "__main__":
+    main()
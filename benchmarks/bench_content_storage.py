@@ -0,0 +1,107 @@
+"""Database size and query speed with inline content bodies vs. compressed blobs.
+
+Seeds `rows` generated_content rows of realistic multi-KB markdown (a share of
+them duplicates, as cache hits are) at schema v4, measures, migrates to the
+latest version, VACUUMs and measures again.
+
+Run from the repository root:
+    python benchmarks/bench_content_storage.py [rows]
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark-token")
+
+from main import Database
+
+WORDS = ("talaba", "referat", "tahlil", "iqtisodiyot", "tarix", "zamonaviy", "muammo", "yechim",
+         "jamiyat", "rivojlanish", "texnologiya", "ta'lim", "ilmiy", "natija", "asosiy", "xulosa")
+
+
+def body(rng: random.Random, paragraphs: int = 12) -> str:
+    parts = [f"# {' '.join(rng.choices(WORDS, k=4)).title()}"]
+    for i in range(paragraphs):
+        parts.append(f"## {i + 1}. {' '.join(rng.choices(WORDS, k=3)).title()}")
+        parts.append(" ".join(rng.choices(WORDS, k=60)) + ".")
+    return "\n\n".join(parts)
+
+
+def seed(path: str, rows: int, users: int = 2000):
+    rng = random.Random(7)
+    popular = [body(rng) for _ in range(50)]
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO generated_content (tg_id, content_type, topic, content, created) VALUES (?, ?, ?, ?, ?)",
+            ((rng.randrange(users), rng.choice(("referat", "insho", "test")), f"Mavzu {i % 500}",
+              rng.choice(popular) if rng.random() < 0.3 else body(rng), "2024-01-01T00:00:00")
+             for i in range(rows)))
+    conn.close()
+
+
+def vacuum_size(path: str) -> float:
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("VACUUM")
+    conn.close()
+    return os.path.getsize(path) / 1e6
+
+
+async def timed(database: Database, sql: str, args=(), repeat: int = 5) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        async with database.pool.read() as db:
+            await (await db.execute(sql, args)).fetchall()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+async def measure(database: Database):
+    return {
+        "history (metadata)": await timed(
+            database, "SELECT id, content_type, topic, created FROM generated_content WHERE tg_id=?", (42,)),
+        "scan by type": await timed(
+            database, "SELECT COUNT(*) FROM generated_content WHERE content_type='referat'"),
+        "scan by topic": await timed(
+            database, "SELECT COUNT(*) FROM generated_content WHERE topic LIKE 'Mavzu 1%'"),
+    }
+
+
+async def main(rows: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        database = Database(path)
+        await database.pool.open()
+        await database.migrate(target=4)
+        await database.close()
+
+        print(f"seeding {rows:,} rows...")
+        seed(path, rows)
+        size_before = vacuum_size(path)
+        await database.pool.open()
+        before = await measure(database)
+
+        start = time.perf_counter()
+        await database.migrate()
+        migrate_seconds = time.perf_counter() - start
+        await database.close()
+
+        size_after = vacuum_size(path)
+        await database.pool.open()
+        after = await measure(database)
+        await database.close()
+
+    print(f"migration took {migrate_seconds:.1f}s")
+    print(f"{'':<22}{'inline':>12}{'blobs':>12}")
+    print(f"{'db size MB':<22}{size_before:>12.1f}{size_after:>12.1f}")
+    for name in before:
+        print(f"{name + ' ms':<22}{before[name]:>12.2f}{after[name]:>12.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000))
@@ -0,0 +1,92 @@
+"""Micro-benchmark: pooled Database vs. the old connect-per-call pattern.
+
+Run from the repository root:
+    python benchmarks/bench_db_pool.py [ops]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark-token")
+
+import aiosqlite
+
+from main import Database
+
+USERS = 100
+
+
+class PerCallDatabase:
+    """The previous access pattern: a fresh aiosqlite connection per call."""
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+
+    async def get_user(self, tg_id: int):
+        async with aiosqlite.connect(self.db_name) as db:
+            db.row_factory = aiosqlite.Row
+            cursor = await db.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,))
+            return await cursor.fetchone()
+
+    async def increment_content_count(self, tg_id: int):
+        async with aiosqlite.connect(self.db_name) as db:
+            await db.execute("UPDATE users SET content_count = content_count + 1 WHERE tg_id=?", (tg_id,))
+            await db.commit()
+
+    async def save_content(self, tg_id: int, content_type: str, topic: str, content: str):
+        async with aiosqlite.connect(self.db_name) as db:
+            await db.execute('''INSERT INTO generated_content (tg_id, content_type, topic, content, created)
+                VALUES (?, ?, ?, ?, ?)''',
+                (tg_id, content_type, topic, content, datetime.now().isoformat()))
+            await db.commit()
+
+
+async def seed(path):
+    database = Database(path)
+    await database.init_db()
+    for i in range(USERS):
+        await database.create_or_update_user(i, f"user{i}", f"User {i}")
+    await database.close()
+
+
+async def run_ops(target, ops: int, concurrency: int = 8):
+    async def reads(worker):
+        for i in range(worker, ops, concurrency):
+            await target.get_user(i % USERS)
+
+    async def writes(worker):
+        for i in range(worker, ops, concurrency):
+            await target.save_content(i % USERS, "referat", "Mavzu", "x" * 2000)
+            await target.increment_content_count(i % USERS)
+
+    results = {}
+    for name, fn in (("get_user", reads), ("generate_writes", writes)):
+        start = time.perf_counter()
+        await asyncio.gather(*(fn(w) for w in range(concurrency)))
+        results[name] = ops / (time.perf_counter() - start)
+    return results
+
+
+async def main(ops: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        await seed(path)
+
+        per_call = await run_ops(PerCallDatabase(path), ops)
+
+        pooled_db = Database(path)
+        await pooled_db.init_db()
+        pooled = await run_ops(pooled_db, ops)
+        await pooled_db.close()
+
+    print(f"{'operation':<18}{'per-call ops/s':>16}{'pooled ops/s':>16}{'speedup':>10}")
+    for name in per_call:
+        print(f"{name:<18}{per_call[name]:>16.0f}{pooled[name]:>16.0f}{pooled[name] / per_call[name]:>9.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
@@ -0,0 +1,63 @@
+"""Micro-benchmark: cost of Web App initData verification per request.
+
+Signs initData strings the way Telegram does, then times InitDataVerifier.verify
+on first sight (parse + HMAC) and on repeat calls (LRU hit), and the whole
+current_tg_id dependency as FastAPI calls it for a warm set of users.
+
+Run from the repository root:
+    python benchmarks/bench_init_data.py [calls]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+TOKEN = "123456:benchmark-token"
+os.environ.setdefault("BOT_TOKEN", TOKEN)
+
+from starlette.requests import Request
+
+from fake_bot_api import sign_init_data
+from main import InitDataVerifier, current_tg_id, init_data_verifier
+
+
+def per_call_us(fn, calls: int) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main(calls: int):
+    init_data = [sign_init_data(1000 + i, TOKEN) for i in range(calls)]
+
+    verifier = InitDataVerifier(TOKEN, cache_size=calls)
+    miss = per_call_us(lambda i: verifier.verify(init_data[i]), calls)
+    hit = per_call_us(lambda i: verifier.verify(init_data[i]), calls)
+
+    # A realistic active set: 1000 users making repeated calls
+    requests = [Request({"type": "http", "headers": [(b"x-telegram-init-data", init_data[i % 1000].encode())]})
+                for i in range(calls)]
+    loop = asyncio.new_event_loop()
+    for request in requests[:1000]:
+        loop.run_until_complete(current_tg_id(request))
+
+    async def dependency():
+        start = time.perf_counter()
+        for request in requests:
+            await current_tg_id(request)
+        return (time.perf_counter() - start) / calls * 1e6
+
+    cached_dependency = loop.run_until_complete(dependency())
+    loop.close()
+
+    print(f"{'path':<34}{'us/call':>10}")
+    print(f"{'verify, first sight (HMAC)':<34}{miss:>10.2f}")
+    print(f"{'verify, LRU hit':<34}{hit:>10.2f}")
+    print(f"{'current_tg_id dependency, cached':<34}{cached_dependency:>10.2f}")
+    print(f"LRU hit rate: {init_data_verifier.stats()['hit_rate']}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
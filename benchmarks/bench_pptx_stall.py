@@ -0,0 +1,86 @@
+"""Event-loop stall while building presentations: inline python-pptx vs. PptxRenderer.
+
+Run from the repository root:
+    python benchmarks/bench_pptx_stall.py [downloads] [slides]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark-token")
+
+from documents import create_pptx_from_text
+from main import PptxRenderer
+
+
+def sample_presentation(slides: int, seed: int) -> str:
+    parts = [f"# Taqdimot {seed}\n\nMuallif: Talaba"]
+    for i in range(1, slides + 1):
+        parts.append(
+            f"## Slayd {i}: Bo'lim {i}\n\n"
+            f"**Vizual Tushuncha:** Diagramma {i}\n\n"
+            f"**Asosiy Matn:**\n" + "\n".join(f"- Punkt {i}.{j} haqida qisqa fikr" for j in range(1, 6)) + "\n\n"
+            "**Spiker Nutqi:** " + "Bu slaydda asosiy g'oyalar muhokama qilinadi. " * 8
+        )
+    return "\n\n".join(parts)
+
+
+async def measure(render, contents, concurrency: int = 4):
+    lags = []
+    stop = asyncio.Event()
+
+    async def monitor(interval: float = 0.005):
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - start - interval)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def download(content):
+        async with semaphore:
+            await render(content)
+
+    monitor_task = asyncio.create_task(monitor())
+    start = time.perf_counter()
+    await asyncio.gather(*(download(c) for c in contents))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor_task
+    lags.sort()
+    return {
+        "elapsed": elapsed,
+        "max_lag_ms": lags[-1] * 1000 if lags else 0.0,
+        "p99_lag_ms": lags[int(len(lags) * 0.99)] * 1000 if lags else 0.0,
+    }
+
+
+async def main(downloads: int, slides: int):
+    contents = [sample_presentation(slides, i) for i in range(downloads)]
+
+    async def inline(content):
+        # What the handler used to do: build the file on the event loop thread
+        create_pptx_from_text(content)
+
+    renderer = PptxRenderer(workers=2, max_queue=downloads, cache_size=0)
+    renderer.start()
+    await renderer.render(contents[0] + " warm-up")
+
+    before = await measure(inline, contents)
+    after = await measure(renderer.render, contents)
+    # Repeated downloads of the same presentation are served from the content-hash cache
+    renderer.cache_size = downloads
+    await renderer.render(contents[0])
+    cached = await measure(renderer.render, contents[:1] * downloads)
+    renderer.shutdown()
+
+    print(f"{'mode':<12}{'elapsed s':>12}{'max lag ms':>14}{'p99 lag ms':>14}")
+    for name, result in (("inline", before), ("pool", after), ("pool+cache", cached)):
+        print(f"{name:<12}{result['elapsed']:>12.2f}{result['max_lag_ms']:>14.1f}{result['p99_lag_ms']:>14.1f}")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    asyncio.run(main(*(args + [20, 30][len(args):])))
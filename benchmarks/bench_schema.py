@@ -0,0 +1,101 @@
+"""Query times on a large database before and after the index/counter migrations.
+
+Seeds `rows` generated_content rows (default 1,000,000) plus users and payments
+into a schema at v2, times the admin/payment queries, migrates to the latest
+version and times them again.
+
+Run from the repository root:
+    python benchmarks/bench_schema.py [rows]
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark-token")
+
+from main import Database
+
+LEGACY_STATS = (
+    "SELECT COUNT(*) FROM users",
+    "SELECT COUNT(*) FROM payments WHERE status='pending'",
+    "SELECT COUNT(*) FROM generated_content",
+)
+
+
+def seed(path: str, rows: int):
+    users = max(1000, rows // 20)
+    payments = max(1000, rows // 10)
+    rng = random.Random(42)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("INSERT INTO users (tg_id, username, full_name, created) VALUES (?, ?, ?, ?)",
+                         ((i, f"u{i}", f"User {i}", "2024-01-01T00:00:00") for i in range(users)))
+        conn.executemany(
+            "INSERT INTO payments (tg_id, amount, card_number, card_holder, status, payment_id, created) "
+            "VALUES (?, 25000, 'PHOTO', 'Holder', ?, ?, ?)",
+            ((rng.randrange(users), 'pending' if rng.random() < 0.02 else 'approved', f"p{i}",
+              f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T00:00:{i % 60:02d}") for i in range(payments)))
+        conn.executemany(
+            "INSERT INTO generated_content (tg_id, content_type, topic, content, created) VALUES (?, ?, ?, ?, ?)",
+            ((rng.randrange(users), 'referat', f"Mavzu {i % 5000}", "x" * 200, "2024-01-01T00:00:00")
+             for i in range(rows)))
+    conn.close()
+    return users
+
+
+async def timed(fn, repeat: int = 5) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+async def measure(database: Database, users: int, legacy: bool):
+    async def stats():
+        if legacy:
+            async with database.pool.read() as db:
+                for sql in LEGACY_STATS:
+                    await (await db.execute(sql)).fetchone()
+        else:
+            await database.get_stats()
+
+    sample_user = users // 2
+    return {
+        "get_stats": await timed(stats),
+        "get_pending_payments": await timed(database.get_pending_payments),
+        "get_user_payments": await timed(lambda: database.get_user_payments(sample_user)),
+    }
+
+
+async def main(rows: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        database = Database(path)
+        await database.pool.open()
+        await database.migrate(target=2)
+        await database.close()
+
+        print(f"seeding {rows:,} generated_content rows...")
+        users = seed(path, rows)
+
+        await database.pool.open()
+        before = await measure(database, users, legacy=True)
+        start = time.perf_counter()
+        await database.migrate()
+        migrate_seconds = time.perf_counter() - start
+        after = await measure(database, users, legacy=False)
+        await database.close()
+
+    print(f"migration to latest took {migrate_seconds:.1f}s")
+    print(f"{'query':<22}{'before ms':>12}{'after ms':>12}")
+    for name in before:
+        print(f"{name:<22}{before[name]:>12.2f}{after[name]:>12.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000))
@@ -0,0 +1,65 @@
+"""Throughput of the single-pass slide parser vs. the previous re.split approach.
+
+Run from the repository root:
+    python benchmarks/bench_slide_parser.py [slides] [rounds]
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from documents import parse_slides
+
+
+def legacy_split(content: str):
+    """Parsing half of the old create_pptx_from_text: inline patterns, re-split fallback, per-chunk lines."""
+    slides_content = re.split(r'(?i)(?:^|\n)(?:Slide|Slayd)\s+\d+', content)
+    if len(slides_content) < 2:
+        slides_content = re.split(r'(?i)(?:^|\n)#+\s+', content)
+    slides_content = [s.strip() for s in slides_content if s.strip()]
+    result = []
+    for slide_text in slides_content:
+        lines = slide_text.split('\n')
+        title = lines[0].strip().replace('#', '').strip()
+        result.append((title, '\n'.join(lines[1:]).strip()))
+    return result
+
+
+def sample(slides: int) -> str:
+    parts = ["# Katta taqdimot\n\nMuallif: Talaba"]
+    for i in range(1, slides + 1):
+        parts.append(
+            f"## Slayd {i}: Bo'lim {i}\n"
+            f"- **Vizual Tushuncha:** Diagramma va jadval {i}\n"
+            f"- **Asosiy Matn (Slayd uchun):**\n"
+            + "\n".join(f"  - Punkt {i}.{j}: **muhim** fikr va izoh" for j in range(1, 6)) + "\n"
+            "- **Spiker Nutqi:** " + "Bu slaydda asosiy g'oyalar batafsil muhokama qilinadi. " * 6
+        )
+    return "\n\n".join(parts)
+
+
+def bench(fn, content: str, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(content)
+    return (time.perf_counter() - start) / rounds
+
+
+def main(slides: int, rounds: int):
+    content = sample(slides)
+    size_mb = len(content.encode('utf-8')) / 1e6
+    parsed = parse_slides(content)
+    assert len(parsed) == slides + 1, len(parsed)
+
+    print(f"input: {slides} slides, {size_mb:.2f} MB")
+    print(f"{'parser':<14}{'ms/parse':>10}{'MB/s':>10}{'slides/s':>12}")
+    for name, fn in (("legacy split", legacy_split), ("single-pass", parse_slides)):
+        seconds = bench(fn, content, rounds)
+        print(f"{name:<14}{seconds * 1000:>10.1f}{size_mb / seconds:>10.1f}{(slides + 1) / seconds:>12.0f}")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(*(args + [5000, 5][len(args):]))
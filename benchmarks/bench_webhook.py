@@ -0,0 +1,141 @@
+"""Load test: replay Telegram updates at the webhook endpoint for several worker counts.
+
+Starts a fake Bot API server (counting the messages the bot sends back), then for
+each worker count launches `main.py` in webhook mode against a scratch database
+and posts the updates to it. Throughput is measured up to the last reply the fake
+API receives, so it covers handling, not just acceptance.
+
+Run from the repository root:
+    python benchmarks/bench_webhook.py [updates] [workers,...] [--updates recorded.jsonl]
+
+Without --updates, synthetic /start messages from 500 distinct users are replayed.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from fake_bot_api import run_fake_bot_api
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456:benchmark-token"
+USERS = 500
+CONCURRENCY = 64
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def synthetic_updates(count: int):
+    now = int(time.time())
+    for i in range(count):
+        user = {"id": 1000 + i % USERS, "is_bot": False, "first_name": f"User {i % USERS}"}
+        yield {"update_id": i + 1, "message": {
+            "message_id": i + 1, "date": now, "chat": {"id": user["id"], "type": "private"},
+            "from": user, "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+
+
+def load_updates(path: str, count: int):
+    with open(path, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    return [updates[i % len(updates)] for i in range(count)]
+
+
+async def wait_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"server did not start: {url}")
+
+
+async def replay(url: str, updates, replies, last_reply, expected: int):
+    queue = iter(updates)
+
+    async def sender(session):
+        for update in queue:
+            async with session.post(url, json=update) as resp:
+                await resp.read()
+
+    start_replies = replies.value
+    start = time.time()
+    connector = aiohttp.TCPConnector(limit=CONCURRENCY)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(sender(session) for _ in range(CONCURRENCY)))
+    accepted = time.time() - start
+
+    # Wait until the expected replies arrived, or none came for a second
+    idle_since = time.time()
+    seen = replies.value
+    while replies.value - start_replies < expected and time.time() - idle_since < 1:
+        await asyncio.sleep(0.05)
+        if replies.value != seen:
+            seen, idle_since = replies.value, time.time()
+    handled = replies.value - start_replies
+    elapsed = max(last_reply.value, start + accepted) - start
+    return {"accepted_per_sec": len(updates) / accepted, "handled": handled,
+            "handled_per_sec": handled / elapsed if elapsed else 0.0}
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    recorded = sys.argv[sys.argv.index("--updates") + 1] if "--updates" in sys.argv else None
+    if recorded in args:
+        args.remove(recorded)
+    count = int(args[0]) if args else 2000
+    worker_counts = [int(n) for n in args[1].split(",")] if len(args) > 1 else [1, 2, 4]
+    updates = load_updates(recorded, count) if recorded else list(synthetic_updates(count))
+
+    replies = multiprocessing.Value("i", 0)
+    last_reply = multiprocessing.Value("d", 0.0)
+    api_port = free_port()
+    api = multiprocessing.Process(target=run_fake_bot_api, args=(api_port, replies, last_reply), daemon=True)
+    api.start()
+
+    results = []
+    try:
+        for workers in worker_counts:
+            with tempfile.TemporaryDirectory() as tmp:
+                for name in ("webapp.html", "static"):
+                    os.symlink(os.path.join(ROOT, name), os.path.join(tmp, name))
+                port = free_port()
+                env = dict(os.environ, BOT_TOKEN=TOKEN, BOT_MODE="webhook", WEB_HOST="127.0.0.1",
+                           WEB_PORT=str(port), WEB_WORKERS=str(workers), WEBHOOK_URL="",
+                           TELEGRAM_API_SERVER=f"http://127.0.0.1:{api_port}", PYTHONPATH=ROOT)
+                server = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], cwd=tmp, env=env,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    asyncio.run(wait_ready(f"http://127.0.0.1:{port}/api/health"))
+                    result = asyncio.run(replay(f"http://127.0.0.1:{port}/telegram/webhook", updates,
+                                                replies, last_reply, expected=len(updates)))
+                finally:
+                    server.send_signal(signal.SIGINT)
+                    server.wait(timeout=60)
+            results.append({"workers": workers, **result})
+    finally:
+        api.terminate()
+
+    print(f"{'workers':>8}{'accepted/s':>14}{'handled/s':>12}{'handled':>10}")
+    for r in results:
+        print(f"{r['workers']:>8}{r['accepted_per_sec']:>14.0f}{r['handled_per_sec']:>12.0f}{r['handled']:>10}")
+
+
+if __name__ == "__main__":
+    main()
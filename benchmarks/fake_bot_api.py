@@ -0,0 +1,88 @@
+"""A stand-in Telegram Bot API server for the benchmarks.
+
+Answers getMe, acknowledges every send* call with a Message and counts it. With
+`flood_limits` it also behaves like Telegram's flood control: more than `global`
+messages per second overall, or `per_chat` per second to one chat, gets a 429
+with `retry_after`, which aiogram raises as TelegramRetryAfter. `server_errors`
+maps chat ids to how many sends to that chat fail with a 500 before one succeeds.
+
+sign_init_data produces Web App initData the way Telegram signs it, for load
+tests of the authenticated API.
+"""
+import hashlib
+import hmac
+import json
+import time
+from collections import defaultdict, deque
+from urllib.parse import urlencode
+
+from aiohttp import web
+
+DEFAULT_FLOOD_LIMITS = {"global": 30, "per_chat": 1}
+
+
+def sign_init_data(user_id: int, token: str) -> str:
+    """Web App initData for `user_id`, signed with `token` the way Telegram signs it."""
+    fields = {
+        "query_id": f"AAH{user_id}",
+        "user": json.dumps({"id": user_id, "first_name": "Bench", "username": f"user{user_id}",
+                            "language_code": "uz"}, separators=(",", ":")),
+        "auth_date": str(int(time.time())),
+    }
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", token.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def build_app(replies, last_reply, rejected=None, flood_limits=None, server_errors=None) -> web.Application:
+    """`replies`, `last_reply` and `rejected` are multiprocessing Values (or anything with .value)."""
+    sent_at = deque()
+    chat_sent_at = defaultdict(deque)
+    server_errors = dict(server_errors or {})
+
+    def flooded(chat_id: int, now: float) -> int:
+        """Seconds the caller should wait, or 0 if the message may go out."""
+        for window, limit in ((sent_at, flood_limits["global"]), (chat_sent_at[chat_id], flood_limits["per_chat"])):
+            while window and now - window[0] >= 1:
+                window.popleft()
+            if len(window) >= limit:
+                return 1
+        sent_at.append(now)
+        chat_sent_at[chat_id].append(now)
+        return 0
+
+    async def handle(request: web.Request):
+        method = request.match_info["method"]
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 123456, "is_bot": True, "first_name": "Bench"}})
+        if method.startswith("send"):
+            data = await request.post() if request.content_type != "application/json" else await request.json()
+            chat_id = int(data.get("chat_id", 0))
+            if server_errors.get(chat_id, 0) > 0:
+                server_errors[chat_id] -= 1
+                return web.json_response({"ok": False, "error_code": 500,
+                                          "description": "Internal Server Error"}, status=500)
+            now = time.time()
+            retry_after = flooded(chat_id, now) if flood_limits else 0
+            if retry_after:
+                rejected.value += 1
+                return web.json_response({"ok": False, "error_code": 429,
+                                          "description": f"Too Many Requests: retry after {retry_after}",
+                                          "parameters": {"retry_after": retry_after}}, status=429)
+            replies.value += 1
+            last_reply.value = now
+            return web.json_response({"ok": True, "result": {
+                "message_id": 1, "date": int(now), "text": data.get("text", ""),
+                "chat": {"id": chat_id, "type": "private"}}})
+        return web.json_response({"ok": True, "result": True})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+def run_fake_bot_api(port: int, replies, last_reply, rejected=None, flood_limits=None, server_errors=None):
+    """Process target: serve the fake API on 127.0.0.1:`port` until terminated."""
+    app = build_app(replies, last_reply, rejected, flood_limits, server_errors)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
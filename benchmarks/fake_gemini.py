@@ -0,0 +1,37 @@
+"""A stand-in for google.generativeai.GenerativeModel for the benchmarks.
+
+Each call waits `latency` seconds (time to first token), then produces `tokens`
+words at `tokens_per_second`, either all at once or as streamed chunks, so the
+app's generation path can be load-tested without network or quota.
+"""
+import asyncio
+from types import SimpleNamespace
+
+WORDS = ("talaba", "bilim", "tadqiqot", "natija", "tahlil", "mavzu", "g'oya", "xulosa")
+
+
+class FakeGenerativeModel:
+    def __init__(self, latency: float = 0.5, tokens_per_second: float = 200, tokens: int = 400,
+                 chunk_tokens: int = 20):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.chunk_tokens = chunk_tokens
+        self.calls = 0
+
+    def _words(self, start: int, count: int) -> str:
+        return " ".join(WORDS[i % len(WORDS)] for i in range(start, start + count)) + " "
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        self.calls += 1
+        if stream:
+            return self._stream()
+        await asyncio.sleep(self.latency + self.tokens / self.tokens_per_second)
+        return SimpleNamespace(text=f"# {prompt[:60]}\n\n" + self._words(0, self.tokens))
+
+    async def _stream(self):
+        await asyncio.sleep(self.latency)
+        for start in range(0, self.tokens, self.chunk_tokens):
+            count = min(self.chunk_tokens, self.tokens - start)
+            await asyncio.sleep(count / self.tokens_per_second)
+            yield SimpleNamespace(text=self._words(start, count))
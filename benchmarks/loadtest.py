@@ -0,0 +1,265 @@
+"""Load test: the whole app against a stub Gemini model and a fake Bot API.
+
+Starts the app in webhook mode in a subprocess, with its AI router pointed at
+FakeGenerativeModel and its Bot API at fake_bot_api. Then it drives each
+scenario with concurrent clients:
+
+    generate   POST /api/generate (cache off, distinct topics, signed initData)
+    pptx       POST /api/download-pptx with a 10-slide presentation
+    bot        /start updates posted to the Telegram webhook
+
+Per scenario it reports throughput, p50/p95/p99 latency, errors and the server's
+event-loop lag, read from its own /metrics. Results are written as JSON so runs
+of different versions can be compared with --compare. A pptx run at high
+concurrency mostly measures load shedding: see the 503s under "statuses".
+
+Run from the repository root:
+    python benchmarks/loadtest.py [--requests 200] [--concurrency 32] [--scenarios generate,pptx,bot]
+        [--latency 0.5] [--tokens-per-second 200] [--tokens 400]
+        [--ai-rate-per-minute 60000] [--ai-concurrency 64]
+        [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456:benchmark-token"
+METRICS_TOKEN = "benchmark-metrics"
+METRICS_HEADERS = {"Authorization": f"Bearer {METRICS_TOKEN}"}
+USERS = 1000
+
+from bench_pptx_stall import sample_presentation
+from bench_webhook import free_port, synthetic_updates, wait_ready
+from fake_bot_api import run_fake_bot_api, sign_init_data
+
+
+def serve(port: int, latency: float, tokens_per_second: float, tokens: int):
+    """Server process: the app with its AI providers replaced by the stub model."""
+    sys.path.insert(0, ROOT)
+    import uvicorn
+
+    import main
+    from fake_gemini import FakeGenerativeModel
+
+    model = FakeGenerativeModel(latency, tokens_per_second, tokens)
+    main.ai_router = main.AIRouter([main.GeminiProvider(model)], throttle=main.generation_scheduler.throttle,
+                                   hedge_delay=main.AI_HEDGE_DELAY_SECONDS)
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def scrape_loop_lag(text: str):
+    """(cumulative bucket counts by upper bound, max lag) from the app's /metrics."""
+    buckets = {}
+    lag_max = 0.0
+    for line in text.splitlines():
+        match = re.match(r'event_loop_lag_seconds_bucket\{le="([^"]+)"\} (\S+)', line)
+        if match:
+            buckets[float(match.group(1))] = float(match.group(2))
+        elif line.startswith("event_loop_lag_max_seconds "):
+            lag_max = float(line.split()[1])
+    return buckets, lag_max
+
+
+def bucket_quantile(before, after, q: float) -> float:
+    """Upper bound of the histogram bucket holding quantile `q` of the samples taken in between."""
+    bounds = sorted(after)
+    total = after[bounds[-1]] - before.get(bounds[-1], 0) if bounds else 0
+    for bound in bounds:
+        if total and after[bound] - before.get(bound, 0) >= q * total:
+            return bound
+    return 0.0
+
+
+async def run_scenario(base: str, requests, concurrency: int, replies=None):
+    """POST `requests` ((path, json, headers) tuples) from `concurrency` clients, timing every response."""
+    latencies, errors, statuses = [], 0, {}
+    pending = iter(requests)
+
+    async def client(session):
+        nonlocal errors
+        for path, body, headers in pending:
+            start = time.perf_counter()
+            try:
+                async with session.post(base + path, json=body, headers=headers) as resp:
+                    payload = await resp.read()
+                    status = str(resp.status)
+                    ok = resp.status < 400
+                    if ok and resp.content_type == "application/json":
+                        ok = json.loads(payload).get("success", True) is not False
+            except aiohttp.ClientError:
+                status, ok = "connection error", False
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            errors += not ok
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async with session.get(base + "/metrics", headers=METRICS_HEADERS) as resp:
+            lag_before, _ = scrape_loop_lag(await resp.text())
+        start = time.perf_counter()
+        start_replies = replies.value if replies is not None else 0
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+        completed = len(latencies) - errors
+        if replies is not None:
+            # Bot updates are acknowledged before they are handled: count the replies instead
+            idle_since, seen = time.perf_counter(), replies.value
+            while replies.value - start_replies < len(latencies) and time.perf_counter() - idle_since < 1:
+                await asyncio.sleep(0.05)
+                if replies.value != seen:
+                    seen, idle_since = replies.value, time.perf_counter()
+            completed = replies.value - start_replies
+            elapsed = max(elapsed, idle_since - start)
+
+        async with session.get(base + "/metrics", headers=METRICS_HEADERS) as resp:
+            lag_after, lag_max = scrape_loop_lag(await resp.text())
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": statuses,
+        "completed": completed,
+        "seconds": round(elapsed, 3),
+        "throughput": round(completed / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {f"p{int(q * 100)}": round(percentile(latencies, q) * 1000, 2) for q in (0.5, 0.95, 0.99)},
+        # Bucket bounds overstate the quantiles; the max is exact
+        "loop_lag_ms": {
+            "p50": round(min(bucket_quantile(lag_before, lag_after, 0.5), lag_max) * 1000, 1),
+            "p99": round(min(bucket_quantile(lag_before, lag_after, 0.99), lag_max) * 1000, 1),
+            "max": round(lag_max * 1000, 1),
+        },
+    }
+
+
+def build_requests(name: str, count: int, init_data):
+    if name == "generate":
+        return [("/api/generate", {"type": "insho", "topic": f"Mavzu {i}", "params": {}, "cache": False},
+                 {"X-Telegram-Init-Data": init_data[i % USERS]}) for i in range(count)]
+    if name == "pptx":
+        return [("/api/download-pptx", {"content": sample_presentation(10, i), "topic": f"Taqdimot {i}"},
+                 {"X-Telegram-Init-Data": init_data[i % USERS]}) for i in range(count)]
+    if name == "bot":
+        return [("/telegram/webhook", update, {}) for update in synthetic_updates(count)]
+    raise ValueError(f"unknown scenario: {name}")
+
+
+async def run_all(base: str, args, replies):
+    init_data = [sign_init_data(1000 + i, TOKEN) for i in range(USERS)]
+    results = {}
+    for name in args.scenarios:
+        requests = build_requests(name, args.requests, init_data)
+        results[name] = await run_scenario(base, requests, args.concurrency, replies if name == "bot" else None)
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(results, baseline=None):
+    print(f"{'scenario':<10}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}{'lag p99':>9}{'lag max':>9}")
+    for name, r in results.items():
+        latency, lag = r["latency_ms"], r["loop_lag_ms"]
+        print(f"{name:<10}{r['throughput']:>9.1f}{latency['p50']:>9.1f}{latency['p95']:>9.1f}{latency['p99']:>9.1f}"
+              f"{r['errors']:>8}{lag['p99']:>9.1f}{lag['max']:>9.1f}")
+        base = (baseline or {}).get(name)
+        if base:
+            def change(new, old):
+                return f"{(new - old) / old * 100:+.0f}%" if old else "n/a"
+            print(f"{'  vs base':<10}{change(r['throughput'], base['throughput']):>9}"
+                  + "".join(f"{change(latency[p], base['latency_ms'][p]):>9}" for p in ("p50", "p95", "p99")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--scenarios", default="generate,pptx,bot", type=lambda s: s.split(","))
+    parser.add_argument("--latency", type=float, default=0.5, help="stub model time to first token (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--tokens", type=int, default=400, help="tokens per stub response")
+    # The app's own defaults model the Gemini quota (60/min), which would be all a run measures
+    parser.add_argument("--ai-rate-per-minute", type=int, default=60000)
+    parser.add_argument("--ai-concurrency", type=int, default=64)
+    parser.add_argument("--output", help="write the JSON results here (default: stdout)")
+    parser.add_argument("--compare", help="earlier JSON results to show changes against")
+    args = parser.parse_args()
+
+    replies = multiprocessing.Value("i", 0)
+    last_reply = multiprocessing.Value("d", 0.0)
+    api_port, port = free_port(), free_port()
+    api = multiprocessing.Process(target=run_fake_bot_api, args=(api_port, replies, last_reply), daemon=True)
+    api.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("webapp.html", "static"):
+            os.symlink(os.path.join(ROOT, name), os.path.join(tmp, name))
+        env = dict(os.environ, BOT_TOKEN=TOKEN, BOT_MODE="webhook", WEBHOOK_URL="",
+                   TELEGRAM_API_SERVER=f"http://127.0.0.1:{api_port}", PYTHONPATH=ROOT, METRICS_TOKEN=METRICS_TOKEN,
+                   RATE_LIMIT_FREE="1000000", DAILY_QUOTA_FREE="1000000", BOT_FLOOD_LIMIT="1000000",
+                   AI_RATE_PER_MINUTE=str(args.ai_rate_per_minute), AI_RATE_BURST=str(args.ai_concurrency),
+                   AI_MAX_CONCURRENCY=str(args.ai_concurrency))
+        code = (f"import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); "
+                f"import loadtest; loadtest.serve({port}, {args.latency}, {args.tokens_per_second}, {args.tokens})")
+        server = subprocess.Popen([sys.executable, "-c", code], cwd=tmp, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            base = f"http://127.0.0.1:{port}"
+            asyncio.run(wait_ready(base + "/api/health"))
+            scenarios = asyncio.run(run_all(base, args, replies))
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait(timeout=60)
+            api.terminate()
+
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "config": {key: getattr(args, key) for key in
+                       ("requests", "concurrency", "latency", "tokens_per_second", "tokens",
+                        "ai_rate_per_minute", "ai_concurrency")},
+        },
+        "scenarios": scenarios,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["scenarios"]
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print_table(scenarios, baseline)
+    else:
+        print(json.dumps(results, indent=2))
+        if baseline:
+            print_table(scenarios, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,722 @@
+"""Document rendering that runs inside worker processes.
+
+Kept separate from main.py so the render functions the pool pickles by
+reference depend on nothing but python-pptx and the standard library. The
+pool uses the spawn start method, so a worker still re-imports the script
+that launched the app (main.py as __mp_main__ under `python main.py`); that
+module must therefore have no side effects at import time. Presentations go
+through python-pptx; DOCX and PDF exports are written with the standard
+library only.
+"""
+import io
+import re
+import zipfile
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from pptx import Presentation
+
+# Base template bytes, loaded once per worker process by init_pptx_worker()
+_pptx_template: Optional[bytes] = None
+
+
+def load_pptx_template(path: Optional[str] = None) -> bytes:
+    if path:
+        with open(path, 'rb') as f:
+            return f.read()
+    output = io.BytesIO()
+    Presentation().save(output)
+    return output.getvalue()
+
+
+def init_pptx_worker(template_path: Optional[str] = None):
+    global _pptx_template
+    _pptx_template = load_pptx_template(template_path)
+
+
+def render_pptx(content: str) -> bytes:
+    """Process pool entry point: build the presentation and return the file bytes."""
+    return create_pptx_from_text(content, _pptx_template).getvalue()
+
+
+def warm_up() -> bool:
+    return _pptx_template is not None
+
+
+# Markdown Slide Parsing
+HEADING_RE = re.compile(r'^\s{0,3}#{1,6}\s*(.*?)\s*#*\s*$')
+SLIDE_LINE_RE = re.compile(r'^\s*(?:\*\*|__)?\s*(?:Slide|Slayd)\s+\d+\b', re.IGNORECASE)
+SLIDE_NUMBER_RE = re.compile(r'^(?:Slide|Slayd)\s+\d+\s*[:.\-\u2013\u2014)]?\s*', re.IGNORECASE)
+LABEL_RE = re.compile(
+    r'^\s*(?:[-*+\u2022]\s+)?(?:\*\*|__)\s*'
+    r'(Vizual Tushuncha|Vizual|Visual|Asosiy Matn|Main Text|Spiker Nutqi|Speaker Notes?)'
+    r'[^:*_]*:?\s*(?:\*\*|__)\s*:?\s*(.*)$',
+    re.IGNORECASE
+)
+BULLET_CHARS = '-*+\u2022'
+BULLET_RE = re.compile(r'^(\s*)(?:[-*+\u2022]|(\d+)[.)])\s+(.*)$')
+INLINE_MARKUP_RE = re.compile(r'\*\*|__|`')
+SEPARATOR_RE = re.compile(r'^\s*(?:-{3,}|\*{3,}|_{3,})\s*$')
+
+LABEL_SECTIONS = {
+    'vizual': 'visual', 'visual': 'visual',
+    'asosiy': 'bullets', 'main': 'bullets',
+    'spiker': 'notes', 'speaker': 'notes',
+}
+
+
+class Slide:
+    """Structured slide as requested by the generate_presentation prompt."""
+    __slots__ = ('title', 'bullets', 'visual', 'notes')
+
+    def __init__(self, title: str):
+        self.title = title
+        self.bullets: List[Tuple[str, int]] = []  # (text, indent level)
+        self.visual: List[str] = []
+        self.notes: List[str] = []
+
+    def is_empty(self) -> bool:
+        return not (self.bullets or self.visual or self.notes)
+
+    def __repr__(self):
+        return f"Slide({self.title!r}, bullets={len(self.bullets)}, notes={len(self.notes)})"
+
+
+def _clean(text: str) -> str:
+    if '*' in text or '_' in text or '`' in text:
+        text = INLINE_MARKUP_RE.sub('', text)
+    return text.strip()
+
+
+def _slide_title(text: str) -> str:
+    title = _clean(text)
+    stripped = SLIDE_NUMBER_RE.sub('', title).strip()
+    return stripped or title
+
+
+def iter_slides(lines: Iterable[str]) -> Iterator[Slide]:
+    """Single pass over markdown lines, yielding each slide as soon as the next one starts.
+
+    A slide starts at any heading or "Slayd N" line. Labelled blocks (Vizual
+    Tushuncha, Asosiy Matn, Spiker Nutqi) route the following lines to the
+    visual note, bullets or speaker notes; unlabelled text becomes bullets.
+    """
+    slide: Optional[Slide] = None
+    section = 'bullets'
+    base_indent: Optional[int] = None
+    preamble = False
+    for line in lines:
+        stripped = line.lstrip()
+        if not stripped:
+            continue
+        # Dispatch on the first character so most lines run at most one pattern
+        first = stripped[0]
+        marked = '**' in line or '__' in line
+        if first in '-*_' and SEPARATOR_RE.match(line):
+            continue
+
+        heading = HEADING_RE.match(line) if first == '#' else None
+        if heading or (first in 'Ss*_' and SLIDE_LINE_RE.match(line)):
+            title = _slide_title(heading.group(1) if heading else line)
+            if title and not LABEL_RE.match(title if heading else line):
+                # A lone line of chatter before the first heading is not a slide
+                if slide is not None and not (preamble and slide.is_empty()):
+                    yield slide
+                slide = Slide(title)
+                section, base_indent, preamble = 'bullets', None, False
+                continue
+
+        if slide is None:
+            # Text before the first heading: its first line becomes the title
+            slide = Slide(_clean(line))
+            section, base_indent, preamble = 'bullets', None, True
+            continue
+
+        label = LABEL_RE.match(line) if marked else None
+        if label:
+            section = LABEL_SECTIONS[label.group(1).split()[0].lower()]
+            base_indent = None
+            line = label.group(2)
+            stripped = line.lstrip()
+            if not stripped:
+                continue
+            first = stripped[0]
+
+        bullet = BULLET_RE.match(line) if first in BULLET_CHARS or first.isdigit() else None
+        text = _clean(bullet.group(3) if bullet else line)
+        if not text:
+            continue
+        if section == 'bullets':
+            level = 0
+            if bullet:
+                # Nesting is relative to the first bullet of the block
+                indent = len(bullet.group(1).expandtabs(4))
+                if base_indent is None:
+                    base_indent = indent
+                level = max(0, min((indent - base_indent) // 2, 4))
+            slide.bullets.append((text, level))
+        elif section == 'visual':
+            slide.visual.append(text)
+        else:
+            slide.notes.append(text)
+
+    if slide is not None and not (preamble and slide.is_empty()):
+        yield slide
+
+
+def parse_slides(content: str) -> List[Slide]:
+    return list(iter_slides(content.splitlines()))
+
+
+# PPTX Generator Helper
+def create_pptx_from_text(content: str, template: Optional[bytes] = None) -> io.BytesIO:
+    return build_pptx(iter_slides(content.splitlines()), template, fallback=content)
+
+
+def build_pptx(slides: Iterable[Slide], template: Optional[bytes] = None, fallback: str = '') -> io.BytesIO:
+    prs = Presentation(io.BytesIO(template)) if template else Presentation()
+
+    count = 0
+    for slide_model in slides:
+        # 0 = Title Slide for the first slide, 1 = Title and Content
+        layout = prs.slide_layouts[0] if count == 0 else prs.slide_layouts[1]
+        slide = prs.slides.add_slide(layout)
+        count += 1
+
+        if slide.shapes.title:
+            slide.shapes.title.text = slide_model.title
+
+        if len(slide.placeholders) > 1:
+            tf = slide.placeholders[1].text_frame
+            if count == 1:
+                # Title slide: the remaining lines become the subtitle
+                tf.text = '\n'.join(text for text, _ in slide_model.bullets)
+            else:
+                for index, (text, level) in enumerate(slide_model.bullets):
+                    paragraph = tf.paragraphs[0] if index == 0 else tf.add_paragraph()
+                    paragraph.text = text
+                    paragraph.level = level
+
+        notes = list(slide_model.notes)
+        if slide_model.visual:
+            notes.append("Vizual: " + ' '.join(slide_model.visual))
+        if notes:
+            slide.notes_slide.notes_text_frame.text = '\n\n'.join(notes)
+
+    # Nothing recognisable: keep the whole text on a single slide
+    if count == 0:
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        slide.shapes.title.text = "Prezentatsiya"
+        slide.placeholders[1].text_frame.text = fallback
+
+    output = io.BytesIO()
+    prs.save(output)
+    output.seek(0)
+    return output
+
+
+# Markdown Document Parsing (DOCX / PDF export)
+DOC_HEADING_RE = re.compile(r'^\s{0,3}(#{1,6})\s+(.*?)\s*#*\s*$')
+TABLE_SEPARATOR_RE = re.compile(r'^\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?$')
+INLINE_RE = re.compile(
+    r'(\*\*|__)(?=\S)(.+?)(?<=\S)\1'                 # **bold** / __bold__
+    r'|(?<![\w*])\*(?=\S)(.+?)(?<=\S)\*(?!\*)'       # *italic*
+    r'|(?<!\w)_(?=\S)(.+?)(?<=\S)_(?!\w)'            # _italic_
+    r'|`([^`]+)`'                                    # `code`
+)
+XML_INVALID_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+Run = Tuple[str, bool, bool]  # (text, bold, italic)
+
+
+class Block:
+    """One paragraph-level element of a generated text: heading, paragraph, bullet, code or rule.
+
+    Numbered list items carry the number to display in `number`.
+    """
+    __slots__ = ('kind', 'runs', 'level', 'ordered', 'number')
+
+    def __init__(self, kind: str, runs: Optional[List[Run]] = None, level: int = 0, ordered: bool = False,
+                 number: int = 0):
+        self.kind = kind
+        self.runs = runs or []
+        self.level = level
+        self.ordered = ordered
+        self.number = number
+
+    @property
+    def text(self) -> str:
+        return ''.join(text for text, _, _ in self.runs)
+
+    def __repr__(self):
+        return f"Block({self.kind!r}, {self.text[:30]!r}, level={self.level})"
+
+
+def parse_inline(text: str) -> List[Run]:
+    runs: List[Run] = []
+    pos = 0
+    for match in INLINE_RE.finditer(text):
+        if match.start() > pos:
+            runs.append((text[pos:match.start()], False, False))
+        if match.group(2) is not None:
+            runs.append((INLINE_MARKUP_RE.sub('', match.group(2)), True, False))
+        elif match.group(5) is not None:
+            runs.append((match.group(5), False, False))
+        else:
+            runs.append((match.group(3) or match.group(4), False, True))
+        pos = match.end()
+    if pos < len(text):
+        runs.append((text[pos:], False, False))
+    return [run for run in runs if run[0]]
+
+
+def iter_blocks(lines: Iterable[str]) -> Iterator[Block]:
+    """Single pass over markdown lines, shared by the DOCX and PDF writers.
+
+    Consecutive text lines form one paragraph; headings, list items, table rows,
+    rules and fenced code each become blocks of their own. Text lines that are
+    indented, or follow an item directly, continue that list item, and blank
+    lines inside a list don't end it. A numbered list counts on from its first
+    item's number, like markdown renderers do.
+    """
+    pending: List[str] = []
+    # List item whose text is still in `pending`, and whether a blank line followed it
+    item: Optional[Block] = None
+    gap = False
+    # Per nesting level: whether the open list is numbered (None = no list), and its last number
+    lists: List[Optional[bool]] = [None] * 5
+    numbers = [0] * 5
+    fence = False
+    base_indent: Optional[int] = None
+
+    def collected() -> Block:
+        block = item or Block('paragraph')
+        block.runs = parse_inline(' '.join(pending))
+        return block
+
+    for line in lines:
+        if fence:
+            if line.lstrip().startswith('```'):
+                fence = False
+            else:
+                yield Block('code', [(line.rstrip(), False, False)])
+            continue
+        stripped = line.strip()
+        first = stripped[:1]
+        heading = DOC_HEADING_RE.match(line) if first == '#' else None
+        bullet = BULLET_RE.match(line) if first and (first in BULLET_CHARS or first.isdigit()) else None
+        rule = first in ('-', '*', '_') and SEPARATOR_RE.match(line)
+        plain = stripped and not (heading or bullet or rule) and first not in ('|', '`')
+        text = stripped.lstrip('>').strip() if first == '>' else stripped
+        if item is not None and plain and (line[:1].isspace() or not gap):
+            if text:
+                pending.append(text)
+            gap = False
+            continue
+        if not stripped:
+            gap = True
+            if item is None and pending:
+                yield collected()
+                pending = []
+            continue
+        if pending and (item is not None or not plain):
+            yield collected()
+            pending, item = [], None
+        if not bullet:
+            # Anything but a list item or its continuation ends the list
+            lists = [None] * 5
+            base_indent = None
+        if stripped.startswith('```'):
+            fence = True
+        elif heading:
+            yield Block('heading', parse_inline(heading.group(2)), level=len(heading.group(1)))
+        elif rule:
+            yield Block('rule')
+        elif bullet:
+            indent = len(bullet.group(1).expandtabs(4))
+            if base_indent is None:
+                base_indent = indent
+            level = max(0, min((indent - base_indent) // 2, 4))
+            ordered = bullet.group(2) is not None
+            if lists[level] is ordered:
+                numbers[level] += 1
+            else:
+                # A new list, or one switching between bullets and numbers
+                lists[level], numbers[level] = ordered, int(bullet.group(2)) if ordered else 0
+            lists[level + 1:] = [None] * (4 - level)
+            item = Block('bullet', level=level, ordered=ordered, number=numbers[level] if ordered else 0)
+            pending, gap = [bullet.group(3)], False
+        elif first == '|':
+            if not TABLE_SEPARATOR_RE.match(stripped):
+                cells = [cell.strip() for cell in stripped.strip('|').split('|')]
+                yield Block('paragraph', parse_inline('  |  '.join(cells)))
+        elif text:
+            pending.append(text)
+    if pending:
+        yield collected()
+
+
+def render_document(fmt: str, content: str, title: str, path: str) -> str:
+    """Process pool entry point: write `content` as a .docx or .pdf file at `path`."""
+    blocks = iter_blocks(content.splitlines())
+    with open(path, 'wb') as f:
+        if fmt == 'docx':
+            write_docx(blocks, f, title)
+        elif fmt == 'pdf':
+            write_pdf(blocks, f, title)
+        else:
+            raise ValueError(f"Unknown document format: {fmt}")
+    return path
+
+
+# DOCX Writer
+# A minimal WordprocessingML package written with zipfile: no python-docx needed,
+# and document.xml is streamed into the archive one block at a time.
+W_NS = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '<Override PartName="/word/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+    '<Override PartName="/word/numbering.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.numbering+xml"/>'
+    '<Override PartName="/docProps/core.xml" '
+    'ContentType="application/vnd.openxmlformats-package.core-properties+xml"/>'
+    '</Types>'
+)
+DOCX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties" '
+    'Target="docProps/core.xml"/>'
+    '</Relationships>'
+)
+DOCX_DOCUMENT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/numbering" '
+    'Target="numbering.xml"/>'
+    '</Relationships>'
+)
+
+
+def _docx_style(style_id: str, name: str, size: int, bold: bool = False, before: int = 0, after: int = 120,
+                font: Optional[str] = None, center: bool = False) -> str:
+    # Child order matters to Word: rFonts, b, sz
+    run = ('<w:b/>' if bold else '') + f'<w:sz w:val="{size}"/>'
+    if font:
+        run = f'<w:rFonts w:ascii="{font}" w:hAnsi="{font}" w:cs="{font}"/>' + run
+    paragraph = f'<w:spacing w:before="{before}" w:after="{after}"/>' + ('<w:jc w:val="center"/>' if center else '')
+    if style_id.startswith('Heading'):
+        paragraph = '<w:keepNext/>' + paragraph + f'<w:outlineLvl w:val="{int(style_id[-1]) - 1}"/>'
+    return (f'<w:style w:type="paragraph" w:styleId="{style_id}"><w:name w:val="{name}"/>'
+            f'<w:basedOn w:val="Normal"/><w:qFormat/><w:pPr>{paragraph}</w:pPr><w:rPr>{run}</w:rPr></w:style>')
+
+
+# Times New Roman 14pt at 1.5 line spacing: the usual layout for referats
+DOCX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    f'<w:styles {W_NS}>'
+    '<w:docDefaults><w:rPrDefault><w:rPr>'
+    '<w:rFonts w:ascii="Times New Roman" w:hAnsi="Times New Roman" w:cs="Times New Roman" w:eastAsia="Times New Roman"/>'
+    '<w:sz w:val="28"/><w:szCs w:val="28"/><w:lang w:val="uz-Latn-UZ"/></w:rPr></w:rPrDefault>'
+    '<w:pPrDefault><w:pPr><w:spacing w:after="120" w:line="360" w:lineRule="auto"/></w:pPr></w:pPrDefault>'
+    '</w:docDefaults>'
+    '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/><w:qFormat/>'
+    '<w:pPr><w:jc w:val="both"/></w:pPr></w:style>'
+    + _docx_style('Title', 'Title', 36, bold=True, after=240, center=True)
+    + _docx_style('Heading1', 'heading 1', 32, bold=True, before=240)
+    + _docx_style('Heading2', 'heading 2', 30, bold=True, before=200)
+    + _docx_style('Heading3', 'heading 3', 28, bold=True, before=160)
+    + _docx_style('ListParagraph', 'List Paragraph', 28, after=60)
+    + _docx_style('Code', 'Code', 22, after=0, font='Courier New')
+    + '</w:styles>'
+)
+
+
+def _docx_abstract_num(abstract_id: int, ordered: bool) -> str:
+    levels = []
+    for level in range(5):
+        fmt, text = ('decimal', f'%{level + 1}.') if ordered else ('bullet', '•' if level % 2 == 0 else '◦')
+        levels.append(f'<w:lvl w:ilvl="{level}"><w:start w:val="1"/><w:numFmt w:val="{fmt}"/>'
+                      f'<w:lvlText w:val="{text}"/><w:lvlJc w:val="left"/>'
+                      f'<w:pPr><w:ind w:left="{720 * (level + 1)}" w:hanging="360"/></w:pPr></w:lvl>')
+    return f'<w:abstractNum w:abstractNumId="{abstract_id}">{"".join(levels)}</w:abstractNum>'
+
+
+def _docx_numbering(ordered_lists: List[Tuple[int, int]]) -> str:
+    # numId 1 is shared by all bullet lists; each numbered list, given as (level, start),
+    # gets its own numId so that it starts from its source number
+    nums = ['<w:num w:numId="1"><w:abstractNumId w:val="0"/></w:num>']
+    for num_id, (level, start) in enumerate(ordered_lists, 2):
+        nums.append(f'<w:num w:numId="{num_id}"><w:abstractNumId w:val="1"/>'
+                    f'<w:lvlOverride w:ilvl="{level}"><w:startOverride w:val="{start}"/></w:lvlOverride></w:num>')
+    return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<w:numbering {W_NS}>{_docx_abstract_num(0, False)}{_docx_abstract_num(1, True)}{"".join(nums)}'
+            '</w:numbering>')
+
+
+def _xml_text(text: str) -> str:
+    return XML_INVALID_RE.sub('', text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _docx_runs(runs: List[Run]) -> str:
+    parts = []
+    for text, bold, italic in runs:
+        props = ('<w:b/>' if bold else '') + ('<w:i/>' if italic else '')
+        props = f'<w:rPr>{props}</w:rPr>' if props else ''
+        parts.append(f'<w:r>{props}<w:t xml:space="preserve">{_xml_text(text)}</w:t></w:r>')
+    return ''.join(parts)
+
+
+def write_docx(blocks: Iterable[Block], output, title: str = ''):
+    ordered_lists: List[Tuple[int, int]] = []
+    # Per level: numId of the numbered list in use, and the number its next item would get
+    num_ids = [1] * 5
+    next_numbers = [0] * 5
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', DOCX_CONTENT_TYPES)
+        archive.writestr('_rels/.rels', DOCX_ROOT_RELS)
+        archive.writestr('word/_rels/document.xml.rels', DOCX_DOCUMENT_RELS)
+        archive.writestr('word/styles.xml', DOCX_STYLES)
+        with archive.open('word/document.xml', 'w') as document:
+            document.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                            f'<w:document {W_NS}><w:body>').encode('utf-8'))
+            first = True
+            for block in blocks:
+                if block.kind != 'bullet':
+                    next_numbers = [0] * 5
+                else:
+                    # An item that doesn't continue the level's numbering starts a new numbered list
+                    if block.ordered and block.number != next_numbers[block.level]:
+                        ordered_lists.append((block.level, block.number))
+                        num_ids[block.level] = len(ordered_lists) + 1
+                    next_numbers[block.level] = block.number + 1 if block.ordered else 0
+                    next_numbers[block.level + 1:] = [0] * (4 - block.level)
+                if block.kind == 'heading':
+                    style = 'Title' if first and block.level == 1 else f'Heading{min(block.level, 3)}'
+                    props = f'<w:pStyle w:val="{style}"/>'
+                elif block.kind == 'bullet':
+                    num_id = num_ids[block.level] if block.ordered else 1
+                    props = (f'<w:pStyle w:val="ListParagraph"/><w:numPr><w:ilvl w:val="{block.level}"/>'
+                             f'<w:numId w:val="{num_id}"/></w:numPr>')
+                elif block.kind == 'code':
+                    props = '<w:pStyle w:val="Code"/>'
+                elif block.kind == 'rule':
+                    props = '<w:pBdr><w:bottom w:val="single" w:sz="6" w:space="1" w:color="auto"/></w:pBdr>'
+                else:
+                    props = ''
+                document.write(f'<w:p><w:pPr>{props}</w:pPr>{_docx_runs(block.runs)}</w:p>'.encode('utf-8'))
+                first = False
+            # A4, 3 cm left and 1.5 cm right margins, 2 cm top and bottom
+            document.write(('<w:sectPr><w:pgSz w:w="11906" w:h="16838"/>'
+                            '<w:pgMar w:top="1134" w:right="850" w:bottom="1134" w:left="1701" '
+                            'w:header="708" w:footer="708" w:gutter="0"/></w:sectPr>'
+                            '</w:body></w:document>').encode('utf-8'))
+        archive.writestr('word/numbering.xml', _docx_numbering(ordered_lists))
+        archive.writestr('docProps/core.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:title>{_xml_text(title)}</dc:title><dc:creator>Talaba Bot</dc:creator></cp:coreProperties>'))
+
+
+# PDF Writer
+# Uses the 14 standard PDF fonts, so nothing is embedded and no font files are
+# needed. Those fonts only cover WinAnsi (cp1252), which fits Uzbek Latin;
+# Cyrillic is transliterated to Latin. Each page's content stream is written as
+# soon as the page is full.
+PDF_PAGE_WIDTH, PDF_PAGE_HEIGHT = 595.28, 841.89  # A4 in points
+PDF_MARGIN_LEFT, PDF_MARGIN_RIGHT, PDF_MARGIN_Y = 85.0, 42.5, 56.7
+PDF_FONTS = {
+    (False, False): ('F1', 'Helvetica'),
+    (True, False): ('F2', 'Helvetica-Bold'),
+    (False, True): ('F3', 'Helvetica-Oblique'),
+    (True, True): ('F4', 'Helvetica-BoldOblique'),
+    'code': ('F5', 'Courier'),
+}
+PDF_SIZES = {'heading': (18, 15, 13, 12, 12, 12), 'paragraph': 11, 'bullet': 11, 'code': 9.5}
+
+# Helvetica advance widths (1/1000 em) for ASCII 32..126, from the standard AFM
+HELVETICA_WIDTHS = (
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+)
+
+CYRILLIC_TO_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo', 'ж': 'j', 'з': 'z', 'и': 'i',
+    'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't',
+    'у': 'u', 'ф': 'f', 'х': 'x', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sh', 'ъ': "'", 'ы': 'i', 'ь': '',
+    'э': 'e', 'ю': 'yu', 'я': 'ya', 'ў': "o'", 'қ': 'q', 'ғ': "g'", 'ҳ': 'h',
+}
+PDF_TRANSLATION = {ord(c): latin for c, latin in CYRILLIC_TO_LATIN.items()}
+PDF_TRANSLATION.update({ord(c.upper()): latin.capitalize() for c, latin in CYRILLIC_TO_LATIN.items()})
+PDF_TRANSLATION.update({0x02BB: "'", 0x02BC: "'", 0x00A0: ' ', 0x2212: '-'})
+
+
+def _pdf_text(text: str) -> bytes:
+    encoded = text.translate(PDF_TRANSLATION).encode('cp1252', 'replace')
+    return encoded.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+def _text_width(text: str, size: float, bold: bool = False, code: bool = False) -> float:
+    if code:
+        return len(text) * 600 * size / 1000
+    units = sum(HELVETICA_WIDTHS[ord(c) - 32] if 32 <= ord(c) <= 126 else 556 for c in text)
+    # Bold glyphs are wider; overestimating keeps lines inside the margin
+    return units * (1.1 if bold else 1.0) * size / 1000
+
+
+class _PdfWriter:
+    """Writes a PDF object by object, keeping only the current page in memory."""
+
+    # Object numbers fixed up front; pages and their content streams follow
+    CATALOG, PAGES, INFO, FIRST_FONT = 1, 2, 3, 4
+
+    def __init__(self, output, title: str):
+        self.output = output
+        self.title = title
+        self.offsets = {}
+        self.position = 0
+        self.next_id = self.FIRST_FONT + len(PDF_FONTS)
+        self.pages: List[int] = []
+        self.ops: List[bytes] = []
+        self.y = 0.0
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data: bytes):
+        self.output.write(data)
+        self.position += len(data)
+
+    def _object(self, number: int, body: bytes):
+        self.offsets[number] = self.position
+        self._write(b'%d 0 obj\n' % number + body + b'\nendobj\n')
+
+    def new_page(self):
+        self.finish_page()
+        self.y = PDF_PAGE_HEIGHT - PDF_MARGIN_Y
+
+    def finish_page(self):
+        if not self.ops:
+            return
+        stream = b'\n'.join(self.ops)
+        self.ops = []
+        content_id, page_id = self.next_id, self.next_id + 1
+        self.next_id += 2
+        self._object(content_id, b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+        fonts = b' '.join(b'/%s %d 0 R' % (name.encode(), self.FIRST_FONT + i)
+                          for i, (name, _) in enumerate(PDF_FONTS.values()))
+        self._object(page_id, (b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.2f %.2f] '
+                               b'/Contents %d 0 R /Resources << /Font << %s >> >> >>')
+                     % (self.PAGES, PDF_PAGE_WIDTH, PDF_PAGE_HEIGHT, content_id, fonts))
+        self.pages.append(page_id)
+
+    def space(self, height: float):
+        if not self.ops or self.y - height < PDF_MARGIN_Y:
+            self.new_page()
+        self.y -= height
+
+    def line(self, words: List[Tuple[str, Tuple[str, str]]], x: float, size: float):
+        """Draw one line of (text, font) pieces starting at x on the current baseline."""
+        parts = [b'BT %.2f %.2f Td' % (x, self.y)]
+        current = None
+        for text, (font, _) in words:
+            if font != current:
+                parts.append(b'/%s %.1f Tf' % (font.encode(), size))
+                current = font
+            parts.append(b'(' + _pdf_text(text) + b') Tj')
+        parts.append(b'ET')
+        self.ops.append(b' '.join(parts))
+
+    def rule(self):
+        self.ops.append(b'0.5 w %.2f %.2f m %.2f %.2f l S'
+                        % (PDF_MARGIN_LEFT, self.y, PDF_PAGE_WIDTH - PDF_MARGIN_RIGHT, self.y))
+
+    def close(self):
+        if not self.ops and not self.pages:
+            self.new_page()
+            self.ops.append(b'')
+        self.finish_page()
+        for i, (_, base_font) in enumerate(PDF_FONTS.values()):
+            self._object(self.FIRST_FONT + i, b'<< /Type /Font /Subtype /Type1 /BaseFont /%s '
+                                              b'/Encoding /WinAnsiEncoding >>' % base_font.encode())
+        kids = b' '.join(b'%d 0 R' % page for page in self.pages)
+        self._object(self.PAGES, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.pages)))
+        self._object(self.CATALOG, b'<< /Type /Catalog /Pages %d 0 R >>' % self.PAGES)
+        self._object(self.INFO, b'<< /Title (' + _pdf_text(self.title) + b') /Producer (Talaba Bot) >>')
+        xref = self.position
+        count = self.next_id
+        entries = [b'0000000000 65535 f \n'] + [b'%010d 00000 n \n' % self.offsets[n] for n in range(1, count)]
+        self._write(b'xref\n0 %d\n' % count + b''.join(entries))
+        self._write(b'trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                    % (count, self.CATALOG, self.INFO, xref))
+
+
+def _wrap(runs: List[Run], size: float, width: float, code: bool = False):
+    """Greedy word wrap of styled runs into lines of (text, font) pieces."""
+    lines, line, line_width = [], [], 0.0
+    space = _text_width(' ', size)
+    for text, bold, italic in runs:
+        font = PDF_FONTS['code'] if code else PDF_FONTS[(bold, italic)]
+        for word in text.split(' '):
+            if not word:
+                continue
+            word_width = _text_width(word, size, bold, code)
+            gap = space if line else 0.0
+            if line and line_width + gap + word_width > width:
+                lines.append(line)
+                line, line_width, gap = [], 0.0, 0.0
+            # Merge into the previous piece when the font is the same
+            if line and line[-1][1] == font:
+                line[-1] = (line[-1][0] + ' ' + word, font)
+            else:
+                line.append(((' ' if gap else '') + word, font))
+            line_width += gap + word_width
+    if line:
+        lines.append(line)
+    return lines
+
+
+def write_pdf(blocks: Iterable[Block], output, title: str = ''):
+    writer = _PdfWriter(output, title)
+    text_width = PDF_PAGE_WIDTH - PDF_MARGIN_LEFT - PDF_MARGIN_RIGHT
+    for block in blocks:
+        if block.kind == 'rule':
+            writer.space(12)
+            writer.rule()
+            continue
+        if block.kind == 'heading':
+            size = PDF_SIZES['heading'][block.level - 1]
+            runs = [(text, True, italic) for text, _, italic in block.runs]
+            before, indent = size * 0.8, 0.0
+        else:
+            size = PDF_SIZES[block.kind]
+            runs, before, indent = block.runs, (0 if block.kind == 'code' else size * 0.4), 0.0
+        marker = None
+        if block.kind == 'bullet':
+            marker = f"{block.number}." if block.ordered else '•'
+            indent = 18.0 * block.level
+        leading = size * 1.35
+        # List text hangs after its marker
+        hang = 18.0 if marker else 0.0
+        lines = _wrap(runs, size, text_width - indent - hang, code=block.kind == 'code') or [[]]
+        writer.space(before)
+        for index, pieces in enumerate(lines):
+            writer.space(leading)
+            if marker and index == 0:
+                writer.line([(marker, PDF_FONTS[(False, False)])], PDF_MARGIN_LEFT + indent, size)
+            if pieces:
+                writer.line(pieces, PDF_MARGIN_LEFT + indent + hang, size)
+    writer.close()
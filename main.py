@@ -2,36 +2,146 @@ import os
 import logging
 import asyncio
 import json
+import re
 import uuid
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+import gzip
+import hashlib
+import hmac
+import bisect
+import contextlib
+import contextvars
+import functools
+import inspect
+import mimetypes
+import heapq
+import itertools
+import math
+import time
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple
+from urllib.parse import parse_qsl, quote
 
+import aiohttp
 import aiosqlite
 import google.generativeai as genai
-from aiogram import Bot, Dispatcher, types, Router, F
-from aiogram.filters import CommandStart, Command
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.dispatcher.flags import get_flag
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
-from aiogram.types import WebAppInfo, Message, CallbackQuery
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import WebAppInfo, Message, CallbackQuery, InputMediaPhoto
 import uvicorn
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import Depends, FastAPI, Request, HTTPException
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 
+from documents import init_pptx_worker, render_document, render_pptx, warm_up
+
+try:
+    import brotli
+except ImportError:  # optional: gzip is always available
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional: content bodies fall back to zlib
+    zstandard = None
+
 # Load environment variables
 load_dotenv('config.env', override=True)
 
 # Configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-if BOT_TOKEN:
-    print(f"DEBUG: Loaded token: '{BOT_TOKEN}' (length: {len(BOT_TOKEN)})")
-else:
-    print("DEBUG: BOT_TOKEN is None or Empty")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-pro")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.1-70b-versatile")
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "google/gemini-flash-1.5")
+MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
+MISTRAL_MODEL = os.getenv("MISTRAL_MODEL", "mistral-small-latest")
+AI_PROVIDERS = [p.strip() for p in os.getenv("AI_PROVIDERS", "gemini,openai,groq,openrouter,mistral").split(",") if p.strip()]
+AI_HEDGE_DELAY_SECONDS = float(os.getenv("AI_HEDGE_DELAY_SECONDS", "20"))
+AI_REQUEST_TIMEOUT_SECONDS = float(os.getenv("AI_REQUEST_TIMEOUT_SECONDS", "120"))
+CHUNKED_REFERAT_MIN_PAGES = int(os.getenv("CHUNKED_REFERAT_MIN_PAGES", "8"))
+TEST_BATCH_SIZE = int(os.getenv("TEST_BATCH_SIZE", "15"))
+AI_FANOUT_CONCURRENCY = int(os.getenv("AI_FANOUT_CONCURRENCY", "4"))
+PPTX_WORKERS = int(os.getenv("PPTX_WORKERS", "2"))
+PPTX_MAX_QUEUE = int(os.getenv("PPTX_MAX_QUEUE", "16"))
+PPTX_TIMEOUT_SECONDS = float(os.getenv("PPTX_TIMEOUT_SECONDS", "30"))
+PPTX_CACHE_SIZE = int(os.getenv("PPTX_CACHE_SIZE", "64"))
+PPTX_TEMPLATE = os.getenv("PPTX_TEMPLATE") or None
+DOCUMENT_CACHE_DIR = os.getenv("DOCUMENT_CACHE_DIR", "document_cache")
+DOCUMENT_CACHE_FILES = int(os.getenv("DOCUMENT_CACHE_FILES", "256"))
+WEBAPP_RELOAD = os.getenv("WEBAPP_RELOAD", "0").lower() in ("1", "true", "yes")
 PREMIUM_PRICE = int(os.getenv("PREMIUM_PRICE", "50000"))
 WEBAPP_URL = os.getenv("WEBAPP_URL", "")
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8081"))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+NOTIFY_RATE_PER_SECOND = float(os.getenv("NOTIFY_RATE_PER_SECOND", "25"))
+NOTIFY_PER_CHAT_SECONDS = float(os.getenv("NOTIFY_PER_CHAT_SECONDS", "1"))
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "16"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "900"))
+PREMIUM_SWEEP_SECONDS = float(os.getenv("PREMIUM_SWEEP_SECONDS", "60"))
+PREMIUM_REMIND_HOURS = float(os.getenv("PREMIUM_REMIND_HOURS", "72"))
+RATE_LIMIT_WINDOW_SECONDS = float(os.getenv("RATE_LIMIT_WINDOW_SECONDS", "60"))
+RATE_LIMIT_FREE = int(os.getenv("RATE_LIMIT_FREE", "3"))
+RATE_LIMIT_PREMIUM = int(os.getenv("RATE_LIMIT_PREMIUM", "10"))
+DAILY_QUOTA_FREE = int(os.getenv("DAILY_QUOTA_FREE", "10"))
+DAILY_QUOTA_PREMIUM = int(os.getenv("DAILY_QUOTA_PREMIUM", "100"))
+QUOTA_FLUSH_SECONDS = float(os.getenv("QUOTA_FLUSH_SECONDS", "10"))
+BOT_FLOOD_LIMIT = int(os.getenv("BOT_FLOOD_LIMIT", "20"))
+BOT_FLOOD_WINDOW_SECONDS = float(os.getenv("BOT_FLOOD_WINDOW_SECONDS", "10"))
+INIT_DATA_MAX_AGE_SECONDS = int(os.getenv("INIT_DATA_MAX_AGE_SECONDS", "86400"))
+INIT_DATA_CACHE_SIZE = int(os.getenv("INIT_DATA_CACHE_SIZE", "10000"))
+# Lets the Web App be opened in a plain browser during development; keep 0 in production
+WEBAPP_DEV_USER_ID = int(os.getenv("WEBAPP_DEV_USER_ID", "0"))
+# Bearer token for /metrics and the detailed /api/health; both stay closed while unset
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "30"))
+TELEGRAM_API_SERVER = os.getenv("TELEGRAM_API_SERVER", "")
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", "4"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+FSM_STATE_TTL_HOURS = float(os.getenv("FSM_STATE_TTL_HOURS", "24"))
+FSM_CACHE_SECONDS = float(os.getenv("FSM_CACHE_SECONDS", "5"))
+FSM_FLUSH_INTERVAL_MS = int(os.getenv("FSM_FLUSH_INTERVAL_MS", "200"))
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "50"))
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "100"))
+GENERATION_CACHE_SIZE = int(os.getenv("GENERATION_CACHE_SIZE", "512"))
+GENERATION_CACHE_MAX_MB = int(os.getenv("GENERATION_CACHE_MAX_MB", "32"))
+GENERATION_CACHE_TTL_HOURS = int(os.getenv("GENERATION_CACHE_TTL_HOURS", "168"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))
+AI_RATE_PER_MINUTE = int(os.getenv("AI_RATE_PER_MINUTE", "60"))
+AI_RATE_BURST = int(os.getenv("AI_RATE_BURST", "10"))
+
+# Webhook mode serves from WEB_WORKERS processes, each with its own in-memory limiters.
+# Limits meant for the whole bot are split between them so the totals stay as configured.
+LIMIT_SHARDS = max(1, WEB_WORKERS) if BOT_MODE == "webhook" else 1
+
+def per_worker(limit: int) -> int:
+    """This process's share of a bot-wide limit; at least 1, so a small limit may round up."""
+    return max(1, limit // LIMIT_SHARDS)
 
 # Configure Logging
 logging.basicConfig(
@@ -41,154 +151,2226 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Configure Gemini AI
+# Import-time code must stay free of side effects: spawned PPTX workers re-import
+# the launching script (python main.py) as __mp_main__.
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-pro')
+    model = genai.GenerativeModel(GEMINI_MODEL)
 else:
-    logger.warning("GEMINI_API_KEY not found in environment variables!")
     model = None
 
+# Metrics
+metrics_registry: List["Metric"] = []
+
+class Metric:
+    """Base for the metrics exported on /metrics in the Prometheus text format.
+
+    Series are keyed by label-value tuples. Everything runs on the event loop, so
+    updates need no locking and cost a dict lookup plus an addition.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.series: Dict[tuple, Any] = {}
+        metrics_registry.append(self)
+
+    def _labels(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{escape_label(str(value))}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._labels(labels)} {value}" for labels, value in self.series.items()]
+
+    def expose(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, *labels):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Set directly, or computed at scrape time by `collect` returning {labels: value}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value: float, *labels):
+        self.series[labels] = value
+
+    def samples(self) -> List[str]:
+        if self.collect:
+            self.series = self.collect()
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            # Per-bucket counts (last slot is +Inf), sum
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self._labels(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+def timed(histogram: Histogram, *labels):
+    """Decorator observing a coroutine function's duration in `histogram`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labels)
+        return wrapper
+    return decorator
+
+
+def timed_methods(histogram: Histogram):
+    """Class decorator: time every public coroutine method, labelled by method name."""
+    def decorator(cls):
+        for name, attr in list(vars(cls).items()):
+            if not name.startswith('_') and inspect.iscoroutinefunction(attr):
+                setattr(cls, name, timed(histogram, name)(attr))
+        return cls
+    return decorator
+
+
+def estimate_tokens(text: str) -> int:
+    # Providers don't all report usage; ~4 characters per token is close enough for trends
+    return (len(text) + 3) // 4
+
+
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds",
+                                 "HTTP request latency until the last body chunk is sent",
+                                 ("method", "route", "status"))
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Duration of Database methods", ("method",))
+AI_GENERATION_SECONDS = Histogram("ai_generation_duration_seconds",
+                                  "End-to-end AI generation time per content type", ("content_type", "outcome"))
+AI_PROVIDER_SECONDS = Histogram("ai_provider_request_duration_seconds",
+                                "Duration of single AI provider calls", ("provider", "content_type", "outcome"))
+AI_TOKENS = Counter("ai_tokens_total", "Estimated prompt and completion tokens (~4 chars/token)",
+                    ("content_type", "kind"))
+BOT_HANDLER_SECONDS = Histogram("bot_handler_duration_seconds", "aiogram handler duration", ("event", "handler"))
+EVENT_LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "How late the event loop runs a timer callback",
+                                   buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+OUTBOX_MESSAGES = Counter("outbox_messages_total", "Outbound bot messages by result", ("result",))
+RATE_LIMITED = Counter("rate_limited_total", "Requests rejected by per-user limits", ("reason",))
+EVENT_LOOP_LAG_MAX = Gauge("event_loop_lag_max_seconds", "Largest event loop lag since the previous scrape")
+
+# Content type of the generation running in the current task, for per-type AI metrics
+ai_content_type: contextvars.ContextVar = contextvars.ContextVar("ai_content_type", default="other")
+# Whether the generation running in the current task is for a premium user, for scheduler priority
+ai_premium: contextvars.ContextVar = contextvars.ContextVar("ai_premium", default=False)
+
+
+async def monitor_event_loop_lag(interval: float = 0.25):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - start - interval, 0.0)
+        EVENT_LOOP_LAG_SECONDS.observe(lag)
+        if lag > EVENT_LOOP_LAG_MAX.series.get((), 0.0):
+            EVENT_LOOP_LAG_MAX.set(lag)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing each HTTP request by its route template.
+
+    Unmatched paths share the route label "other" so scanners can't blow up the
+    series count. Streaming responses are timed until their final chunk.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"],
+                                         getattr(route, "path", "other"), status)
+
+# Database Connection Pool
+class ConnectionPool:
+    """One long-lived writer connection plus a small pool of reader connections.
+
+    Opening a fresh aiosqlite connection spawns a worker thread and a file handle,
+    so we keep them around for the lifetime of the process instead.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=134217728",
+    )
+
+    def __init__(self, db_name: str, readers: int = 4):
+        self.db_name = db_name
+        self.reader_count = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._readers: Optional[asyncio.Queue] = None
+        self._all_readers: List[aiosqlite.Connection] = []
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_name)
+        conn.row_factory = aiosqlite.Row
+        for pragma in self.PRAGMAS:
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute("PRAGMA query_only=1")
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self.is_open:
+                return
+            # The writer is opened first so WAL mode is set before readers attach
+            self._writer = await self._connect()
+            self._readers = asyncio.Queue()
+            for _ in range(self.reader_count):
+                conn = await self._connect(read_only=True)
+                self._all_readers.append(conn)
+                self._readers.put_nowait(conn)
+            logger.info(f"DB pool opened: {self.db_name} (1 writer, {self.reader_count} readers)")
+
+    async def close(self):
+        async with self._open_lock:
+            if not self.is_open:
+                return
+            async with self._write_lock:
+                for conn in self._all_readers:
+                    await conn.close()
+                self._all_readers = []
+                self._readers = None
+                await self._writer.close()
+                self._writer = None
+            logger.info("DB pool closed")
+
+    @asynccontextmanager
+    async def read(self):
+        if not self.is_open:
+            await self.open()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        """Serialized write transaction: commits on success, rolls back on error."""
+        if not self.is_open:
+            await self.open()
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+# Schema Migrations
+async def _migrate_initial_schema(db: aiosqlite.Connection):
+    # Users table
+    await db.execute('''CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_id INTEGER UNIQUE,
+        username TEXT,
+        full_name TEXT,
+        is_premium INTEGER DEFAULT 0,
+        premium_until TEXT,
+        created TEXT,
+        balance INTEGER DEFAULT 0,
+        content_count INTEGER DEFAULT 0
+    )''')
+
+    # Payments table
+    await db.execute('''CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_id INTEGER,
+        amount INTEGER,
+        card_number TEXT,
+        card_holder TEXT,
+        status TEXT DEFAULT 'pending',
+        payment_id TEXT UNIQUE,
+        created TEXT,
+        approved TEXT,
+        admin_note TEXT
+    )''')
+
+    # Generated content table
+    await db.execute('''CREATE TABLE IF NOT EXISTS generated_content (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_id INTEGER,
+        content_type TEXT,
+        topic TEXT,
+        content TEXT,
+        created TEXT,
+        quality TEXT DEFAULT 'standard'
+    )''')
+
+
+async def _column_exists(db: aiosqlite.Connection, table: str, column: str) -> bool:
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    return any(row['name'] == column for row in await cursor.fetchall())
+
+
+async def _migrate_generation_cache_key(db: aiosqlite.Connection):
+    # Databases from before versioned migrations may already have the column
+    if not await _column_exists(db, 'generated_content', 'cache_key'):
+        await db.execute("ALTER TABLE generated_content ADD COLUMN cache_key TEXT")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_generated_content_cache_key ON generated_content (cache_key)")
+
+
+async def _migrate_query_indexes(db: aiosqlite.Connection):
+    # get_pending_payments: WHERE status=? (in insertion order)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status, id)")
+    # get_user_payments: WHERE tg_id=? ORDER BY created DESC
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_tg_id_created ON payments (tg_id, created)")
+    # per-user content history
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_generated_content_tg_id_created ON generated_content (tg_id, created)")
+
+
+async def _migrate_stats_counters(db: aiosqlite.Connection):
+    """Summary table kept current by triggers, so get_stats never scans."""
+    await db.execute('''CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )''')
+    await db.execute('''INSERT OR REPLACE INTO stats_counters (name, value) VALUES
+        ('users', (SELECT COUNT(*) FROM users)),
+        ('content', (SELECT COUNT(*) FROM generated_content)),
+        ('pending_payments', (SELECT COUNT(*) FROM payments WHERE status='pending'))''')
+
+    await db.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'users';
+    END''')
+    await db.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'users';
+    END''')
+    await db.execute('''CREATE TRIGGER IF NOT EXISTS trg_content_insert AFTER INSERT ON generated_content BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'content';
+    END''')
+    await db.execute('''CREATE TRIGGER IF NOT EXISTS trg_content_delete AFTER DELETE ON generated_content BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'content';
+    END''')
+    await db.execute('''CREATE TRIGGER IF NOT EXISTS trg_payments_insert AFTER INSERT ON payments
+        WHEN NEW.status = 'pending' BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'pending_payments';
+    END''')
+    await db.execute('''CREATE TRIGGER IF NOT EXISTS trg_payments_status AFTER UPDATE OF status ON payments
+        WHEN (OLD.status = 'pending') != (NEW.status = 'pending') BEGIN
+        UPDATE stats_counters SET value = value + (CASE WHEN NEW.status = 'pending' THEN 1 ELSE -1 END)
+            WHERE name = 'pending_payments';
+    END''')
+    await db.execute('''CREATE TRIGGER IF NOT EXISTS trg_payments_delete AFTER DELETE ON payments
+        WHEN OLD.status = 'pending' BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'pending_payments';
+    END''')
+
+
+# Content Blob Storage
+def pack_content(content: str) -> Tuple[str, str, int, bytes]:
+    """Compress a generated body: (sha256 hash, codec, original size, compressed data)."""
+    raw = content.encode('utf-8')
+    digest = hashlib.sha256(raw).hexdigest()
+    if zstandard:
+        return digest, "zstd", len(raw), zstandard.ZstdCompressor(level=10).compress(raw)
+    return digest, "zlib", len(raw), zlib.compress(raw, 9)
+
+
+def unpack_content(codec: str, data: bytes) -> str:
+    if codec == "zstd":
+        if not zstandard:
+            raise RuntimeError("zstandard is required to read zstd-compressed content")
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    return zlib.decompress(data).decode('utf-8')
+
+
+async def _migrate_content_blobs(db: aiosqlite.Connection):
+    """Move generated bodies into compressed, hash-deduplicated blobs; rows keep only metadata.
+
+    The old bodies are set to NULL, but SQLite keeps the freed pages in the file:
+    it only shrinks after a one-off VACUUM (see README).
+    """
+    await db.execute('''CREATE TABLE IF NOT EXISTS content_blobs (
+        hash TEXT PRIMARY KEY,
+        codec TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        data BLOB NOT NULL
+    )''')
+    if not await _column_exists(db, 'generated_content', 'content_hash'):
+        await db.execute("ALTER TABLE generated_content ADD COLUMN content_hash TEXT")
+
+    while True:
+        cursor = await db.execute('''SELECT id, content FROM generated_content
+            WHERE content IS NOT NULL LIMIT 1000''')
+        rows = await cursor.fetchall()
+        if not rows:
+            break
+        packed = [(row['id'], pack_content(row['content'])) for row in rows]
+        await db.executemany("INSERT OR IGNORE INTO content_blobs (hash, codec, size, data) VALUES (?, ?, ?, ?)",
+                             [blob for _, blob in packed])
+        await db.executemany("UPDATE generated_content SET content_hash=?, content=NULL WHERE id=?",
+                             [(blob[0], row_id) for row_id, blob in packed])
+
+
+async def _migrate_fsm_states(db: aiosqlite.Connection):
+    await db.execute('''CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated REAL NOT NULL
+    )''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated)")
+
+
+async def _migrate_generation_jobs(db: aiosqlite.Connection):
+    await db.execute('''CREATE TABLE IF NOT EXISTS generation_jobs (
+        id TEXT PRIMARY KEY,
+        tg_id INTEGER NOT NULL,
+        content_type TEXT NOT NULL,
+        topic TEXT,
+        param TEXT,
+        notify INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'queued',
+        cached INTEGER NOT NULL DEFAULT 0,
+        content_hash TEXT,
+        error TEXT,
+        created REAL NOT NULL,
+        updated REAL NOT NULL
+    )''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_generation_jobs_status_created ON generation_jobs(status, created)")
+
+
+async def _migrate_outbox(db: aiosqlite.Connection):
+    await db.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        created_by INTEGER,
+        total INTEGER NOT NULL DEFAULT 0,
+        created REAL NOT NULL
+    )''')
+    await db.execute('''CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        broadcast_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        not_before REAL NOT NULL DEFAULT 0,
+        updated REAL NOT NULL
+    )''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status_id ON outbox(status, id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_broadcast_status ON outbox(broadcast_id, status)")
+
+
+async def _migrate_premium_expiry(db: aiosqlite.Connection):
+    # premium_until stays for display; the sweeper works on a sortable epoch copy
+    if not await _column_exists(db, 'users', 'premium_expires'):
+        await db.execute("ALTER TABLE users ADD COLUMN premium_expires REAL")
+    if not await _column_exists(db, 'users', 'premium_reminded'):
+        await db.execute("ALTER TABLE users ADD COLUMN premium_reminded INTEGER NOT NULL DEFAULT 0")
+    cursor = await db.execute("SELECT id, premium_until FROM users WHERE premium_until IS NOT NULL")
+    await db.executemany("UPDATE users SET premium_expires=? WHERE id=?",
+                         [(datetime.fromisoformat(until).timestamp(), row_id)
+                          for row_id, until in await cursor.fetchall()])
+    await db.execute('''CREATE INDEX IF NOT EXISTS idx_users_premium_expires
+        ON users (premium_expires) WHERE is_premium=1''')
+
+
+async def _migrate_generation_usage(db: aiosqlite.Connection):
+    await db.execute('''CREATE TABLE IF NOT EXISTS generation_usage (
+        day TEXT NOT NULL,
+        tg_id INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (day, tg_id)
+    ) WITHOUT ROWID''')
+
+
+async def _migrate_service_leases(db: aiosqlite.Connection):
+    await db.execute('''CREATE TABLE IF NOT EXISTS service_leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires REAL NOT NULL
+    ) WITHOUT ROWID''')
+
+
+# (version, description, migration). Append new versions; never edit applied ones.
+SCHEMA_MIGRATIONS = [
+    (1, "initial schema", _migrate_initial_schema),
+    (2, "generated_content.cache_key", _migrate_generation_cache_key),
+    (3, "indexes for payments and generated_content", _migrate_query_indexes),
+    (4, "stats counters maintained by triggers", _migrate_stats_counters),
+    (5, "compressed content blobs", _migrate_content_blobs),
+    (6, "persistent FSM storage", _migrate_fsm_states),
+    (7, "generation jobs", _migrate_generation_jobs),
+    (8, "outbox and broadcasts", _migrate_outbox),
+    (9, "sortable premium expiry", _migrate_premium_expiry),
+    (10, "daily generation usage", _migrate_generation_usage),
+    (11, "service leases", _migrate_service_leases),
+]
+
+# User Cache
+class UserCache:
+    """LRU + TTL cache of users rows by tg_id, invalidated by the Database mutators.
+
+    Unknown users are cached too, so repeated lookups of a missing id stay off
+    the disk until create_or_update_user runs for it.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        # Reads in progress, and those a write landed in the middle of
+        self._loading: Dict[int, int] = {}
+        self._stale: set = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tg_id: int) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        entry = self._entries.get(tg_id)
+        if entry is not None:
+            user, expires = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(tg_id)
+                self.hits += 1
+                return True, user
+            del self._entries[tg_id]
+        self.misses += 1
+        return False, None
+
+    def begin_load(self, tg_id: int):
+        self._loading[tg_id] = self._loading.get(tg_id, 0) + 1
+
+    def finish_load(self, tg_id: int, user: Optional[Dict[str, Any]]):
+        # A row read while a write was in flight may already be outdated; don't keep it
+        if tg_id not in self._stale:
+            self._entries[tg_id] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(tg_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self._loading[tg_id] -= 1
+        if not self._loading[tg_id]:
+            del self._loading[tg_id]
+            self._stale.discard(tg_id)
+
+    def invalidate(self, tg_id: int):
+        self._entries.pop(tg_id, None)
+        if tg_id in self._loading:
+            self._stale.add(tg_id)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+# Premium Index
+class PremiumIndex:
+    """In-memory tg_id -> premium expiry (epoch seconds, None = no end) for active premium users.
+
+    Checked on every generation instead of reading and parsing the users row. The
+    Database mutators grant and revoke entries; the sweeper reloads the whole map
+    periodically so grants made by other workers show up too.
+    """
+
+    def __init__(self):
+        self._expires: Dict[int, Optional[float]] = {}
+        # Changes made while a reload query is running, re-applied on top of its result
+        self._changes: Optional[Dict[int, Optional[float]]] = None
+        self.loaded = False
+
+    def is_active(self, tg_id: int) -> bool:
+        if tg_id not in self._expires:
+            return False
+        expires = self._expires[tg_id]
+        return expires is None or expires > time.time()
+
+    def grant(self, tg_id: int, expires: Optional[float]):
+        self._expires[tg_id] = expires
+        if self._changes is not None:
+            self._changes[tg_id] = expires
+
+    def revoke(self, tg_ids):
+        for tg_id in tg_ids:
+            self._expires.pop(tg_id, None)
+            if self._changes is not None:
+                self._changes[tg_id] = 0.0
+
+    async def reload(self, fetch):
+        """Replace the map with `await fetch()` without losing grants made meanwhile."""
+        self._changes = {}
+        try:
+            expires = await fetch()
+            expires.update(self._changes)
+            self._expires = {tg_id: until for tg_id, until in expires.items() if until is None or until > 0}
+            self.loaded = True
+        finally:
+            self._changes = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"active": len(self._expires), "loaded": self.loaded}
+
 # Database Manager
+@timed_methods(DB_QUERY_SECONDS)
 class Database:
-    def __init__(self, db_name='talaba_bot.db'):
+    def __init__(self, db_name='talaba_bot.db', readers: int = 4, user_cache: Optional[UserCache] = None,
+                 premium_index: Optional[PremiumIndex] = None):
         self.db_name = db_name
+        self.pool = ConnectionPool(db_name, readers=readers)
+        self.user_cache = user_cache or UserCache()
+        self.premium_index = premium_index or PremiumIndex()
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_name) as db:
-            # Users table
-            await db.execute('''CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tg_id INTEGER UNIQUE,
-                username TEXT,
-                full_name TEXT,
-                is_premium INTEGER DEFAULT 0,
-                premium_until TEXT,
-                created TEXT,
-                balance INTEGER DEFAULT 0,
-                content_count INTEGER DEFAULT 0
-            )''')
-            
-            # Payments table
-            await db.execute('''CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tg_id INTEGER,
-                amount INTEGER,
-                card_number TEXT,
-                card_holder TEXT,
-                status TEXT DEFAULT 'pending',
-                payment_id TEXT UNIQUE,
-                created TEXT,
-                approved TEXT,
-                admin_note TEXT
-            )''')
-            
-            # Generated content table
-            await db.execute('''CREATE TABLE IF NOT EXISTS generated_content (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tg_id INTEGER,
-                content_type TEXT,
-                topic TEXT,
-                content TEXT,
-                created TEXT,
-                quality TEXT DEFAULT 'standard'
-            )''')
-            await db.commit()
-
-    async def get_user(self, tg_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,))
-            return await cursor.fetchone()
+        await self.pool.open()
+        await self.migrate()
+
+    async def schema_version(self) -> int:
+        async with self.pool.read() as db:
+            return (await (await db.execute("PRAGMA user_version")).fetchone())[0]
+
+    async def migrate(self, target: Optional[int] = None):
+        """Apply pending SCHEMA_MIGRATIONS in order, each in its own transaction."""
+        current = await self.schema_version()
+        for version, description, apply in SCHEMA_MIGRATIONS:
+            if version <= current or (target is not None and version > target):
+                continue
+            async with self.pool.write() as db:
+                # IMMEDIATE takes the write lock up front, so concurrently starting workers
+                # apply each version once
+                await db.execute("BEGIN IMMEDIATE")
+                cursor = await db.execute("PRAGMA user_version")
+                if (await cursor.fetchone())[0] >= version:
+                    continue
+                await apply(db)
+                await db.execute(f"PRAGMA user_version = {version}")
+            logger.info(f"DB migrated to v{version}: {description}")
+
+    async def close(self):
+        await self.pool.close()
+
+    async def get_user(self, tg_id: int) -> Optional[Dict[str, Any]]:
+        found, user = self.user_cache.get(tg_id)
+        if found:
+            return user
+        self.user_cache.begin_load(tg_id)
+        user = None
+        try:
+            async with self.pool.read() as db:
+                cursor = await db.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,))
+                row = await cursor.fetchone()
+            user = dict(row) if row else None
+        finally:
+            self.user_cache.finish_load(tg_id, user)
+        return user
 
     async def create_or_update_user(self, tg_id: int, username: str, full_name: str):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute('''INSERT OR REPLACE INTO users (tg_id, username, full_name, created)
-                VALUES (?, ?, ?, COALESCE((SELECT created FROM users WHERE tg_id=?), ?))''',
-                (tg_id, username, full_name, tg_id, datetime.now().isoformat()))
-            await db.commit()
+        async with self.pool.write() as db:
+            # Upsert: REPLACE would delete the row, resetting premium, balance and counters
+            await db.execute('''INSERT INTO users (tg_id, username, full_name, created) VALUES (?, ?, ?, ?)
+                ON CONFLICT(tg_id) DO UPDATE SET username=excluded.username, full_name=excluded.full_name''',
+                (tg_id, username, full_name, datetime.now().isoformat()))
+        self.user_cache.invalidate(tg_id)
 
     async def update_user_balance(self, tg_id: int, amount: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.write() as db:
             await db.execute("UPDATE users SET balance = balance + ? WHERE tg_id=?", (amount, tg_id))
-            await db.commit()
+        self.user_cache.invalidate(tg_id)
 
     async def set_premium(self, tg_id: int, days: int = 30):
-        premium_until = (datetime.now() + timedelta(days=days)).isoformat()
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("UPDATE users SET is_premium=1, premium_until=? WHERE tg_id=?", (premium_until, tg_id))
-            await db.commit()
+        premium_until = datetime.now() + timedelta(days=days)
+        async with self.pool.write() as db:
+            await db.execute('''UPDATE users SET is_premium=1, premium_until=?, premium_expires=?, premium_reminded=0
+                WHERE tg_id=?''', (premium_until.isoformat(), premium_until.timestamp(), tg_id))
+        self.user_cache.invalidate(tg_id)
+        self.premium_index.grant(tg_id, premium_until.timestamp())
 
     async def increment_content_count(self, tg_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.write() as db:
             await db.execute("UPDATE users SET content_count = content_count + 1 WHERE tg_id=?", (tg_id,))
-            await db.commit()
+        self.user_cache.invalidate(tg_id)
 
     async def create_payment(self, tg_id: int, amount: int, card_number: str, card_holder: str, payment_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.write() as db:
             await db.execute('''INSERT INTO payments (tg_id, amount, card_number, card_holder, payment_id, created)
                 VALUES (?, ?, ?, ?, ?, ?)''',
                 (tg_id, amount, card_number, card_holder, payment_id, datetime.now().isoformat()))
-            await db.commit()
+
+    async def set_payment_note(self, payment_id: str, note: str):
+        async with self.pool.write() as db:
+            await db.execute("UPDATE payments SET admin_note=? WHERE payment_id=?", (note, payment_id))
 
     async def get_pending_payments(self):
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.read() as db:
             cursor = await db.execute("SELECT * FROM payments WHERE status='pending'")
             return await cursor.fetchall()
 
+    async def get_pending_payments_page(self, after_id: int = 0, limit: int = 10):
+        """Keyset page: pending payments with id > after_id, oldest first."""
+        async with self.pool.read() as db:
+            cursor = await db.execute("SELECT * FROM payments WHERE status='pending' AND id > ? ORDER BY id LIMIT ?",
+                                      (after_id, limit))
+            return await cursor.fetchall()
+
+    async def get_pending_payments_range(self, first_id: int, last_id: int):
+        async with self.pool.read() as db:
+            cursor = await db.execute('''SELECT * FROM payments
+                WHERE status='pending' AND id BETWEEN ? AND ? ORDER BY id''', (first_id, last_id))
+            return await cursor.fetchall()
+
+    async def review_payments(self, status: str, payment_ids: Optional[List[str]] = None,
+                              id_range: Optional[Tuple[int, int]] = None,
+                              premium_days: int = 30) -> List[Dict[str, Any]]:
+        """Move still-pending payments to `status` in one transaction; approvals also grant premium.
+
+        Select payments by payment_ids or an inclusive (first, last) row id range. Only
+        the payments actually changed are returned, so a repeated click notifies no one.
+        """
+        if payment_ids is not None:
+            if not payment_ids:
+                return []
+            where, params = f"payment_id IN ({','.join('?' * len(payment_ids))})", list(payment_ids)
+        else:
+            where, params = "id BETWEEN ? AND ?", list(id_range)
+        now = datetime.now()
+        async with self.pool.write() as db:
+            cursor = await db.execute(f'''UPDATE payments SET status=?, approved=?
+                WHERE status='pending' AND {where} RETURNING *''', [status, now.isoformat(), *params])
+            changed = [dict(row) for row in await cursor.fetchall()]
+            if status == 'approved' and changed:
+                premium_until = now + timedelta(days=premium_days)
+                await db.executemany('''UPDATE users SET is_premium=1, premium_until=?, premium_expires=?,
+                    premium_reminded=0 WHERE tg_id=?''',
+                    [(premium_until.isoformat(), premium_until.timestamp(), p['tg_id']) for p in changed])
+        for p in changed:
+            self.user_cache.invalidate(p['tg_id'])
+            if status == 'approved':
+                self.premium_index.grant(p['tg_id'], premium_until.timestamp())
+        return changed
+
+    async def add_generation_usage(self, usage: List[Tuple[str, int, int]]):
+        """Add (day, tg_id, count) deltas; several workers may add to the same row."""
+        async with self.pool.write() as db:
+            await db.executemany('''INSERT INTO generation_usage (day, tg_id, count) VALUES (?, ?, ?)
+                ON CONFLICT (day, tg_id) DO UPDATE SET count = count + excluded.count''', usage)
+
+    async def get_generation_usage(self, day: str) -> Dict[int, int]:
+        async with self.pool.read() as db:
+            cursor = await db.execute("SELECT tg_id, count FROM generation_usage WHERE day=?", (day,))
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+    async def prune_generation_usage(self, before_day: str):
+        async with self.pool.write() as db:
+            await db.execute("DELETE FROM generation_usage WHERE day < ?", (before_day,))
+
+    async def get_premium_expiries(self) -> Dict[int, Optional[float]]:
+        async with self.pool.read() as db:
+            cursor = await db.execute('''SELECT tg_id, premium_expires FROM users
+                WHERE is_premium=1 AND (premium_expires IS NULL OR premium_expires > ?)''', (time.time(),))
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+    async def expire_premium(self, now: float, limit: int, notice: str) -> List[int]:
+        """Clear premium for up to `limit` users whose expiry passed, soonest first.
+
+        Their expiry notices go into the outbox in the same transaction.
+        """
+        async with self.pool.write() as db:
+            cursor = await db.execute('''UPDATE users SET is_premium=0 WHERE id IN (
+                SELECT id FROM users WHERE is_premium=1 AND premium_expires <= ?
+                ORDER BY premium_expires LIMIT ?) RETURNING tg_id''', (now, limit))
+            expired = [row[0] for row in await cursor.fetchall()]
+            await db.executemany("INSERT INTO outbox (chat_id, text, updated) VALUES (?, ?, ?)",
+                                 [(tg_id, notice, now) for tg_id in expired])
+        for tg_id in expired:
+            self.user_cache.invalidate(tg_id)
+        self.premium_index.revoke(expired)
+        return expired
+
+    async def queue_premium_reminders(self, now: float, before: float, limit: int, reminder: str) -> int:
+        """Queue one reminder each for up to `limit` premium users expiring by `before`.
+
+        `reminder` is formatted with the expiry `date`.
+        """
+        async with self.pool.write() as db:
+            cursor = await db.execute('''UPDATE users SET premium_reminded=1 WHERE id IN (
+                SELECT id FROM users WHERE is_premium=1 AND premium_expires > ? AND premium_expires <= ?
+                AND premium_reminded=0 ORDER BY premium_expires LIMIT ?) RETURNING tg_id, premium_expires''',
+                (now, before, limit))
+            rows = await cursor.fetchall()
+            await db.executemany("INSERT INTO outbox (chat_id, text, updated) VALUES (?, ?, ?)", [
+                (tg_id, reminder.format(date=datetime.fromtimestamp(expires).strftime("%d.%m.%Y %H:%M")), now)
+                for tg_id, expires in rows])
+        return len(rows)
+
     async def get_user_payments(self, tg_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.read() as db:
             cursor = await db.execute("SELECT * FROM payments WHERE tg_id=? ORDER BY created DESC", (tg_id,))
             return await cursor.fetchall()
             
     async def get_payment(self, payment_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.read() as db:
             cursor = await db.execute("SELECT * FROM payments WHERE payment_id=?", (payment_id,))
             return await cursor.fetchone()
 
     async def update_payment_status(self, payment_id: str, status: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.write() as db:
             await db.execute("UPDATE payments SET status=?, approved=? WHERE payment_id=?", 
                              (status, datetime.now().isoformat(), payment_id))
-            await db.commit()
-
-    async def save_content(self, tg_id: int, content_type: str, topic: str, content: str):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute('''INSERT INTO generated_content (tg_id, content_type, topic, content, created)
-                VALUES (?, ?, ?, ?, ?)''',
-                (tg_id, content_type, topic, content, datetime.now().isoformat()))
-            await db.commit()
+
+    async def save_content(self, tg_id: int, content_type: str, topic: str, content: str,
+                           cache_key: Optional[str] = None):
+        await self.apply_content_batch([(tg_id, content_type, topic, content, datetime.now().isoformat(), cache_key)], {})
+
+    async def get_cached_content(self, cache_key: str, not_before: str) -> Optional[Tuple[str, str]]:
+        """(content, created) of the newest generation for cache_key, decompressed on hit only."""
+        async with self.pool.read() as db:
+            cursor = await db.execute('''SELECT g.created, b.codec, b.data FROM generated_content g
+                JOIN content_blobs b ON b.hash = g.content_hash
+                WHERE g.cache_key=? AND g.created>=? ORDER BY g.id DESC LIMIT 1''', (cache_key, not_before))
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        return unpack_content(row['codec'], row['data']), row['created']
+
+    async def get_content_body(self, content_hash: str) -> Optional[str]:
+        async with self.pool.read() as db:
+            cursor = await db.execute("SELECT codec, data FROM content_blobs WHERE hash=?", (content_hash,))
+            row = await cursor.fetchone()
+        return unpack_content(row['codec'], row['data']) if row else None
+
+    async def apply_content_batch(self, contents: List[tuple], increments: Dict[int, int]):
+        """Insert generated_content rows and bump content_count in a single transaction.
+
+        Each item is (tg_id, content_type, topic, content, created, cache_key); bodies
+        are compressed off the event loop and stored once per distinct hash.
+        """
+        packed = await asyncio.to_thread(lambda: [pack_content(item[3]) for item in contents])
+        async with self.pool.write() as db:
+            if contents:
+                await db.executemany("INSERT OR IGNORE INTO content_blobs (hash, codec, size, data) VALUES (?, ?, ?, ?)",
+                                     packed)
+                await db.executemany('''INSERT INTO generated_content (tg_id, content_type, topic, content_hash, created, cache_key)
+                    VALUES (?, ?, ?, ?, ?, ?)''',
+                    [(tg_id, content_type, topic, blob[0], created, cache_key)
+                     for (tg_id, content_type, topic, _, created, cache_key), blob in zip(contents, packed)])
+            if increments:
+                await db.executemany("UPDATE users SET content_count = content_count + ? WHERE tg_id=?",
+                                     [(count, tg_id) for tg_id, count in increments.items()])
+        for tg_id in increments:
+            self.user_cache.invalidate(tg_id)
             
+    async def create_job(self, job_id: str, tg_id: int, content_type: str, topic: str, param: str,
+                         notify: bool) -> float:
+        created = time.time()
+        async with self.pool.write() as db:
+            await db.execute('''INSERT INTO generation_jobs
+                (id, tg_id, content_type, topic, param, notify, status, created, updated)
+                VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)''',
+                (job_id, tg_id, content_type, topic, param, int(notify), created, created))
+        return created
+
+    async def claim_job(self, lease_before: float) -> Optional[Dict[str, Any]]:
+        """Atomically take the oldest queued job, or a running one whose lease expired."""
+        async with self.pool.write() as db:
+            cursor = await db.execute('''UPDATE generation_jobs SET status='running', updated=?
+                WHERE id = (SELECT id FROM generation_jobs
+                    WHERE status='queued' OR (status='running' AND updated < ?)
+                    ORDER BY created LIMIT 1)
+                RETURNING *''', (time.time(), lease_before))
+            row = await cursor.fetchone()
+            return dict(row) if row else None
+
+    async def finish_job(self, job_id: str, status: str, content: Optional[str] = None,
+                         error: Optional[str] = None, cached: bool = False):
+        packed = await asyncio.to_thread(pack_content, content) if content is not None else None
+        async with self.pool.write() as db:
+            if packed:
+                await db.execute("INSERT OR IGNORE INTO content_blobs (hash, codec, size, data) VALUES (?, ?, ?, ?)",
+                                 packed)
+            await db.execute('''UPDATE generation_jobs SET status=?, content_hash=?, error=?, cached=?, updated=?
+                WHERE id=?''', (status, packed[0] if packed else None, error, int(cached), time.time(), job_id))
+
+    async def requeue_jobs(self, job_ids: List[str]):
+        async with self.pool.write() as db:
+            await db.executemany("UPDATE generation_jobs SET status='queued' WHERE id=? AND status='running'",
+                                 [(job_id,) for job_id in job_ids])
+
+    async def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Job row plus its queue position (while queued) and result body (once done)."""
+        async with self.pool.read() as db:
+            cursor = await db.execute('''SELECT j.*, b.codec, b.data FROM generation_jobs j
+                LEFT JOIN content_blobs b ON b.hash = j.content_hash WHERE j.id=?''', (job_id,))
+            row = await cursor.fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            if job['status'] == 'queued':
+                cursor = await db.execute('''SELECT COUNT(*) FROM generation_jobs
+                    WHERE status='queued' AND created < ?''', (job['created'],))
+                job['position'] = (await cursor.fetchone())[0] + 1
+        codec, data = job.pop('codec'), job.pop('data')
+        job['content'] = unpack_content(codec, data) if data is not None else None
+        return job
+
+    async def enqueue_messages(self, messages: List[Tuple[int, str]]):
+        now = time.time()
+        async with self.pool.write() as db:
+            await db.executemany("INSERT INTO outbox (chat_id, text, updated) VALUES (?, ?, ?)",
+                                 [(chat_id, text, now) for chat_id, text in messages])
+
+    async def create_broadcast(self, text: str, created_by: int) -> Tuple[int, int]:
+        """Queue `text` for every user in one statement; returns (broadcast_id, recipients)."""
+        now = time.time()
+        async with self.pool.write() as db:
+            cursor = await db.execute("INSERT INTO broadcasts (text, created_by, created) VALUES (?, ?, ?)",
+                                      (text, created_by, now))
+            broadcast_id = cursor.lastrowid
+            cursor = await db.execute('''INSERT INTO outbox (chat_id, text, broadcast_id, updated)
+                SELECT tg_id, ?, ?, ? FROM users ORDER BY id''', (text, broadcast_id, now))
+            total = cursor.rowcount
+            await db.execute("UPDATE broadcasts SET total=? WHERE id=?", (total, broadcast_id))
+        return broadcast_id, total
+
+    async def get_broadcast_progress(self, broadcast_id: int) -> Dict[str, int]:
+        async with self.pool.read() as db:
+            cursor = await db.execute('''SELECT status, COUNT(*) FROM outbox WHERE broadcast_id=?
+                GROUP BY status''', (broadcast_id,))
+            counts = {row[0]: row[1] for row in await cursor.fetchall()}
+            cursor = await db.execute("SELECT total FROM broadcasts WHERE id=?", (broadcast_id,))
+            row = await cursor.fetchone()
+        return {
+            "total": row['total'] if row else 0,
+            "sent": counts.get('sent', 0),
+            "failed": counts.get('failed', 0),
+            "pending": counts.get('pending', 0) + counts.get('sending', 0)
+        }
+
+    async def has_due_outbox(self, lease_before: float) -> bool:
+        async with self.pool.read() as db:
+            cursor = await db.execute('''SELECT EXISTS(
+                SELECT 1 FROM outbox WHERE status='pending' AND not_before <= ?
+                UNION ALL SELECT 1 FROM outbox WHERE status='sending' AND updated < ?)''',
+                (time.time(), lease_before))
+            return bool((await cursor.fetchone())[0])
+
+    async def claim_outbox(self, limit: int, lease_before: float) -> List[Dict[str, Any]]:
+        """Take up to `limit` due messages (or ones whose sender's lease expired), oldest first."""
+        now = time.time()
+        async with self.pool.write() as db:
+            cursor = await db.execute('''UPDATE outbox SET status='sending', updated=?
+                WHERE id IN (SELECT id FROM outbox
+                    WHERE (status='pending' AND not_before <= ?) OR (status='sending' AND updated < ?)
+                    ORDER BY id LIMIT ?)
+                RETURNING id, chat_id, text, attempts''', (now, now, lease_before, limit))
+            rows = [dict(row) for row in await cursor.fetchall()]
+        return sorted(rows, key=lambda m: m['id'])
+
+    async def finish_outbox(self, results: List[tuple]):
+        """Apply (status, attempts, error, not_before, id) results of sent or given-up messages."""
+        async with self.pool.write() as db:
+            await db.executemany('''UPDATE outbox SET status=?, attempts=?, error=?, not_before=?, updated=?
+                WHERE id=?''', [(status, attempts, error, not_before, time.time(), message_id)
+                                for status, attempts, error, not_before, message_id in results])
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Take or renew the named lease for `owner`; False while another owner's lease is live."""
+        now = time.time()
+        async with self.pool.write() as db:
+            cursor = await db.execute('''INSERT INTO service_leases (name, owner, expires) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires=excluded.expires
+                WHERE service_leases.owner=excluded.owner OR service_leases.expires < ?''',
+                (name, owner, now + ttl, now))
+            return cursor.rowcount > 0
+
+    async def release_lease(self, name: str, owner: str):
+        async with self.pool.write() as db:
+            await db.execute("DELETE FROM service_leases WHERE name=? AND owner=?", (name, owner))
+
+    async def prune_outbox(self, before: float) -> int:
+        async with self.pool.write() as db:
+            cursor = await db.execute("DELETE FROM outbox WHERE status IN ('sent', 'failed') AND updated < ?",
+                                      (before,))
+            return cursor.rowcount
+
+    async def get_fsm_record(self, key: str, not_before: float) -> Optional[Tuple[Optional[str], str, float]]:
+        async with self.pool.read() as db:
+            cursor = await db.execute("SELECT state, data, updated FROM fsm_states WHERE key=? AND updated >= ?",
+                                      (key, not_before))
+            row = await cursor.fetchone()
+            return (row['state'], row['data'], row['updated']) if row else None
+
+    async def apply_fsm_batch(self, upserts: List[tuple], deletes: List[str]):
+        """Persist (key, state, data, updated) rows and drop cleared keys in one transaction."""
+        async with self.pool.write() as db:
+            if upserts:
+                await db.executemany('''INSERT INTO fsm_states (key, state, data, updated) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data,
+                        updated=excluded.updated''', upserts)
+            if deletes:
+                await db.executemany("DELETE FROM fsm_states WHERE key=?", [(key,) for key in deletes])
+
+    async def purge_fsm_records(self, before: float) -> int:
+        async with self.pool.write() as db:
+            cursor = await db.execute("DELETE FROM fsm_states WHERE updated < ?", (before,))
+            return cursor.rowcount
+
     async def get_stats(self):
-        async with aiosqlite.connect(self.db_name) as db:
-            users = await (await db.execute("SELECT COUNT(*) FROM users")).fetchone()
-            payments = await (await db.execute("SELECT COUNT(*) FROM payments WHERE status='pending'")).fetchone()
-            content = await (await db.execute("SELECT COUNT(*) FROM generated_content")).fetchone()
+        async with self.pool.read() as db:
+            cursor = await db.execute("SELECT name, value FROM stats_counters")
+            counters = {row['name']: row['value'] for row in await cursor.fetchall()}
             return {
-                "users": users[0],
-                "pending_payments": payments[0],
-                "content": content[0]
+                "users": counters.get('users', 0),
+                "pending_payments": counters.get('pending_payments', 0),
+                "content": counters.get('content', 0)
             }
 
-db = Database()
+db = Database(readers=DB_POOL_READERS, user_cache=UserCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS),
+              premium_index=PremiumIndex())
+
+def is_premium_active(user) -> bool:
+    if not user or not user['is_premium']:
+        return False
+    until = user['premium_expires']
+    return until is None or until > time.time()
+
+# Write-behind Queue
+class WriteBehindQueue:
+    """Buffers content saves and counter increments off the request path.
+
+    Pending writes are flushed in one transaction every `interval_ms`, or as soon
+    as `max_batch` items are waiting. `stop()` performs a final flush.
+    """
+
+    def __init__(self, database: Database, interval_ms: int = 50, max_batch: int = 100):
+        self.database = database
+        self.interval = interval_ms / 1000
+        self.max_batch = max_batch
+        self._contents: List[tuple] = []
+        self._increments: Dict[int, int] = {}
+        self._pending = 0
+        self._has_items = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.flushed_items = 0
+        self.failures = 0
+
+    @property
+    def depth(self) -> int:
+        return self._pending
+
+    def save_content(self, tg_id: int, content_type: str, topic: str, content: str,
+                     cache_key: Optional[str] = None):
+        self._contents.append((tg_id, content_type, topic, content, datetime.now().isoformat(), cache_key))
+        self._added(1)
+
+    def increment_content_count(self, tg_id: int):
+        self._increments[tg_id] = self._increments.get(tg_id, 0) + 1
+        self._added(1)
+
+    def _added(self, count: int):
+        self._pending += count
+        self._has_items.set()
+        if self._pending >= self.max_batch:
+            self._full.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            contents, increments, pending = self._contents, self._increments, self._pending
+            self._contents, self._increments, self._pending = [], {}, 0
+            try:
+                await self.database.apply_content_batch(contents, increments)
+            except Exception:
+                # Put the batch back in front of anything queued meanwhile and retry later
+                self.failures += 1
+                self._contents = contents + self._contents
+                for tg_id, count in increments.items():
+                    self._increments[tg_id] = self._increments.get(tg_id, 0) + count
+                self._added(pending)
+                raise
+            self.batches += 1
+            self.flushed_items += pending
+
+    async def _run(self):
+        while True:
+            await self._has_items.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._has_items.clear()
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind flush error: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Write-behind final flush failed, {self.depth} writes lost: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "depth": self.depth,
+            "batches": self.batches,
+            "flushed_items": self.flushed_items,
+            "failures": self.failures
+        }
+
+write_queue = WriteBehindQueue(db, interval_ms=WRITE_BEHIND_INTERVAL_MS, max_batch=WRITE_BEHIND_MAX_BATCH)
+
+# FSM Storage
+class SQLiteStorage(BaseStorage):
+    """aiogram FSM storage kept in the bot database's fsm_states table.
+
+    Writes land in an in-memory cache and are persisted in batches every
+    `flush_interval_ms`. Clean entries are re-read once older than `cache_seconds`,
+    so processes sharing the database see each other's changes within roughly the
+    flush interval plus the cache age. States untouched for `ttl_seconds` count as
+    abandoned and are swept.
+    """
+
+    def __init__(self, database: Database, ttl_seconds: float = 86400, cache_seconds: float = 5,
+                 flush_interval_ms: int = 200, max_entries: int = 10000):
+        self.database = database
+        self.ttl = ttl_seconds
+        self.cache_seconds = cache_seconds
+        self.interval = flush_interval_ms / 1000
+        self.max_entries = max_entries
+        # key -> [state, data, updated (wall clock), loaded (monotonic)]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._dirty: set = set()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._next_sweep = 0.0
+        self.hits = 0
+        self.loads = 0
+        self.flushes = 0
+        self.swept = 0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _entry(self, key: StorageKey) -> list:
+        skey = self._key(key)
+        entry = self._entries.get(skey)
+        if entry is not None and entry[2] >= time.time() - self.ttl and (
+                skey in self._dirty or time.monotonic() - entry[3] < self.cache_seconds):
+            self._entries.move_to_end(skey)
+            self.hits += 1
+            return entry
+        self.loads += 1
+        record = await self.database.get_fsm_record(skey, time.time() - self.ttl)
+        # A write that happened while we were reading wins over the stored row
+        if skey in self._dirty:
+            return self._entries[skey]
+        state, data, updated = record if record else (None, '{}', time.time())
+        entry = [state, json.loads(data), updated, time.monotonic()]
+        self._entries[skey] = entry
+        self._evict()
+        return entry
+
+    def _touch(self, key: StorageKey, entry: list):
+        entry[2] = time.time()
+        entry[3] = time.monotonic()
+        skey = self._key(key)
+        self._entries[skey] = entry
+        self._entries.move_to_end(skey)
+        self._dirty.add(skey)
+
+    def _evict(self):
+        # Dirty entries stay until they are flushed
+        while len(self._entries) > self.max_entries:
+            for skey in self._entries:
+                if skey not in self._dirty:
+                    del self._entries[skey]
+                    break
+            else:
+                return
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._touch(key, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        entry = await self._entry(key)
+        entry[1] = dict(data)
+        self._touch(key, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._entry(key))[1])
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            keys, self._dirty = self._dirty, set()
+            upserts, deletes = [], []
+            for skey in keys:
+                state, data, updated, _ = self._entries[skey]
+                if state is None and not data:
+                    deletes.append(skey)
+                else:
+                    upserts.append((skey, state, json.dumps(data, ensure_ascii=False), updated))
+            try:
+                await self.database.apply_fsm_batch(upserts, deletes)
+            except Exception:
+                self._dirty |= keys
+                raise
+            self.flushes += 1
+            self._evict()
+
+    async def sweep(self):
+        cutoff = time.time() - self.ttl
+        for skey in [k for k, e in self._entries.items() if e[2] < cutoff and k not in self._dirty]:
+            del self._entries[skey]
+        self.swept += await self.database.purge_fsm_records(cutoff)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+                if time.monotonic() >= self._next_sweep:
+                    self._next_sweep = time.monotonic() + min(self.ttl, 600)
+                    await self.sweep()
+            except Exception as e:
+                logger.error(f"FSM storage flush error: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"FSM storage final flush failed, {len(self._dirty)} states lost: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "loads": self.loads,
+            "flushes": self.flushes,
+            "swept": self.swept
+        }
+
+fsm_storage = SQLiteStorage(db, ttl_seconds=FSM_STATE_TTL_HOURS * 3600, cache_seconds=FSM_CACHE_SECONDS,
+                            flush_interval_ms=FSM_FLUSH_INTERVAL_MS)
+
+# Request Coalescing
+class SingleFlight:
+    """Shares one in-flight call between concurrent callers asking for the same key."""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.coalesced += 1
+        # Shielded so one caller disconnecting does not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark as retrieved even if every caller went away
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._inflight),
+            "calls": self.calls,
+            "coalesced": self.coalesced
+        }
+
+generation_flight = SingleFlight()
+
+# AI Call Scheduling
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class GenerationTicket:
+    PREMIUM = 0
+    FREE = 1
+
+    def __init__(self, priority: int, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.cancelled = False
+        self.released = False
+        self.started: Optional[float] = None
+
+    @property
+    def granted(self) -> bool:
+        return self.started is not None
+
+    def __lt__(self, other: "GenerationTicket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class GenerationScheduler:
+    """Bounded-concurrency gate for AI calls with premium users served first.
+
+    Each call waits for one of `concurrency` slots (premium tickets ahead of free
+    ones, FIFO within a class). Every upstream request made while holding a slot
+    also takes a token from its provider's bucket via `throttle()`.
+    """
+
+    def __init__(self, concurrency: int = 4, rate_per_minute: int = 60, burst: int = 10):
+        self.concurrency = max(1, concurrency)
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self._active = 0
+        self._waiting: List[GenerationTicket] = []
+        self._waiting_count = 0
+        self._seq = itertools.count()
+        self._buckets: Dict[str, TokenBucket] = {}
+        # Rolling average of how long a slot is held, used for wait estimates
+        self.avg_service_seconds = 20.0
+        self.completed = 0
+
+    def bucket(self, api_key: str) -> TokenBucket:
+        if api_key not in self._buckets:
+            self._buckets[api_key] = TokenBucket(self.rate_per_minute / 60, self.burst)
+        return self._buckets[api_key]
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def enqueue(self, premium: bool) -> GenerationTicket:
+        ticket = GenerationTicket(GenerationTicket.PREMIUM if premium else GenerationTicket.FREE, next(self._seq))
+        heapq.heappush(self._waiting, ticket)
+        self._waiting_count += 1
+        self._grant_next()
+        return ticket
+
+    def _grant_next(self):
+        while self._active < self.concurrency and self._waiting:
+            ticket = heapq.heappop(self._waiting)
+            if ticket.cancelled:
+                continue
+            self._waiting_count -= 1
+            self._active += 1
+            ticket.started = time.monotonic()
+            ticket.future.set_result(True)
+
+    async def wait(self, ticket: GenerationTicket, timeout: Optional[float] = None) -> bool:
+        """Wait until the ticket holds a slot. Returns False if `timeout` elapsed first."""
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout)
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.CancelledError:
+            self.release(ticket)
+            raise
+        return True
+
+    async def throttle(self, api_key: str):
+        await self.bucket(api_key).acquire()
+
+    def release(self, ticket: GenerationTicket):
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.granted:
+            self._active -= 1
+            elapsed = time.monotonic() - ticket.started
+            self.avg_service_seconds = 0.8 * self.avg_service_seconds + 0.2 * elapsed
+            self.completed += 1
+        else:
+            ticket.cancelled = True
+            self._waiting_count -= 1
+            ticket.future.cancel()
+        self._grant_next()
+
+    def position(self, ticket: GenerationTicket) -> int:
+        """1-based place in the queue, 0 once the ticket holds a slot."""
+        if ticket.granted:
+            return 0
+        return 1 + sum(1 for t in self._waiting if not t.cancelled and t < ticket)
+
+    def estimated_wait(self, position: int) -> float:
+        return round(position * self.avg_service_seconds / self.concurrency, 1)
+
+    def estimate(self, premium: bool) -> Dict[str, Any]:
+        """Where a request submitted right now would land."""
+        if self._active < self.concurrency and not self._waiting_count:
+            position = 0
+        else:
+            priority = GenerationTicket.PREMIUM if premium else GenerationTicket.FREE
+            position = 1 + sum(1 for t in self._waiting if not t.cancelled and t.priority <= priority)
+        return {"position": position, "estimated_wait": self.estimated_wait(position)}
+
+    @asynccontextmanager
+    async def slot(self, premium: bool):
+        ticket = self.enqueue(premium)
+        try:
+            await self.wait(ticket)
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    async def run(self, fn, premium: bool):
+        async with self.slot(premium):
+            return await fn()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self._active,
+            "waiting": self._waiting_count,
+            "concurrency": self.concurrency,
+            "completed": self.completed,
+            "avg_service_seconds": round(self.avg_service_seconds, 2)
+        }
+
+generation_scheduler = GenerationScheduler(
+    concurrency=per_worker(AI_MAX_CONCURRENCY),
+    rate_per_minute=per_worker(AI_RATE_PER_MINUTE),
+    burst=per_worker(AI_RATE_BURST)
+)
+
+# Bump whenever a generate_* prompt changes so stale generations are not served
+PROMPT_TEMPLATE_VERSION = 2
+AI_ERROR_PREFIX = "❌"
+
+# content_type -> (param name, default value)
+GENERATION_PARAMS = {
+    'referat': ('size', '10'),
+    'prezentatsiya': ('slides', '10'),
+    'insho': ('type', 'argumentativ'),
+    'test': ('count', '10'),
+}
+
+# Numeric params are clamped to these (min, max): each unit costs AI calls, not just quota
+GENERATION_PARAM_RANGES = {
+    'referat': (1, 20),
+    'prezentatsiya': (1, 15),
+    'test': (1, 50),
+}
+
+# Generation Cache
+class GenerationCache:
+    """Content-addressed cache of AI generations.
+
+    The in-memory LRU tier is bounded by entry count and total size; misses fall
+    back to the generated_content table, whose rows carry the same cache_key.
+    """
+
+    def __init__(self, database: Database, max_entries: int = 512, max_bytes: int = 32 * 1024 * 1024,
+                 ttl_seconds: int = 7 * 24 * 3600):
+        self.database = database
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(content_type: str, topic: str, param: str) -> str:
+        normalized_topic = " ".join((topic or "").split()).casefold()
+        normalized_param = " ".join(str(param).split()).casefold()
+        raw = json.dumps([PROMPT_TEMPLATE_VERSION, content_type, normalized_topic, normalized_param],
+                         ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            content, expires = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return content
+            self._evict(key)
+
+        not_before = (datetime.now() - timedelta(seconds=self.ttl)).isoformat()
+        row = await self.database.get_cached_content(key, not_before)
+        if row is None:
+            self.misses += 1
+            return None
+        self.db_hits += 1
+        content, created = row
+        age = (datetime.now() - datetime.fromisoformat(created)).total_seconds()
+        self._store(key, content, self.ttl - age)
+        return content
+
+    def put(self, key: str, content: str):
+        self._store(key, content, self.ttl)
+
+    def _store(self, key: str, content: str, ttl: float):
+        size = len(content.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (content, time.monotonic() + ttl)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key: str):
+        content, _ = self._entries.pop(key)
+        self._bytes -= len(content.encode('utf-8'))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses
+        }
+
+generation_cache = GenerationCache(
+    db,
+    max_entries=GENERATION_CACHE_SIZE,
+    max_bytes=GENERATION_CACHE_MAX_MB * 1024 * 1024,
+    ttl_seconds=GENERATION_CACHE_TTL_HOURS * 3600
+)
+
+# AI Providers
+class AIProviderError(Exception):
+    pass
+
+
+class AIProvider:
+    name = "base"
+
+    async def generate(self, prompt: str) -> str:
+        raise NotImplementedError
+
+    async def stream(self, prompt: str):
+        yield await self.generate(prompt)
+
+    async def close(self):
+        pass
+
+
+class GeminiProvider(AIProvider):
+    name = "gemini"
+
+    def __init__(self, gemini_model):
+        self.model = gemini_model
+
+    async def generate(self, prompt: str) -> str:
+        response = await self.model.generate_content_async(prompt)
+        return response.text
+
+    async def stream(self, prompt: str):
+        response = await self.model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+
+class OpenAICompatibleProvider(AIProvider):
+    """OpenAI, Groq, OpenRouter and Mistral all speak the chat completions API."""
+
+    def __init__(self, name: str, base_url: str, api_key: str, model_name: str, timeout: float = 120):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model_name = model_name
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    def _payload(self, prompt: str, stream: bool) -> Dict[str, Any]:
+        return {
+            "model": self.model_name,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": stream
+        }
+
+    async def generate(self, prompt: str) -> str:
+        async with self._get_session().post(f"{self.base_url}/chat/completions",
+                                            json=self._payload(prompt, False)) as response:
+            if response.status != 200:
+                raise AIProviderError(f"{self.name}: HTTP {response.status} {await response.text()}")
+            data = await response.json()
+            return data["choices"][0]["message"]["content"]
+
+    async def stream(self, prompt: str):
+        async with self._get_session().post(f"{self.base_url}/chat/completions",
+                                            json=self._payload(prompt, True)) as response:
+            if response.status != 200:
+                raise AIProviderError(f"{self.name}: HTTP {response.status} {await response.text()}")
+            async for raw in response.content:
+                line = raw.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                delta = json.loads(payload)["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+class CircuitBreaker:
+    """Stops routing to a provider after repeated failures, retrying after a cool-down."""
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        # A failed half-open trial re-opens the breaker immediately
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class ProviderStats:
+    """Rolling latency and outcome samples, limited to the last `window` calls and `max_age` seconds.
+
+    Aging samples out by time lets a provider that failed for a while compete
+    again once its failures are old, instead of staying ranked last.
+    """
+
+    def __init__(self, window: int = 50, max_age: float = 300):
+        self.max_age = max_age
+        self._latencies: deque = deque(maxlen=window)
+        self._outcomes: deque = deque(maxlen=window)
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.max_age
+        for samples in (self._latencies, self._outcomes):
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+
+    @property
+    def latencies(self) -> List[float]:
+        self._prune()
+        return [latency for _, latency in self._latencies]
+
+    @property
+    def outcomes(self) -> List[bool]:
+        self._prune()
+        return [ok for _, ok in self._outcomes]
+
+    def record(self, ok: bool, latency: Optional[float] = None):
+        now = time.monotonic()
+        self._outcomes.append((now, ok))
+        if ok and latency is not None:
+            self._latencies.append((now, latency))
+
+    def record_latency(self, latency: float):
+        """A lower bound on latency from a call that was cancelled before it finished."""
+        self._latencies.append((time.monotonic(), latency))
+
+    def clear(self):
+        self._latencies.clear()
+        self._outcomes.clear()
+
+    def percentile(self, q: float) -> Optional[float]:
+        latencies = self.latencies
+        if not latencies:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        outcomes = self.outcomes
+        if not outcomes:
+            return 0.0
+        return 1 - sum(outcomes) / len(outcomes)
+
+    def score(self) -> float:
+        # Untried providers score 0 so each gets sampled once before routing settles
+        p50 = self.percentile(0.5)
+        if p50 is None:
+            return float("inf") if self.outcomes else 0.0
+        return p50 * (1 + 10 * self.error_rate)
+
+
+class AIRouter:
+    """Routes each prompt to the healthiest, fastest provider.
+
+    Providers are ranked by rolling p50 latency penalized by error rate, skipping
+    those whose circuit breaker is open. A generation that has not finished after
+    the primary's p95 (or `hedge_delay`) is hedged to the next provider, and the
+    first success wins. Failures fall through to the next provider in rank.
+    """
+
+    def __init__(self, providers: List[AIProvider], throttle=None, hedge_delay: float = 20):
+        self.providers = providers
+        self.throttle = throttle
+        self.hedge_delay = hedge_delay
+        self.breakers = {p.name: CircuitBreaker() for p in providers}
+        self.stats = {p.name: ProviderStats() for p in providers}
+        self.hedges = 0
+        # opened_at of the breaker opening each provider's stats were last reset for
+        self._probed: Dict[str, float] = {}
+
+    def ranked(self) -> List[AIProvider]:
+        order = {p.name: i for i, p in enumerate(self.providers)}
+        available = []
+        for provider in self.providers:
+            breaker = self.breakers[provider.name]
+            if not breaker.allow():
+                continue
+            if breaker.state == "half_open" and self._probed.get(provider.name) != breaker.opened_at:
+                # Forget the failures that opened the breaker so the provider scores as untried
+                # and the next request actually probes it
+                self.stats[provider.name].clear()
+                self._probed[provider.name] = breaker.opened_at
+            available.append(provider)
+        return sorted(available, key=lambda p: (self.stats[p.name].score(), order[p.name]))
+
+    def _hedge_after(self, provider: AIProvider) -> float:
+        p95 = self.stats[provider.name].percentile(0.95)
+        return p95 if p95 is not None else self.hedge_delay
+
+    def _record(self, provider: AIProvider, ok: bool, latency: Optional[float] = None):
+        self.stats[provider.name].record(ok, latency)
+        if ok:
+            self.breakers[provider.name].record_success()
+        else:
+            self.breakers[provider.name].record_failure()
+
+    async def _call(self, provider: AIProvider, prompt: str) -> str:
+        if self.throttle:
+            await self.throttle(provider.name)
+        start = time.monotonic()
+        content_type = ai_content_type.get()
+        try:
+            result = await provider.generate(prompt)
+        except asyncio.CancelledError:
+            # Lost a hedge race: its latency is at least this long
+            self.stats[provider.name].record_latency(time.monotonic() - start)
+            AI_PROVIDER_SECONDS.observe(time.monotonic() - start, provider.name, content_type, "cancelled")
+            raise
+        except Exception as e:
+            self._record(provider, False)
+            AI_PROVIDER_SECONDS.observe(time.monotonic() - start, provider.name, content_type, "error")
+            raise AIProviderError(f"{provider.name}: {e}") from e
+        self._record(provider, True, time.monotonic() - start)
+        AI_PROVIDER_SECONDS.observe(time.monotonic() - start, provider.name, content_type, "ok")
+        AI_TOKENS.inc(estimate_tokens(prompt), content_type, "prompt")
+        AI_TOKENS.inc(estimate_tokens(result), content_type, "completion")
+        return result
+
+    async def generate(self, prompt: str) -> str:
+        candidates = self.ranked()
+        if not candidates:
+            raise AIProviderError("No AI provider available")
+
+        pending: Dict[asyncio.Task, AIProvider] = {}
+        errors = []
+        next_index = 0
+        hedged = False
+
+        def launch():
+            nonlocal next_index
+            provider = candidates[next_index]
+            next_index += 1
+            pending[asyncio.create_task(self._call(provider, prompt))] = provider
+
+        launch()
+        try:
+            while pending:
+                # Hedge at most once, and only while a single request is in flight
+                timeout = None
+                if not hedged and len(pending) == 1 and next_index < len(candidates):
+                    timeout = self._hedge_after(next(iter(pending.values())))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.hedges += 1
+                    launch()
+                    continue
+                for task in done:
+                    del pending[task]
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append(str(task.exception()))
+                if not pending and next_index < len(candidates):
+                    launch()
+            raise AIProviderError("; ".join(errors))
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, prompt: str):
+        """Stream from the best provider, failing over only before the first chunk."""
+        candidates = self.ranked()
+        if not candidates:
+            raise AIProviderError("No AI provider available")
+        errors = []
+        for provider in candidates:
+            if self.throttle:
+                await self.throttle(provider.name)
+            start = time.monotonic()
+            content_type = ai_content_type.get()
+            started = False
+            produced = 0
+            try:
+                async for chunk in provider.stream(prompt):
+                    started = True
+                    produced += len(chunk)
+                    yield chunk
+            except Exception as e:
+                self._record(provider, False)
+                AI_PROVIDER_SECONDS.observe(time.monotonic() - start, provider.name, content_type, "error")
+                if started:
+                    raise
+                errors.append(f"{provider.name}: {e}")
+                continue
+            self._record(provider, True, time.monotonic() - start)
+            AI_PROVIDER_SECONDS.observe(time.monotonic() - start, provider.name, content_type, "ok")
+            AI_TOKENS.inc(estimate_tokens(prompt), content_type, "prompt")
+            AI_TOKENS.inc((produced + 3) // 4, content_type, "completion")
+            return
+        raise AIProviderError("; ".join(errors))
+
+    async def close(self):
+        for provider in self.providers:
+            await provider.close()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            p.name: {
+                "state": self.breakers[p.name].state,
+                "p50": self.stats[p.name].percentile(0.5),
+                "error_rate": round(self.stats[p.name].error_rate, 3)
+            }
+            for p in self.providers
+        }
+
+
+def build_providers() -> List[AIProvider]:
+    available = {}
+    if model:
+        available["gemini"] = GeminiProvider(model)
+    for name, base_url, api_key, model_name in (
+        ("openai", "https://api.openai.com/v1", OPENAI_API_KEY, OPENAI_MODEL),
+        ("groq", "https://api.groq.com/openai/v1", GROQ_API_KEY, GROQ_MODEL),
+        ("openrouter", "https://openrouter.ai/api/v1", OPENROUTER_API_KEY, OPENROUTER_MODEL),
+        ("mistral", "https://api.mistral.ai/v1", MISTRAL_API_KEY, MISTRAL_MODEL),
+    ):
+        if api_key:
+            available[name] = OpenAICompatibleProvider(name, base_url, api_key, model_name,
+                                                       timeout=AI_REQUEST_TIMEOUT_SECONDS)
+    return [available[name] for name in AI_PROVIDERS if name in available]
+
+ai_router = AIRouter(build_providers(), throttle=generation_scheduler.throttle, hedge_delay=AI_HEDGE_DELAY_SECONDS)
+
+async def fan_out_ordered(factories, limit: int):
+    """Run coroutine factories concurrently (at most `limit` at once), yielding results in order.
+
+    Tasks are created only as earlier results are taken, so a long list of factories
+    never has more than `limit` tasks alive.
+    """
+    factories = iter(factories)
+    pending: deque = deque()
+    try:
+        for factory in itertools.islice(factories, max(1, limit)):
+            pending.append(asyncio.create_task(factory()))
+        while pending:
+            result = await pending.popleft()
+            for factory in itertools.islice(factories, 1):
+                pending.append(asyncio.create_task(factory()))
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def to_int(value, default: int) -> int:
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return default
+
+
+QUESTION_HEADER_RE = re.compile(r'^#{2,4}\s*Savol\b.*$', re.MULTILINE)
+NON_WORD_RE = re.compile(r'\W+')
+
+def split_questions(text: str) -> List[str]:
+    """Split a batch produced by AIService.test_batch_prompt into question bodies (headers stripped)."""
+    parts = QUESTION_HEADER_RE.split(text)
+    return [part.strip() for part in parts[1:] if part.strip()]
+
+def question_fingerprint(body: str) -> str:
+    first_line = body.strip().split('\n', 1)[0]
+    return NON_WORD_RE.sub(' ', first_line.replace('*', '')).strip().casefold()
 
 # AI Service
 class AIService:
     @staticmethod
     async def generate_content(prompt: str) -> str:
-        if not model:
-            return "❌ AI Xizmati vaqtincha ishlamayapti (API Key topilmadi)."
+        if not ai_router.providers:
+            return f"{AI_ERROR_PREFIX} AI Xizmati vaqtincha ishlamayapti (API Key topilmadi)."
         try:
-            response = await model.generate_content_async(prompt)
-            return response.text
+            # One scheduler slot per upstream call, so fanned-out referats and tests stay
+            # within AI_MAX_CONCURRENCY like everything else
+            async with generation_scheduler.slot(ai_premium.get()):
+                return await ai_router.generate(prompt)
         except Exception as e:
             logger.error(f"AI Generation Error: {e}")
-            return "❌ Kechirasiz, kontent yaratishda xatolik yuz berdi. Iltimos keyinroq urinib ko'ring."
+            return f"{AI_ERROR_PREFIX} Kechirasiz, kontent yaratishda xatolik yuz berdi. Iltimos keyinroq urinib ko'ring."
+
+    @staticmethod
+    async def stream_content(prompt: str):
+        """Yield text chunks as the provider produces them. Errors propagate to the caller."""
+        if not ai_router.providers:
+            yield f"{AI_ERROR_PREFIX} AI Xizmati vaqtincha ishlamayapti (API Key topilmadi)."
+            return
+        async for chunk in ai_router.stream(prompt):
+            yield chunk
+
+    @staticmethod
+    def build_prompt(content_type: str, topic: str, param: str) -> str:
+        if content_type == 'referat':
+            return AIService.referat_prompt(topic, param)
+        if content_type == 'prezentatsiya':
+            return AIService.presentation_prompt(topic, param)
+        if content_type == 'insho':
+            return AIService.essay_prompt(topic, param)
+        if content_type == 'test':
+            return AIService.test_prompt(topic, param)
+        raise ValueError(f"Unknown content type: {content_type}")
+
+    @staticmethod
+    async def generate(content_type: str, topic: str, param: str) -> str:
+        token = ai_content_type.set(content_type)
+        start = time.perf_counter()
+        outcome = "cancelled"
+        try:
+            if content_type == 'referat':
+                content = await AIService.generate_referat(topic, param)
+            elif content_type == 'test':
+                content = await AIService.generate_test(topic, param)
+            else:
+                content = await AIService.generate_content(AIService.build_prompt(content_type, topic, param))
+            outcome = "error" if content.startswith(AI_ERROR_PREFIX) else "ok"
+            return content
+        finally:
+            AI_GENERATION_SECONDS.observe(time.perf_counter() - start, content_type, outcome)
+            ai_content_type.reset(token)
+
+    @staticmethod
+    async def stream(content_type: str, topic: str, param: str):
+        """Streaming counterpart of generate(); chunked referats are emitted section by section."""
+        # An async generator shares its consumer's context: here, the streaming response task
+        ai_content_type.set(content_type)
+        start = time.perf_counter()
+        outcome = "cancelled"
+        chunks = AIService.stream_chunks(content_type, topic, param)
+        try:
+            async for chunk in chunks:
+                yield chunk
+            outcome = "ok"
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            await chunks.aclose()
+            AI_GENERATION_SECONDS.observe(time.perf_counter() - start, content_type, outcome)
+
+    @staticmethod
+    def fans_out(content_type: str, param: str) -> bool:
+        """Whether a generation is split into several calls that each take their own scheduler slot."""
+        if content_type == 'referat':
+            return to_int(param, 10) >= CHUNKED_REFERAT_MIN_PAGES
+        return content_type == 'test' and to_int(param, 10) > TEST_BATCH_SIZE
+
+    @staticmethod
+    async def stream_chunks(content_type: str, topic: str, param: str):
+        if content_type == 'referat' and to_int(param, 10) >= CHUNKED_REFERAT_MIN_PAGES:
+            parts = AIService.referat_parts(topic, param)
+            try:
+                async for part in parts:
+                    if part.startswith(AI_ERROR_PREFIX):
+                        raise AIProviderError(part)
+                    yield part
+            finally:
+                await parts.aclose()
+            return
+        if content_type == 'test' and to_int(param, 10) > TEST_BATCH_SIZE:
+            content = await AIService.generate_test(topic, param)
+            if content.startswith(AI_ERROR_PREFIX):
+                raise AIProviderError(content)
+            yield content
+            return
+        async for chunk in AIService.stream_content(AIService.build_prompt(content_type, topic, param)):
+            yield chunk
 
     @staticmethod
     async def generate_referat(topic: str, size: str) -> str:
+        if to_int(size, 10) < CHUNKED_REFERAT_MIN_PAGES:
+            return await AIService.generate_content(AIService.referat_prompt(topic, size))
+        parts = []
+        stream = AIService.referat_parts(topic, size)
+        try:
+            async for part in stream:
+                if part.startswith(AI_ERROR_PREFIX):
+                    return part
+                parts.append(part)
+        finally:
+            await stream.aclose()
+        return "".join(parts)
+
+    @staticmethod
+    async def plan_referat(topic: str, pages: int) -> List[str]:
+        """Ask for a section outline, falling back to a fixed one if the reply is unusable."""
+        sections = max(4, min(12, pages // 2 + 2))
+        reply = await AIService.generate_content(AIService.outline_prompt(topic, pages, sections))
+        try:
+            outline = json.loads(reply[reply.index('['):reply.rindex(']') + 1])
+            if isinstance(outline, list) and 3 <= len(outline) <= 15 and all(isinstance(t, str) for t in outline):
+                return [title.strip() for title in outline]
+        except ValueError:
+            pass
+        body = [f"Asosiy qism: {i}-reja" for i in range(1, sections - 3)]
+        return ["Kirish"] + body + ["Tahliliy qism", "Xulosa", "Foydalanilgan adabiyotlar"]
+
+    @staticmethod
+    async def referat_parts(topic: str, size: str):
+        """Outline first, then every section in parallel; yields the title and sections in order."""
+        pages = to_int(size, 10)
+        outline = await AIService.plan_referat(topic, pages)
+        pages_per_section = max(1, round(pages / len(outline)))
+        factories = [
+            (lambda i=i: AIService.generate_content(AIService.section_prompt(topic, outline, i, pages_per_section)))
+            for i in range(len(outline))
+        ]
+        yield f"# {topic}\n\n"
+        sections = fan_out_ordered(factories, AI_FANOUT_CONCURRENCY)
+        try:
+            index = 0
+            async for section in sections:
+                if section.startswith(AI_ERROR_PREFIX):
+                    yield section
+                    return
+                section = section.strip()
+                if not section.startswith('#'):
+                    section = f"## {outline[index]}\n\n{section}"
+                index += 1
+                yield section + "\n\n"
+        finally:
+            await sections.aclose()
+
+    @staticmethod
+    async def generate_presentation(topic: str, slides: str) -> str:
+        return await AIService.generate_content(AIService.presentation_prompt(topic, slides))
+
+    @staticmethod
+    async def generate_essay(topic: str, essay_type: str) -> str:
+        return await AIService.generate_content(AIService.essay_prompt(topic, essay_type))
+
+    @staticmethod
+    async def generate_test(topic: str, count: str) -> str:
+        total = to_int(count, 10)
+        if total <= TEST_BATCH_SIZE:
+            return await AIService.generate_content(AIService.test_prompt(topic, count))
+
+        batch_count = -(-total // TEST_BATCH_SIZE)
+        sizes = [total // batch_count + (1 if i < total % batch_count else 0) for i in range(batch_count)]
+        factories = [
+            (lambda i=i: AIService.generate_content(AIService.test_batch_prompt(topic, sizes[i], i + 1, batch_count)))
+            for i in range(batch_count)
+        ]
+
+        questions: List[str] = []
+        seen = set()
+
+        def collect(batch: str):
+            for body in split_questions(batch):
+                fingerprint = question_fingerprint(body)
+                if fingerprint and fingerprint not in seen:
+                    seen.add(fingerprint)
+                    questions.append(body)
+
+        batches = fan_out_ordered(factories, AI_FANOUT_CONCURRENCY)
+        try:
+            async for batch in batches:
+                if batch.startswith(AI_ERROR_PREFIX):
+                    return batch
+                collect(batch)
+        finally:
+            await batches.aclose()
+
+        # One top-up round for questions lost to de-duplication or short batches
+        missing = total - len(questions)
+        if missing > 0:
+            avoid = [body.split('\n', 1)[0] for body in questions]
+            batch = await AIService.generate_content(AIService.test_batch_prompt(topic, missing, 1, 1, avoid))
+            if not batch.startswith(AI_ERROR_PREFIX):
+                collect(batch)
+
+        if not questions:
+            return await AIService.generate_content(AIService.test_prompt(topic, count))
+        lines = [f"# {topic}: test savollari\n"]
+        for number, body in enumerate(questions[:total], 1):
+            lines.append(f"### Savol {number}\n{body}\n")
+        return "\n".join(lines)
+
+    @staticmethod
+    def referat_prompt(topic: str, size: str) -> str:
         prompt = f"""
         Mavzu: {topic}
         Hajmi: {size} betga mo'ljallangan
@@ -203,10 +2385,10 @@ class AIService:
         
         Formatlash: Markdown formatidan foydalaning, sarlavhalarni ajratib ko'rsating.
         """
-        return await AIService.generate_content(prompt)
+        return prompt
 
     @staticmethod
-    async def generate_presentation(topic: str, slides: str) -> str:
+    def presentation_prompt(topic: str, slides: str) -> str:
         prompt = f"""
         Role: Sen professional notiq va prezentatsiya mutaxassisisan.
         Vazifa: "{topic}" mavzusida {slides} ta slayddan iborat professional prezentatsiya rejasini va matnini tayyorla.
@@ -222,10 +2404,10 @@ class AIService:
         Formatlash: Toza Markdown formatidan foydalan. Sarlavhalar uchun #, qalin yozuv uchun ** belgilarini ishlat.
         Til: To'liq O'zbek tilida (Kirill yoki Lotin alifbosida foydalanuvchi so'roviga moslab, hozir Lotincha yoz).
         """
-        return await AIService.generate_content(prompt)
+        return prompt
         
     @staticmethod
-    async def generate_essay(topic: str, essay_type: str) -> str:
+    def essay_prompt(topic: str, essay_type: str) -> str:
         prompt = f"""
         Mavzu: {topic}
         Insho turi: {essay_type}
@@ -238,10 +2420,10 @@ class AIService:
         
         Formatlash: Markdown formatidan foydalaning.
         """
-        return await AIService.generate_content(prompt)
+        return prompt
 
     @staticmethod
-    async def generate_test(topic: str, count: str) -> str:
+    def test_prompt(topic: str, count: str) -> str:
         prompt = f"""
         Mavzu: {topic}
         Savollar soni: {count} ta
@@ -255,37 +2437,847 @@ class AIService:
         
         Formatlash: Markdown formatida jadval yoki ro'yxat ko'rinishida.
         """
-        return await AIService.generate_content(prompt)
+        return prompt
+
+    @staticmethod
+    def outline_prompt(topic: str, pages: int, sections: int) -> str:
+        prompt = f"""
+        Mavzu: {topic}
+        Hajmi: {pages} betga mo'ljallangan referat
+        Vazifa: Ushbu referat uchun {sections} ta bo'limdan iborat reja tuzing.
+        Birinchi bo'lim "Kirish", oxirgi ikkitasi "Xulosa" va "Foydalanilgan adabiyotlar" bo'lsin.
+
+        Javobni FAQAT JSON massiv ko'rinishida qaytaring, masalan: ["Kirish", "...", "Xulosa", "Foydalanilgan adabiyotlar"]
+        """
+        return prompt
+
+    @staticmethod
+    def section_prompt(topic: str, outline: List[str], index: int, pages: int) -> str:
+        plan = "\n".join(f"        {i + 1}. {title}" for i, title in enumerate(outline))
+        prompt = f"""
+        Mavzu: {topic}
+        Referat rejasi:
+{plan}
+
+        Vazifa: O'zbek tilida professional, akademik uslubda faqat {index + 1}-bo'limni ("{outline[index]}") yozing.
+        Hajmi: taxminan {pages} bet.
+        Boshqa bo'limlarni takrorlamang, mavzuga kirish yoki xulosa qo'shmang (agar bu bo'limning o'zi bo'lmasa).
+
+        Formatlash: Markdown. Bo'limni "## {outline[index]}" sarlavhasi bilan boshlang.
+        """
+        return prompt
+
+    @staticmethod
+    def test_batch_prompt(topic: str, count: int, part: int, parts: int, avoid: Optional[List[str]] = None) -> str:
+        avoid_text = ""
+        if avoid:
+            listed = "\n".join(f"        - {question}" for question in avoid)
+            avoid_text = f"\n        Quyidagi savollarni takrorlamang:\n{listed}\n"
+        prompt = f"""
+        Mavzu: {topic}
+        Savollar soni: {count} ta
+        Vazifa: O'zbek tilida test savollari tuzing.
+        Bu {parts} ta to'plamdan {part}-to'plam: savollar mavzuning turli jihatlarini qamrab olsin.
+{avoid_text}
+        Har bir savol uchun:
+        - Savol matni
+        - 4 ta variant (A, B, C, D)
+        - To'g'ri javob
+        - Qisqa izoh (nima uchun bu javob to'g'ri)
+
+        Formatlash: Har bir savolni alohida "### Savol N" sarlavhasi bilan boshlang, keyingi qatorda savol matnini yozing.
+        """
+        return prompt
+
+# Bot Setup
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(
+    api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER)) if TELEGRAM_API_SERVER else None)
+dp = Dispatcher(storage=fsm_storage)
+router = Router()
+dp.include_router(router)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Inner middleware observing each handler's duration, labelled by handler name."""
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(self, handler, event, data):
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_object = data.get("handler")
+            name = handler_object.callback.__name__ if handler_object else "unknown"
+            BOT_HANDLER_SECONDS.observe(time.perf_counter() - start, self.event, name)
+
+dp.message.middleware(HandlerTimingMiddleware("message"))
+dp.callback_query.middleware(HandlerTimingMiddleware("callback_query"))
+
+# Notification Queue
+class NotificationQueue:
+    """Persistent, rate-limited sender for everything the bot pushes to users.
+
+    Messages are written to the outbox table first, so they survive restarts and
+    any process sharing the database can queue them. Only the process holding the
+    "outbox" lease sends, so several web workers still share one rate limit. The
+    sender claims messages in batches and paces them through a token bucket
+    (Telegram allows ~30 messages/second per bot) and a per-chat interval, which
+    also keeps each chat's messages in order. RetryAfter pauses all sending for
+    the requested time, other errors back off and retry up to `max_attempts`, and
+    chats that blocked the bot are marked failed.
+    """
+
+    def __init__(self, database: Database, rate_per_second: float = 25, per_chat_seconds: float = 1.0,
+                 concurrency: int = 16, max_attempts: int = 5, batch_size: int = 200,
+                 poll_seconds: float = 1.0, lease_seconds: float = 600, retention_days: float = 7,
+                 retry_seconds: float = 2.0, sender_lease_seconds: float = 15):
+        self.database = database
+        # No burst allowance: Telegram counts per second, so a full bucket on top of
+        # the refill rate would overshoot its limit right after every idle period.
+        self.bucket = TokenBucket(rate_per_second, 1)
+        self.per_chat_seconds = per_chat_seconds
+        self.max_attempts = max_attempts
+        # First retry delay, doubled on each further attempt
+        self.retry_seconds = retry_seconds
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_days * 86400
+        # The sender lease is renewed every third of its lifetime; a stopped or dead
+        # holder's lease is taken over by another process once it expires
+        self.sender_lease_seconds = sender_lease_seconds
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.leader = False
+        self._next_renew = 0.0
+        # Claimed messages not yet handed to a sender, in outbox id order
+        self._local: List[Dict[str, Any]] = []
+        self._in_flight: set = set()
+        self._chat_ready: Dict[int, float] = {}
+        self._results: List[tuple] = []
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: set = set()
+        self._wakeup = asyncio.Event()
+        self._new = True
+        self._next_poll = 0.0
+        self._next_flush = 0.0
+        self._next_prune = 0.0
+        self._paused_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def send(self, chat_id: int, text: str):
+        await self.send_many([(chat_id, text)])
+
+    async def send_many(self, messages: List[Tuple[int, str]]):
+        if messages:
+            await self.database.enqueue_messages(messages)
+            self.wake()
+
+    def wake(self):
+        """Look for new outbox rows now instead of at the next poll."""
+        self._new = True
+        self._wakeup.set()
+
+    async def _hold_lease(self) -> bool:
+        now = time.monotonic()
+        if now < self._next_renew:
+            return self.leader
+        was_leader, self.leader = self.leader, False
+        self._next_renew = now + self.sender_lease_seconds / 3
+        self.leader = await self.database.acquire_lease("outbox", self.owner, self.sender_lease_seconds)
+        if was_leader and not self.leader:
+            # Another process took over: hand back what this one claimed but hasn't sent
+            logger.warning("Outbox sender lease lost")
+            self._results += [('pending', m['attempts'], None, 0, m['id']) for m in self._local]
+            self._local = []
+        return self.leader
+
+    async def _fill(self):
+        if not await self._hold_lease():
+            return
+        now = time.monotonic()
+        if len(self._local) >= self.batch_size // 2 or (not self._new and now < self._next_poll):
+            return
+        self._new = False
+        self._next_poll = now + self.poll_seconds
+        if now >= self._next_prune:
+            self._next_prune = now + 3600
+            await self.database.prune_outbox(time.time() - self.retention_seconds)
+            self._chat_ready = {chat: ready for chat, ready in self._chat_ready.items() if ready > now}
+        lease_before = time.time() - self.lease_seconds
+        if not await self.database.has_due_outbox(lease_before):
+            return
+        claimed = await self.database.claim_outbox(self.batch_size - len(self._local), lease_before)
+        if claimed:
+            self._local = sorted(self._local + claimed, key=lambda m: m['id'])
+
+    def _next_ready(self) -> Tuple[Optional[Dict[str, Any]], float]:
+        """First message whose chat may receive now, else how long until one may."""
+        now = time.monotonic()
+        wait = self.poll_seconds
+        held = set()
+        for message in self._local:
+            chat_id = message['chat_id']
+            if chat_id in held:
+                continue
+            # A chat's later messages wait behind its earlier ones
+            held.add(chat_id)
+            if chat_id in self._in_flight:
+                continue
+            ready = self._chat_ready.get(chat_id, 0.0)
+            if ready <= now:
+                return message, 0.0
+            wait = min(wait, ready - now)
+        return None, wait
+
+    def _finish(self, message: Dict[str, Any], status: str, error: Optional[str] = None):
+        self._results.append((status, message['attempts'] + 1, error, 0, message['id']))
+        OUTBOX_MESSAGES.inc(1, status)
+
+    def _requeue(self, message: Dict[str, Any]):
+        bisect.insort(self._local, message, key=lambda m: m['id'])
+
+    async def _deliver(self, message: Dict[str, Any]):
+        chat_id = message['chat_id']
+        try:
+            await bot.send_message(chat_id, message['text'])
+            self.sent += 1
+            self._finish(message, 'sent')
+        except TelegramRetryAfter as e:
+            self.retried += 1
+            OUTBOX_MESSAGES.inc(1, "retry_after")
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            self._requeue(message)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Blocked bot, deleted account or bad chat: retrying won't help
+            self.failed += 1
+            self._finish(message, 'failed', str(e))
+        except Exception as e:
+            message['attempts'] += 1
+            if message['attempts'] >= self.max_attempts:
+                logger.error(f"Message {message['id']} to {chat_id} failed: {e}")
+                self.failed += 1
+                message['attempts'] -= 1
+                self._finish(message, 'failed', str(e))
+            else:
+                self._chat_ready[chat_id] = time.monotonic() + self.retry_seconds * 2 ** (message['attempts'] - 1)
+                self._requeue(message)
+        finally:
+            self._in_flight.discard(chat_id)
+
+    def _sender_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._slots.release()
+        self._wakeup.set()
+
+    async def _flush(self):
+        if not self._results:
+            return
+        results, self._results = self._results, []
+        try:
+            await self.database.finish_outbox(results)
+        except Exception:
+            self._results = results + self._results
+            raise
+
+    async def _run(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                await self._fill()
+                if len(self._results) >= 50 or time.monotonic() >= self._next_flush:
+                    self._next_flush = time.monotonic() + 0.5
+                    await self._flush()
+            except Exception as e:
+                logger.error(f"Outbox error: {e}")
+
+            message, wait = self._next_ready()
+            if message is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            await self._slots.acquire()
+            await self.bucket.acquire()
+            self._local.remove(message)
+            self._in_flight.add(message['chat_id'])
+            self._chat_ready[message['chat_id']] = time.monotonic() + self.per_chat_seconds
+            task = asyncio.create_task(self._deliver(message))
+            self._tasks.add(task)
+            task.add_done_callback(self._sender_done)
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)
+        # Whatever was claimed but not sent goes back to the outbox for the next start
+        self._results += [('pending', m['attempts'], None, 0, m['id']) for m in self._local]
+        self._local = []
+        try:
+            await self._flush()
+            if self.leader:
+                self.leader = False
+                self._next_renew = 0.0
+                await self.database.release_lease("outbox", self.owner)
+        except Exception as e:
+            logger.error(f"Outbox state not saved on shutdown: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "leader": self.leader,
+            "claimed": len(self._local),
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "paused": self._paused_until > time.monotonic()
+        }
+
+notifications = NotificationQueue(db, rate_per_second=NOTIFY_RATE_PER_SECOND,
+                                  per_chat_seconds=NOTIFY_PER_CHAT_SECONDS, concurrency=NOTIFY_CONCURRENCY)
+
+PREMIUM_REMINDER = "⏳ Premium obunangiz {date} da tugaydi. Uzaytirish uchun 💎 Premium bo'limiga o'ting."
+PREMIUM_EXPIRED = "⌛️ Premium obunangiz muddati tugadi. Qayta faollashtirish uchun 💎 Premium bo'limiga o'ting."
+
+class PremiumSweeper:
+    """Periodically expires premium users, queues reminders before expiry and refreshes the PremiumIndex.
+
+    Both sweeps walk the partial premium_expires index in batches, and every batch
+    claims its rows with UPDATE ... RETURNING, so several workers can sweep at once
+    without sending anything twice.
+    """
+
+    def __init__(self, database: Database, interval: float = 60, remind_before_hours: float = 72,
+                 batch_size: int = 500):
+        self.database = database
+        self.interval = interval
+        self.remind_before = remind_before_hours * 3600
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+        self.expired = 0
+        self.reminded = 0
+        self.last_sweep: Optional[float] = None
+
+    async def sweep(self):
+        now = time.time()
+        queued = 0
+        while True:
+            expired = await self.database.expire_premium(now, self.batch_size, PREMIUM_EXPIRED)
+            self.expired += len(expired)
+            queued += len(expired)
+            if len(expired) < self.batch_size:
+                break
+        while True:
+            reminded = await self.database.queue_premium_reminders(now, now + self.remind_before,
+                                                                   self.batch_size, PREMIUM_REMINDER)
+            self.reminded += reminded
+            queued += reminded
+            if reminded < self.batch_size:
+                break
+        if queued:
+            notifications.wake()
+        await self.database.premium_index.reload(self.database.get_premium_expiries)
+        self.last_sweep = now
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Premium sweep failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.database.premium_index.stats(), "expired": self.expired,
+                "reminded": self.reminded, "last_sweep": self.last_sweep}
+
+premium_sweeper = PremiumSweeper(db, interval=PREMIUM_SWEEP_SECONDS, remind_before_hours=PREMIUM_REMIND_HOURS)
+
+# Generation Quotas
+class QuotaExceeded(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+
+
+class SlidingWindowLimiter:
+    """Per-key timestamps of the requests made in the last `window_seconds`."""
+
+    def __init__(self, window_seconds: float, max_keys: int = 100000):
+        self.window = window_seconds
+        self.max_keys = max_keys
+        self._hits: Dict[int, deque] = {}
+
+    def hit(self, key: int, limit: int) -> float:
+        """Record a request and return 0, or return the seconds until one is allowed."""
+        now = time.monotonic()
+        hits = self._hits.get(key)
+        if hits is None:
+            if len(self._hits) >= self.max_keys:
+                self._hits = {k: v for k, v in self._hits.items() if v and now - v[-1] < self.window}
+            hits = self._hits[key] = deque()
+        while hits and now - hits[0] >= self.window:
+            hits.popleft()
+        if len(hits) >= limit:
+            return self.window - (now - hits[0])
+        hits.append(now)
+        return 0.0
+
+
+class GenerationQuota:
+    """Per-user generation limits: a sliding window against bursts and a daily quota.
+
+    Both depend on premium status and are checked in memory only, so a rejected
+    request costs no database or AI work. Today's usage is written back as deltas
+    every `flush_seconds` and re-read after each flush, so workers sharing the
+    database converge on the same totals.
+    """
+
+    def __init__(self, database: Database, window_seconds: float = 60, burst_free: int = 3,
+                 burst_premium: int = 10, daily_free: int = 10, daily_premium: int = 100,
+                 flush_seconds: float = 10, keep_days: int = 7):
+        self.database = database
+        self.limiter = SlidingWindowLimiter(window_seconds)
+        self.burst = {False: burst_free, True: burst_premium}
+        self.daily = {False: daily_free, True: daily_premium}
+        self.flush_seconds = flush_seconds
+        self.keep_days = keep_days
+        self._day = date.today().isoformat()
+        self._base: Dict[int, int] = {}
+        # Not yet written: (day, tg_id) -> count
+        self._pending: Dict[Tuple[str, int], int] = {}
+        self._pruned_day: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self.rejected = 0
+
+    def used_today(self, tg_id: int) -> int:
+        today = date.today().isoformat()
+        if today != self._day:
+            self._day, self._base = today, {}
+        return self._base.get(tg_id, 0) + self._pending.get((today, tg_id), 0)
+
+    def check(self, tg_id: int):
+        """Count one generation for `tg_id`, or raise QuotaExceeded."""
+        premium = self.database.premium_index.is_active(tg_id)
+        daily = self.daily[premium]
+        if self.used_today(tg_id) >= daily:
+            self.rejected += 1
+            RATE_LIMITED.inc(1, "daily")
+            midnight = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+            hint = "" if premium else " yoki 💎 Premium obunani faollashtiring"
+            raise QuotaExceeded(f"Bugungi limit tugadi ({daily} ta). Ertaga qayta urinib ko'ring{hint}.",
+                                (midnight - datetime.now()).total_seconds())
+        wait = self.limiter.hit(tg_id, self.burst[premium])
+        if wait:
+            self.rejected += 1
+            RATE_LIMITED.inc(1, "burst")
+            raise QuotaExceeded(f"So'rovlar juda ko'p. {math.ceil(wait)} soniyadan keyin qayta urinib ko'ring.", wait)
+        key = (self._day, tg_id)
+        self._pending[key] = self._pending.get(key, 0) + 1
+
+    def refund(self, tg_id: int):
+        """Give back the daily generation counted by check() when the server failed to produce it.
+
+        The burst window keeps its hit: the user's newest hit may belong to another
+        request running at the same time.
+        """
+        key = (self._day, tg_id)
+        self._pending[key] = self._pending.get(key, 0) - 1
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        usage = [(day, tg_id, count) for (day, tg_id), count in pending.items() if count]
+        if usage:
+            try:
+                await self.database.add_generation_usage(usage)
+            except Exception:
+                for key, count in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + count
+                raise
+        day = self._day
+        usage = await self.database.get_generation_usage(day)
+        if day == self._day:
+            self._base = usage
+        if self._pruned_day != day:
+            await self.database.prune_generation_usage((date.today() - timedelta(days=self.keep_days)).isoformat())
+            self._pruned_day = day
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Quota flush failed: {e}")
+
+    async def start(self):
+        await self.flush()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Quota usage not saved on shutdown: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"users_today": len(self._base), "unflushed": sum(self._pending.values()),
+                "rejected": self.rejected}
+
+# Daily quotas are shared through the database; the burst windows are per process
+generation_quota = GenerationQuota(db, window_seconds=RATE_LIMIT_WINDOW_SECONDS, burst_free=per_worker(RATE_LIMIT_FREE),
+                                   burst_premium=per_worker(RATE_LIMIT_PREMIUM), daily_free=DAILY_QUOTA_FREE,
+                                   daily_premium=DAILY_QUOTA_PREMIUM, flush_seconds=QUOTA_FLUSH_SECONDS)
+
+class RateLimitMiddleware(BaseMiddleware):
+    """Drops a user's updates past the flood limit and applies the generation quota
+    to handlers registered with flags={"generation": True}."""
+
+    def __init__(self, quota: GenerationQuota, limit: int, window_seconds: float):
+        self.quota = quota
+        self.limit = limit
+        self.flood = SlidingWindowLimiter(window_seconds)
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id == ADMIN_ID:
+            return await handler(event, data)
+        if self.flood.hit(user.id, self.limit):
+            RATE_LIMITED.inc(1, "flood")
+            return None
+        if get_flag(data, "generation"):
+            try:
+                self.quota.check(user.id)
+            except QuotaExceeded as e:
+                if isinstance(event, CallbackQuery):
+                    await event.answer(e.message, show_alert=True)
+                else:
+                    await event.answer(e.message)
+                return None
+        return await handler(event, data)
+
+dp.message.middleware(RateLimitMiddleware(generation_quota, per_worker(BOT_FLOOD_LIMIT), BOT_FLOOD_WINDOW_SECONDS))
+dp.callback_query.middleware(RateLimitMiddleware(generation_quota, per_worker(BOT_FLOOD_LIMIT), BOT_FLOOD_WINDOW_SECONDS))
+
+# WebApp Authentication
+class InvalidInitData(Exception):
+    pass
+
+
+class InitDataVerifier:
+    """Checks the initData Telegram signs for a Web App and returns the user's id.
+
+    The HMAC key derived from the bot token is computed once. Verified strings go
+    into an LRU, so a page's repeat calls with the same initData skip parsing and
+    hashing; cached entries still expire with their auth_date.
+    """
+
+    def __init__(self, bot_token: str, max_age_seconds: int = 86400, cache_size: int = 10000):
+        self._secret = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+        self.max_age = max_age_seconds
+        self.cache_size = cache_size
+        self._verified: "OrderedDict[str, Tuple[int, int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, auth_date: int) -> bool:
+        return self.max_age > 0 and time.time() - auth_date > self.max_age
+
+    def verify(self, init_data: str) -> int:
+        entry = self._verified.get(init_data)
+        if entry is not None:
+            tg_id, auth_date = entry
+            if not self._expired(auth_date):
+                self._verified.move_to_end(init_data)
+                self.hits += 1
+                return tg_id
+            del self._verified[init_data]
+            raise InvalidInitData("initData expired")
+        self.misses += 1
 
-# Bot Setup
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
-router = Router()
+        fields = dict(parse_qsl(init_data, keep_blank_values=True))
+        received = fields.pop("hash", "")
+        check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+        expected = hmac.new(self._secret, check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, received):
+            raise InvalidInitData("initData signature mismatch")
+        try:
+            auth_date = int(fields["auth_date"])
+            tg_id = int(json.loads(fields["user"])["id"])
+        except (KeyError, ValueError, TypeError):
+            raise InvalidInitData("initData has no user")
+        if self._expired(auth_date):
+            raise InvalidInitData("initData expired")
+
+        self._verified[init_data] = (tg_id, auth_date)
+        if len(self._verified) > self.cache_size:
+            self._verified.popitem(last=False)
+        return tg_id
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._verified),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+init_data_verifier = InitDataVerifier(BOT_TOKEN or "", INIT_DATA_MAX_AGE_SECONDS, INIT_DATA_CACHE_SIZE)
 
 # Web App Setup
 app = FastAPI(title="Talaba Bot API")
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(QuotaExceeded)
+async def quota_exceeded_handler(request: Request, exc: QuotaExceeded):
+    return JSONResponse(status_code=429, content={"success": False, "message": exc.message},
+                        headers={"Retry-After": str(math.ceil(exc.retry_after))})
+
+@app.exception_handler(InvalidInitData)
+async def invalid_init_data_handler(request: Request, exc: InvalidInitData):
+    return JSONResponse(status_code=401, content={"success": False, "message": "Avtorizatsiya xatosi"})
+
+async def current_tg_id(request: Request) -> int:
+    """Dependency: the Telegram user id from the request's verified Web App initData.
+
+    Sent as `X-Telegram-Init-Data: <initData>` or `Authorization: tma <initData>`.
+    """
+    init_data = request.headers.get("x-telegram-init-data")
+    if not init_data:
+        scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+        init_data = credentials if scheme.lower() == "tma" else ""
+    if not init_data:
+        if WEBAPP_DEV_USER_ID:
+            return WEBAPP_DEV_USER_ID
+        raise InvalidInitData("initData missing")
+    return init_data_verifier.verify(init_data)
+
+# WebApp Assets
+class StaticAsset:
+    __slots__ = ('media_type', 'etag', 'cache_control', 'variants')
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str):
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        # Precompressed once at load time; tiny files are not worth compressing
+        self.variants: Dict[str, bytes] = {"identity": body}
+        if len(body) >= 512:
+            self.variants["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli:
+                self.variants["br"] = brotli.compress(body, quality=11)
+
+    def pick_encoding(self, accept_encoding: str) -> str:
+        accepted = {part.split(';')[0].strip().lower() for part in accept_encoding.split(',')}
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in self.variants:
+                return encoding
+        return "identity"
+
+
+class WebAppAssets:
+    """webapp.html and its static/ assets, loaded once and served from memory.
+
+    Assets are exposed under content-hashed names (webapp.3f2a9c01.js) with a
+    one-year immutable Cache-Control, and the HTML is rewritten to point at them.
+    The HTML itself is revalidated on every open via ETag / If-None-Match.
+    """
+
+    ASSET_REF_RE = re.compile(r'(src|href)="/static/([^"]+)"')
+    IMMUTABLE = "public, max-age=31536000, immutable"
+
+    def __init__(self, html_path: str = 'webapp.html', static_dir: str = 'static'):
+        self.html_path = html_path
+        self.static_dir = static_dir
+        self.html: Optional[StaticAsset] = None
+        self.assets: Dict[str, StaticAsset] = {}
+        self._mtimes: Dict[str, float] = {}
+
+    def _watched_files(self) -> List[str]:
+        files = [self.html_path]
+        if os.path.isdir(self.static_dir):
+            files += [os.path.join(self.static_dir, name) for name in sorted(os.listdir(self.static_dir))]
+        return files
+
+    def load(self):
+        assets: Dict[str, StaticAsset] = {}
+        hashed_names: Dict[str, str] = {}
+        for path in self._watched_files()[1:]:
+            name = os.path.basename(path)
+            with open(path, 'rb') as f:
+                body = f.read()
+            media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            stem, ext = os.path.splitext(name)
+            hashed = f"{stem}.{hashlib.sha256(body).hexdigest()[:8]}{ext}"
+            assets[hashed] = StaticAsset(body, media_type, self.IMMUTABLE)
+            assets[name] = StaticAsset(body, media_type, "no-cache")
+            hashed_names[name] = hashed
+
+        try:
+            with open(self.html_path, 'r', encoding='utf-8') as f:
+                html = f.read()
+        except FileNotFoundError:
+            html = "WebApp HTML fayli topilmadi."
+        html = self.ASSET_REF_RE.sub(
+            lambda m: f'{m.group(1)}="/static/{hashed_names.get(m.group(2), m.group(2))}"', html)
+
+        self.assets = assets
+        self.html = StaticAsset(html.encode('utf-8'), "text/html", "no-cache")
+        self._mtimes = self._current_mtimes()
+        logger.info(f"WebApp assets loaded ({len(hashed_names)} static files)")
+
+    def _current_mtimes(self) -> Dict[str, float]:
+        mtimes = {}
+        for path in self._watched_files():
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except FileNotFoundError:
+                pass
+        return mtimes
+
+    async def watch(self, interval: float = 1.0):
+        """Development helper: reload whenever a watched file changes on disk."""
+        while True:
+            await asyncio.sleep(interval)
+            if self._current_mtimes() != self._mtimes:
+                try:
+                    self.load()
+                except Exception as e:
+                    logger.error(f"WebApp reload failed: {e}")
+
+    def respond(self, asset: Optional[StaticAsset], request: Request) -> Response:
+        if asset is None:
+            return Response(status_code=404)
+        encoding = asset.pick_encoding(request.headers.get("accept-encoding", ""))
+        etag = f'"{asset.etag}"' if encoding == "identity" else f'"{asset.etag}-{encoding}"'
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(',')}
+            if "*" in candidates or etag in candidates:
+                return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=asset.variants[encoding], media_type=asset.media_type, headers=headers)
+
+webapp_assets = WebAppAssets()
+
+@app.on_event("startup")
+async def load_webapp_assets():
+    webapp_assets.load()
+    if WEBAPP_RELOAD:
+        app.state.webapp_watcher = asyncio.create_task(webapp_assets.watch())
 
 @app.get("/", response_class=HTMLResponse)
-async def web_app_home():
-    try:
-        with open('webapp.html', 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        return "WebApp HTML fayli topilmadi."
+async def web_app_home(request: Request):
+    if webapp_assets.html is None:
+        webapp_assets.load()
+    return webapp_assets.respond(webapp_assets.html, request)
+
+@app.get("/static/{name}")
+async def web_app_static(name: str, request: Request):
+    if webapp_assets.html is None:
+        webapp_assets.load()
+    return webapp_assets.respond(webapp_assets.assets.get(name), request)
+
+def has_metrics_token(request: Request) -> bool:
+    """Whether the request carries `Authorization: Bearer <METRICS_TOKEN>`; never true while it is unset."""
+    if not METRICS_TOKEN:
+        return False
+    header = request.headers.get("Authorization", "")
+    return hmac.compare_digest(header.encode(), f"Bearer {METRICS_TOKEN}".encode())
+
+@app.get("/api/health")
+async def health(request: Request):
+    # The Web App shares this server, so internals are only shown to the metrics scraper
+    if not has_metrics_token(request):
+        return {"status": "ok"}
+    return {
+        "status": "ok",
+        "write_queue": write_queue.stats(),
+        "user_cache": db.user_cache.stats(),
+        "fsm_storage": fsm_storage.stats(),
+        "generation_cache": generation_cache.stats(),
+        "generation_flight": generation_flight.stats(),
+        "generation_scheduler": generation_scheduler.stats(),
+        "ai_providers": ai_router.status(),
+        "pptx_renderer": pptx_renderer.stats(),
+        "document_exporter": document_exporter.stats(),
+        "jobs": job_queue.stats(),
+        "notifications": notifications.stats(),
+        "premium": premium_sweeper.stats(),
+        "quota": generation_quota.stats(),
+        "init_data": init_data_verifier.stats()
+    }
+
+QUEUE_DEPTH = Gauge("app_queue_depth", "Items waiting or in progress in internal queues", ("queue",),
+                    collect=lambda: {
+                        ("write_behind",): write_queue.depth,
+                        ("ai_scheduler_active",): generation_scheduler.active,
+                        ("ai_scheduler_waiting",): generation_scheduler.stats()["waiting"],
+                        ("jobs_running",): job_queue.stats()["running"],
+                        ("webhook_updates",): len(webhook_tasks),
+                    })
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Metrics are disabled; set METRICS_TOKEN")
+    if not has_metrics_token(request):
+        raise HTTPException(status_code=401, detail="Invalid metrics token",
+                            headers={"WWW-Authenticate": "Bearer"})
+    body = render_metrics()
+    EVENT_LOOP_LAG_MAX.set(0.0)
+    return Response(content=body, media_type="text/plain; version=0.0.4")
+
+@app.get("/api/queue")
+async def queue_status(premium: bool = False):
+    """Queue position and estimated wait a new generation request would get."""
+    return generation_scheduler.estimate(premium)
 
 @app.post("/api/user-info")
-async def get_user_info(request: Request):
-    # In a real app, you would validate the Telegram WebApp Init Data here
-    # For now, we simulate pulling the ID, assuming the front end sends it or we use a default for testing
-    # Since headers are hard to spoof in pure browser without tools, but for production use `validate_web_app_data`
-    
-    # We'll try to extract from initData if passed, otherwise default for testing
-    body = await request.json() if await request.body() else {}
-    # NOTE: In production, rely on initData from headers/body and verify signature
-    
-    # For simulation/demo purposes, we use a fixed ID if not provided, or extract from request
-    tg_id = 123456789 # Default test ID
-    
+async def get_user_info(tg_id: int = Depends(current_tg_id)):
     user = await db.get_user(tg_id)
     if not user:
         return {
@@ -299,105 +3291,571 @@ async def get_user_info(request: Request):
     return {
         "tg_id": user['tg_id'],
         "balance": user['balance'],
-        "is_premium": bool(user['is_premium']),
+        "is_premium": is_premium_active(user),
         "premium_until": user['premium_until'],
         "content_count": user['content_count']
     }
 
-@app.post("/api/generate")
-async def generate_content_api(request: Request):
-    data = await request.json()
+async def run_generation(tg_id: int, content_type: str, topic: str, param: str,
+                         use_cache: bool = True) -> Tuple[str, bool]:
+    """Cache -> single-flight -> AIService pipeline shared by /api/generate and jobs.
+
+    Every upstream call AIService makes takes its own scheduler slot, at the
+    caller's priority.
+
+    Returns (content, cached); the result is recorded through the write-behind queue.
+    """
+    cache_key = GenerationCache.make_key(content_type, topic, param)
+
+    # Opting out skips the lookup only; the fresh result still refreshes the cache
+    content = await generation_cache.get(cache_key) if use_cache else None
+    cached = content is not None
+    if not cached:
+        # Copied into the single-flight task, so the leader's priority applies to every sub-call
+        ai_premium.set(db.premium_index.is_active(tg_id))
+        content = await generation_flight.do(cache_key, lambda: AIService.generate(content_type, topic, param))
+        if content.startswith(AI_ERROR_PREFIX):
+            cache_key = None
+        else:
+            generation_cache.put(cache_key, content)
+    
+    # Save statistics (flushed in the background by the write-behind queue)
+    write_queue.save_content(tg_id, content_type, topic, content, cache_key)
+    write_queue.increment_content_count(tg_id)
+    return content, cached
+
+def parse_generation_request(data: Any) -> Tuple[str, str, str]:
+    """(content_type, topic, param) from a generation request body, or ValueError with a message for the user.
+
+    Generation endpoints call this before charging the quota, so a bad request costs nothing.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Noto'g'ri so'rov")
     content_type = data.get('type')
+    if content_type not in GENERATION_PARAMS:
+        raise ValueError("Noto'g'ri kontent turi")
     topic = data.get('topic')
-    params = data.get('params', {})
-    tg_id = 123456789 # Placeholder, should be extracted from auth
-    
-    if content_type == 'referat':
-        content = await AIService.generate_referat(topic, params.get('size', '10'))
-    elif content_type == 'prezentatsiya':
-        content = await AIService.generate_presentation(topic, params.get('slides', '10'))
-    elif content_type == 'insho':
-        content = await AIService.generate_essay(topic, params.get('type', 'argumentativ'))
-    elif content_type == 'test':
-        content = await AIService.generate_test(topic, params.get('count', '10'))
-    else:
-        return {"success": False, "message": "Noto'g'ri kontent turi"}
-    
-    # Save statistics
-    await db.save_content(tg_id, content_type, topic, content)
-    await db.increment_content_count(tg_id)
-    
+    if not isinstance(topic, str) or not topic.strip():
+        raise ValueError("Mavzu kiritilmagan")
+    params = data.get('params') or {}
+    if not isinstance(params, dict):
+        raise ValueError("Noto'g'ri parametrlar")
+    param_name, default = GENERATION_PARAMS[content_type]
+    param = str(params.get(param_name, default))
+    if content_type in GENERATION_PARAM_RANGES:
+        low, high = GENERATION_PARAM_RANGES[content_type]
+        param = str(max(low, min(high, to_int(param, int(default)))))
+    return content_type, topic, param
+
+@app.post("/api/generate")
+async def generate_content_api(request: Request, tg_id: int = Depends(current_tg_id)):
+    data = await request.json()
+    try:
+        content_type, topic, param = parse_generation_request(data)
+    except ValueError as e:
+        return {"success": False, "message": str(e)}
+    use_cache = data.get('cache', True) is not False
+
+    generation_quota.check(tg_id)
+    content, cached = await run_generation(tg_id, content_type, topic, param, use_cache)
+    if content.startswith(AI_ERROR_PREFIX):
+        generation_quota.refund(tg_id)
+
     return {
         "success": True,
         "content": content,
-        "type": content_type
+        "type": content_type,
+        "cached": cached
     }
 
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
+@app.post("/api/generate-stream")
+async def generate_content_stream_api(request: Request, tg_id: int = Depends(current_tg_id)):
+    """Same as /api/generate, but forwards Gemini chunks as Server-Sent Events."""
+    data = await request.json()
+    try:
+        content_type, topic, param = parse_generation_request(data)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"success": False, "message": str(e)})
+    use_cache = data.get('cache', True) is not False
 
-from pptx import Presentation
-from pptx.util import Inches, Pt
-from fastapi.responses import StreamingResponse
-import io
-import re
+    generation_quota.check(tg_id)
+    cache_key = GenerationCache.make_key(content_type, topic, param)
+    cached_content = await generation_cache.get(cache_key) if use_cache else None
+    premium = db.premium_index.is_active(tg_id) if cached_content is None else False
 
-# PPTX Generator Helper
-def create_pptx_from_text(content: str) -> io.BytesIO:
-    prs = Presentation()
-    
-    # Split content into slides based on markdown headings or explicit separators
-    # We look for lines starting with "Slide", "Slayd" or just headings
-    slides_content = re.split(r'(?i)(?:^|\n)(?:Slide|Slayd)\s+\d+', content)
-    
-    # If split didn't work well (no explicit "Slide X"), try splitting by H1/H2 (#)
-    if len(slides_content) < 2:
-        slides_content = re.split(r'(?i)(?:^|\n)#+\s+', content)
-
-    # Clean up empty splits
-    slides_content = [s.strip() for s in slides_content if s.strip()]
-
-    # If still no splits, treat whole text as one slide (fallback)
-    if not slides_content:
-        slides_content = [content]
-
-    for i, slide_text in enumerate(slides_content):
-        # Create a slide
-        # 0 = Title Slide (for first slide if it looks like a title), 1 = Title and Content
-        layout = prs.slide_layouts[0] if i == 0 else prs.slide_layouts[1]
-        slide = prs.slides.add_slide(layout)
-        
-        # Extract Title
-        lines = slide_text.split('\n')
-        title_text = lines[0].strip().replace('#', '').strip()
-        if title_text.startswith("*") and title_text.endswith("*"): # Remove bold markdown
-            title_text = title_text.strip("*")
-            
-        # Remove title from lines to process body
-        body_lines = lines[1:]
-        body_text = '\n'.join(body_lines).strip()
-        
-        # Set Title
-        if slide.shapes.title:
-            slide.shapes.title.text = title_text
-            
-        # Set Body Content
-        if i == 0: # Title Slide
-            # For title slide, put the rest in subtitle
-            if len(slide.placeholders) > 1:
-                slide.placeholders[1].text = body_text
-        else: # Content Slide
-            # For content slides, we want structured bullet points
-            if len(slide.placeholders) > 1:
-                tf = slide.placeholders[1].text_frame
-                tf.text = body_text # Simple approach: dump text.
-
-    output = io.BytesIO()
-    prs.save(output)
-    output.seek(0)
-    return output
+    # Only server-side failures are refunded; a client that goes away keeps the charge,
+    # since the provider was already called for it
+    async def events():
+        if cached_content is not None:
+            yield sse_event({"delta": cached_content})
+            write_queue.save_content(tg_id, content_type, topic, cached_content, cache_key)
+            write_queue.increment_content_count(tg_id)
+            yield sse_event({"type": content_type, "cached": True}, event="done")
+            return
+
+        parts = []
+        ai_premium.set(premium)
+        # A fanned-out generation takes a slot per sub-call instead of holding one throughout
+        ticket = None if AIService.fans_out(content_type, param) else generation_scheduler.enqueue(premium)
+        try:
+            # Report queue position until a generation slot frees up
+            while ticket is not None and not await generation_scheduler.wait(ticket, timeout=2.0):
+                position = generation_scheduler.position(ticket)
+                yield sse_event({"position": position,
+                                 "estimated_wait": generation_scheduler.estimated_wait(position)}, event="queued")
+            async for chunk in AIService.stream(content_type, topic, param):
+                parts.append(chunk)
+                yield sse_event({"delta": chunk})
+        except Exception as e:
+            logger.error(f"AI Streaming Error: {e}")
+            generation_quota.refund(tg_id)
+            yield sse_event({"message": "Kechirasiz, kontent yaratishda xatolik yuz berdi. Iltimos keyinroq urinib ko'ring."},
+                            event="error")
+            return
+        finally:
+            if ticket is not None:
+                generation_scheduler.release(ticket)
+
+        # Persist only once the whole text has been produced
+        content = "".join(parts)
+        key = None if content.startswith(AI_ERROR_PREFIX) else cache_key
+        if key:
+            generation_cache.put(key, content)
+        else:
+            generation_quota.refund(tg_id)
+        write_queue.save_content(tg_id, content_type, topic, content, key)
+        write_queue.increment_content_count(tg_id)
+        yield sse_event({"type": content_type, "cached": False}, event="done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# Generation Jobs
+JOB_LABELS = {
+    'referat': "Referat",
+    'prezentatsiya': "Prezentatsiya",
+    'insho': "Insho",
+    'test': "Test",
+}
+
+def split_message(text: str, limit: int = 4096) -> List[str]:
+    """Split text into Telegram-sized messages, preferring line, then word boundaries."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(' ', 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+class JobQueue:
+    """Generation jobs persisted in generation_jobs and run by up to `workers` tasks.
+
+    A dispatcher claims jobs from the database whenever a worker slot is free, so
+    queued jobs survive restarts and any process sharing the file can pick them up;
+    while idle it costs one query per `poll_seconds`. A job left 'running' by a process
+    that died is claimed again once its lease expires; a clean stop() hands its
+    running jobs back right away.
+    """
+
+    def __init__(self, database: Database, workers: int = 8, poll_seconds: float = 1.0,
+                 lease_seconds: float = 900):
+        self.database = database
+        self.worker_count = max(1, workers)
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self._wakeup = asyncio.Event()
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._running: set = set()
+        self._slots = asyncio.Semaphore(self.worker_count)
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+        self._stopping = False
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def submit(self, tg_id: int, content_type: str, topic: str, param: str, notify: bool) -> str:
+        job_id = uuid.uuid4().hex
+        await self.database.create_job(job_id, tg_id, content_type, topic, param, notify)
+        self.submitted += 1
+        self._wakeup.set()
+        return job_id
+
+    async def wait_changed(self, job_id: str, timeout: float):
+        """Wait until this process updates the job, or `timeout` (for jobs run elsewhere)."""
+        event = self._changed.setdefault(job_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self._changed.get(job_id) is event:
+                del self._changed[job_id]
+
+    def _mark_changed(self, job_id: str):
+        event = self._changed.pop(job_id, None)
+        if event:
+            event.set()
+
+    async def _dispatch(self):
+        while not self._stopping:
+            await self._slots.acquire()
+            self._wakeup.clear()
+            try:
+                job = await self.database.claim_job(time.time() - self.lease_seconds)
+            except Exception as e:
+                logger.error(f"Job claim error: {e}")
+                job = None
+            if job is None:
+                self._slots.release()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Tracked from the claim on, so stop() requeues it even if cancelled before it starts
+            self._running.add(job['id'])
+            task = asyncio.create_task(self._process(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._slots.release()
+
+    async def _process(self, job: Dict[str, Any]):
+        job_id = job['id']
+        self._mark_changed(job_id)
+        try:
+            content, cached = await run_generation(job['tg_id'], job['content_type'], job['topic'], job['param'])
+            if content.startswith(AI_ERROR_PREFIX):
+                await self.database.finish_job(job_id, 'failed', error=content)
+                self.failed += 1
+            else:
+                await self.database.finish_job(job_id, 'done', content=content, cached=cached)
+                self.completed += 1
+                if job['notify']:
+                    await self._notify(job, content)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            self.failed += 1
+            try:
+                await self.database.finish_job(job_id, 'failed', error=str(e))
+            except Exception as db_error:
+                logger.error(f"Job {job_id} status not saved: {db_error}")
+        finally:
+            self._running.discard(job_id)
+            self._mark_changed(job_id)
+
+    async def _notify(self, job: Dict[str, Any], content: str):
+        label = JOB_LABELS.get(job['content_type'], job['content_type'])
+        await notifications.send_many([(job['tg_id'], f"✅ {label} tayyor: {job['topic']}")] +
+                                      [(job['tg_id'], part) for part in split_message(content)])
+
+    def start(self):
+        if self._dispatcher is None:
+            self._stopping = False
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        # Taken before cancelling: each job leaves _running in its finally block
+        interrupted = list(self._running)
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._running.clear()
+        if interrupted:
+            try:
+                await self.database.requeue_jobs(interrupted)
+            except Exception as e:
+                logger.error(f"Could not requeue {len(interrupted)} running jobs: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "workers": self.worker_count,
+            "running": len(self._running),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed
+        }
+
+job_queue = JobQueue(db, workers=JOB_WORKERS, poll_seconds=JOB_POLL_SECONDS, lease_seconds=JOB_LEASE_SECONDS)
+
+def job_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    view = {
+        "id": job['id'],
+        "status": job['status'],
+        "type": job['content_type'],
+        "topic": job['topic'],
+        "created": datetime.fromtimestamp(job['created']).isoformat(),
+        "updated": datetime.fromtimestamp(job['updated']).isoformat()
+    }
+    if job['status'] == 'queued':
+        view["position"] = job['position']
+    elif job['status'] == 'done':
+        view["content"] = job['content']
+        view["cached"] = bool(job['cached'])
+    elif job['status'] == 'failed':
+        view["message"] = job['error']
+    return view
+
+@app.post("/api/jobs", status_code=202)
+async def create_job_api(request: Request, tg_id: int = Depends(current_tg_id)):
+    data = await request.json()
+    try:
+        content_type, topic, param = parse_generation_request(data)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"success": False, "message": str(e)})
+    notify = data.get('notify', True) is not False
+
+    generation_quota.check(tg_id)
+    job_id = await job_queue.submit(tg_id, content_type, topic, param, notify)
+    return {"success": True, "job_id": job_id, "status": "queued"}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job_api(job_id: str, tg_id: int = Depends(current_tg_id)):
+    job = await db.get_job(job_id)
+    if job is None or job['tg_id'] != tg_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_view(job)
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events_api(job_id: str, tg_id: int = Depends(current_tg_id)):
+    """SSE: a `status` event whenever the job changes, ending with `done` or `error`."""
+    job = await db.get_job(job_id)
+    if job is None or job['tg_id'] != tg_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        current, last = job, None
+        while True:
+            view = job_view(current)
+            if current['status'] == 'done':
+                yield sse_event(view, "done")
+                return
+            if current['status'] == 'failed':
+                yield sse_event(view, "error")
+                return
+            if view != last:
+                yield sse_event(view, "status")
+                last = view
+            await job_queue.wait_changed(job_id, JOB_POLL_SECONDS)
+            current = await db.get_job(job_id)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# PPTX Rendering
+class RendererBusyError(Exception):
+    pass
+
+
+class PptxRenderer:
+    """Renders presentations in a process pool so python-pptx never blocks the event loop.
+
+    Workers preload the base template once. Results are cached by content hash,
+    identical concurrent renders are coalesced, and at most `max_queue` renders
+    may be queued or running at a time.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 16, timeout: float = 30,
+                 cache_size: int = 64, template_path: Optional[str] = None):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.template_path = template_path
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._flight = SingleFlight()
+        self._in_flight = 0
+        self.cache_hits = 0
+        self.renders = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def start(self):
+        if self._executor is None:
+            # spawn: workers must not inherit the event loop and aiosqlite threads via fork
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_pptx_worker,
+                initargs=(self.template_path,)
+            )
+            # Start every worker now instead of on the first download
+            for _ in range(self.workers):
+                self._executor.submit(warm_up)
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def render(self, content: str) -> bytes:
+        key = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return cached
+        return await self._flight.do(key, lambda: self._render(key, content))
+
+    async def run(self, fn, *args):
+        """Run `fn(*args)` in the pool, under the same queue limit and timeout as renders.
+
+        A job counts against `max_queue` until the pool is done with it, not until its
+        caller stops waiting, so renders abandoned on timeout still hold their place.
+        """
+        if self._in_flight >= self.max_queue:
+            self.rejected += 1
+            raise RendererBusyError("Render queue is full")
+        self.start()
+        loop = asyncio.get_running_loop()
+        job = self._executor.submit(fn, *args)
+        self._in_flight += 1
+        job.add_done_callback(lambda _: self._job_done(loop))
+        try:
+            # Cancelling the wrapper (timeout or caller gone) only cancels jobs not yet started
+            return await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+        except asyncio.TimeoutError:
+            # A started worker cannot be interrupted; it finishes in the background and is discarded
+            self.timeouts += 1
+            raise
+
+    def _job_done(self, loop: asyncio.AbstractEventLoop):
+        """Done callback of a pool job; runs on the executor's thread."""
+        def release():
+            self._in_flight -= 1
+        with contextlib.suppress(RuntimeError):  # loop already closed at shutdown
+            loop.call_soon_threadsafe(release)
+
+    async def _render(self, key: str, content: str) -> bytes:
+        data = await self.run(render_pptx, content)
+        self.renders += 1
+        self._cache[key] = data
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self._in_flight,
+            "cached": len(self._cache),
+            "cache_hits": self.cache_hits,
+            "renders": self.renders,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts
+        }
+
+pptx_renderer = PptxRenderer(
+    workers=PPTX_WORKERS,
+    max_queue=PPTX_MAX_QUEUE,
+    timeout=PPTX_TIMEOUT_SECONDS,
+    cache_size=PPTX_CACHE_SIZE,
+    template_path=PPTX_TEMPLATE
+)
+
+
+class DocumentExporter:
+    """DOCX/PDF exports of generated markdown, rendered by the PPTX worker pool into a disk cache.
+
+    Workers write the file straight to disk and responses stream it from there,
+    so a document is never held in memory by either process. Files are keyed
+    by a hash of format, title and content; identical concurrent exports are
+    coalesced and the oldest files beyond `max_files` are evicted.
+    """
+
+    MEDIA_TYPES = {
+        "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        "pdf": "application/pdf",
+    }
+
+    def __init__(self, renderer: PptxRenderer, cache_dir: str, max_files: int = 256):
+        self.renderer = renderer
+        self.cache_dir = cache_dir
+        self.max_files = max_files
+        self._flight = SingleFlight()
+        self._files: Optional[int] = None
+        self.cache_hits = 0
+        self.renders = 0
+
+    async def export(self, fmt: str, content: str, title: str) -> str:
+        """Path of the rendered file, rendering it first unless cached."""
+        digest = hashlib.sha256(f"{fmt}\0{title}\0{content}".encode('utf-8')).hexdigest()
+        path = os.path.join(self.cache_dir, f"{digest}.{fmt}")
+        try:
+            # Touch on hit so eviction drops the least recently used files
+            os.utime(path)
+            self.cache_hits += 1
+            return path
+        except FileNotFoundError:
+            return await self._flight.do(path, lambda: self._render(fmt, content, title, path))
+
+    async def _render(self, fmt: str, content: str, title: str, path: str) -> str:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            await self.renderer.run(render_document, fmt, content, title, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        self.renders += 1
+        if self._files is None:
+            self._files = await asyncio.to_thread(lambda: len(os.listdir(self.cache_dir)))
+        else:
+            self._files += 1
+        if self._files > self.max_files:
+            await asyncio.to_thread(self._evict)
+        return path
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                with contextlib.suppress(OSError):
+                    entries.append((entry.stat().st_mtime, entry.path))
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_files)]:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        self._files = min(len(entries), self.max_files)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "cache_hits": self.cache_hits,
+            "renders": self.renders
+        }
+
+document_exporter = DocumentExporter(pptx_renderer, DOCUMENT_CACHE_DIR, DOCUMENT_CACHE_FILES)
 
 @app.post("/api/download-pptx")
-async def download_pptx_api(request: Request):
+async def download_pptx_api(request: Request, tg_id: int = Depends(current_tg_id)):
     data = await request.json()
     content = data.get('content')
     topic = data.get('topic', 'Presentation')
@@ -406,20 +3864,136 @@ async def download_pptx_api(request: Request):
         return JSONResponse(status_code=400, content={"message": "Content is required"})
         
     try:
-        pptx_file = create_pptx_from_text(content)
+        pptx_data = await pptx_renderer.render(content)
         
         # Clean filename
         filename = re.sub(r'[^\w\-_\. ]', '_', topic) + ".pptx"
         
-        return StreamingResponse(
-            pptx_file, 
+        return Response(
+            content=pptx_data,
             media_type="application/vnd.openxmlformats-officedocument.presentationml.presentation",
             headers={"Content-Disposition": f"attachment; filename={filename}"}
         )
+    except RendererBusyError:
+        return JSONResponse(status_code=503, content={"message": "Server band, iltimos birozdan so'ng urinib ko'ring."})
+    except asyncio.TimeoutError:
+        logger.error("PPTX Gen Error: render timed out")
+        return JSONResponse(status_code=504, content={"message": "Fayl yaratish juda uzoq davom etdi."})
     except Exception as e:
         logger.error(f"PPTX Gen Error: {e}")
         return JSONResponse(status_code=500, content={"message": str(e)})
 
+async def download_document(request: Request, fmt: str):
+    """Shared body of the DOCX/PDF endpoints, which only signed-in Web App users may call."""
+    data = await request.json()
+    content = data.get('content')
+    topic = data.get('topic') or 'Hujjat'
+
+    if not content:
+        return JSONResponse(status_code=400, content={"message": "Content is required"})
+
+    try:
+        path = await document_exporter.export(fmt, content, topic)
+    except RendererBusyError:
+        return JSONResponse(status_code=503, content={"message": "Server band, iltimos birozdan so'ng urinib ko'ring."})
+    except asyncio.TimeoutError:
+        logger.error(f"{fmt.upper()} Gen Error: render timed out")
+        return JSONResponse(status_code=504, content={"message": "Fayl yaratish juda uzoq davom etdi."})
+    except Exception as e:
+        logger.error(f"{fmt.upper()} Gen Error: {e}")
+        return JSONResponse(status_code=500, content={"message": str(e)})
+
+    filename = re.sub(r'[^\w\-_\. ]', '_', topic) + f".{fmt}"
+    # FileResponse streams the cached file from disk in chunks
+    return FileResponse(path, media_type=DocumentExporter.MEDIA_TYPES[fmt],
+                        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"})
+
+@app.post("/api/download-docx")
+async def download_docx_api(request: Request, tg_id: int = Depends(current_tg_id)):
+    return await download_document(request, "docx")
+
+@app.post("/api/download-pdf")
+async def download_pdf_api(request: Request, tg_id: int = Depends(current_tg_id)):
+    return await download_document(request, "pdf")
+
+# Telegram Webhook
+webhook_tasks: set = set()
+
+def _webhook_update_done(task: asyncio.Task):
+    webhook_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Webhook update error: {task.exception()}")
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    """Accept an update from Telegram and handle it in the background.
+
+    Replying right away keeps Telegram from retrying while a handler waits on AI
+    generation; the task is tracked so shutdown can drain it.
+    """
+    if BOT_MODE != "webhook":
+        raise HTTPException(status_code=404, detail="Webhook mode is disabled")
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if WEBHOOK_SECRET and not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+    update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    task = asyncio.create_task(dp.feed_update(bot, update))
+    webhook_tasks.add(task)
+    task.add_done_callback(_webhook_update_done)
+    return {"ok": True}
+
+async def drain_in_flight(timeout: float):
+    """Wait for webhook updates and AI generations still running, up to `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while webhook_tasks or generation_scheduler.active:
+        if time.monotonic() >= deadline:
+            logger.warning(f"Shutdown drain timed out: {len(webhook_tasks)} updates, "
+                           f"{generation_scheduler.active} generations still running")
+            return
+        await asyncio.sleep(0.1)
+
+background_tasks: List[asyncio.Task] = []
+
+async def start_services():
+    if model is None:
+        logger.warning("GEMINI_API_KEY not found in environment variables!")
+    background_tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+    await db.init_db()
+    write_queue.start()
+    fsm_storage.start()
+    pptx_renderer.start()
+    job_queue.start()
+    notifications.start()
+    premium_sweeper.start()
+    await generation_quota.start()
+
+async def stop_services():
+    await drain_in_flight(SHUTDOWN_DRAIN_SECONDS)
+    await job_queue.stop()
+    await premium_sweeper.stop()
+    await generation_quota.stop()
+    await notifications.stop()
+    await write_queue.stop()
+    await fsm_storage.close()
+    await ai_router.close()
+    pptx_renderer.shutdown()
+    await db.close()
+    for task in [*background_tasks, *broadcast_tasks]:
+        task.cancel()
+    background_tasks.clear()
+
+@app.on_event("startup")
+async def start_webhook_worker():
+    # In webhook mode every uvicorn worker is a full bot process of its own
+    if BOT_MODE == "webhook":
+        await start_services()
+
+@app.on_event("shutdown")
+async def stop_webhook_worker():
+    if BOT_MODE == "webhook":
+        await stop_services()
+        await bot.session.close()
+
 # Bot Handlers
 
 def get_main_menu():
@@ -444,7 +4018,7 @@ async def cmd_start(message: Message):
     )
 
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.state import StatesGroup
 
 class PaymentState(StatesGroup):
     waiting_for_receipt = State()
@@ -529,9 +4103,7 @@ async def handle_payment_receipt(message: Message, state: FSMContext):
     )
     
     # Update admin_note with file_id
-    async with aiosqlite.connect('talaba_bot.db') as conn:
-        await conn.execute("UPDATE payments SET admin_note=? WHERE payment_id=?", (file_id, payment_id))
-        await conn.commit()
+    await db.set_payment_note(payment_id, file_id)
     
     await state.clear()
     await message.answer("✅ To'lov cheki qabul qilindi! Admin tasdiqlashini kuting.")
@@ -582,105 +4154,205 @@ async def cmd_admin(message: Message):
     
     await message.answer(text, reply_markup=keyboard.as_markup())
 
+broadcast_tasks: set = set()
+
+def broadcast_progress_text(progress: Dict[str, int]) -> str:
+    return (f"📣 Xabar yuborilmoqda\n\n"
+            f"✅ Yuborildi: {progress['sent']}/{progress['total']}\n"
+            f"⚠️ Yetkazilmadi: {progress['failed']}\n"
+            f"⏳ Navbatda: {progress['pending']}")
+
+async def track_broadcast(status: Message, broadcast_id: int, interval: float = 5):
+    """Edit the admin's status message until every recipient was tried."""
+    last_text = status.text
+    while True:
+        await asyncio.sleep(interval)
+        progress = await db.get_broadcast_progress(broadcast_id)
+        text = broadcast_progress_text(progress)
+        if not progress['pending']:
+            text = text.replace("Xabar yuborilmoqda", "Xabar yuborildi")
+        if text != last_text:
+            try:
+                await status.edit_text(text)
+                last_text = text
+            except TelegramBadRequest:
+                pass
+        if not progress['pending']:
+            return
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID:
+        return
+    if not command.args:
+        await message.answer("Foydalanish: /broadcast <xabar matni>")
+        return
+
+    broadcast_id, total = await db.create_broadcast(command.args, message.from_user.id)
+    notifications.wake()
+    status = await message.answer(broadcast_progress_text(
+        {"total": total, "sent": 0, "failed": 0, "pending": total}))
+    task = asyncio.create_task(track_broadcast(status, broadcast_id))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+
+PAYMENT_PAGE_SIZE = 10  # a media group holds at most 10 photos
+PAYMENT_NOTICES = {
+    "approved": "✅ Sizning to'lovingiz tasdiqlandi! Premium status faollashtirildi.",
+    "rejected": "❌ Sizning to'lovingiz rad etildi.",
+}
+
+def has_receipt(payment) -> bool:
+    return bool(payment['admin_note']) and len(payment['admin_note']) > 10
+
+def payment_caption(payment) -> str:
+    return (f"#{payment['id']} 👤 Foydalanuvchi: {payment['card_holder']}\n"
+            f"🆔 ID: {payment['tg_id']}\n"
+            f"💰 Summa: {payment['amount']} so'm\n"
+            f"📅 Vaqt: {payment['created']}")
+
+def payment_page_view(payments, first_id: int, last_id: int):
+    """Review message for one page: a line and ✅/❌ buttons per pending payment plus bulk actions."""
+    span = f"{first_id}_{last_id}"
+    builder = InlineKeyboardBuilder()
+    lines = [f"💰 To'lovlar #{first_id}–#{last_id}\n"]
+    for p in payments:
+        lines.append(f"#{p['id']} — {p['card_holder']} — {p['amount']} so'm")
+        builder.button(text=f"✅ #{p['id']}", callback_data=f"pay_ok_{p['id']}_{span}")
+        builder.button(text=f"❌ #{p['id']}", callback_data=f"pay_no_{p['id']}_{span}")
+    if payments:
+        builder.button(text="✅ Hammasini tasdiqlash", callback_data=f"pay_okall_{span}")
+        builder.button(text="❌ Hammasini rad etish", callback_data=f"pay_noall_{span}")
+    else:
+        lines.append("Bu sahifada kutilayotgan to'lov qolmadi.")
+    builder.button(text="▶️ Keyingi sahifa", callback_data=f"payments_page_{last_id}")
+    builder.adjust(2)
+    return "\n".join(lines), builder.as_markup()
+
+async def notify_reviewed(payments: List[Dict[str, Any]], status: str):
+    await notifications.send_many([(p['tg_id'], PAYMENT_NOTICES[status]) for p in payments])
+
+async def send_payment_page(message: Message, after_id: int):
+    payments = await db.get_pending_payments_page(after_id, PAYMENT_PAGE_SIZE)
+    if not payments:
+        await message.answer("Kutilayotgan to'lovlar qolmadi.")
+        return
+
+    # Receipts go out as one album instead of a message per payment
+    photos = [InputMediaPhoto(media=p['admin_note'], caption=payment_caption(p)) for p in payments if has_receipt(p)]
+    if len(photos) == 1:
+        await message.answer_photo(photo=photos[0].media, caption=photos[0].caption)
+    elif photos:
+        await bot.send_media_group(message.chat.id, media=photos)
+    text, markup = payment_page_view(payments, payments[0]['id'], payments[-1]['id'])
+    await message.answer(text, reply_markup=markup)
+
 @router.callback_query(F.data == "view_payments")
 async def view_payments_callback(callback: CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         return
-        
-    payments = await db.get_pending_payments()
-    if not payments:
-        await callback.message.answer("Kutilayotgan to'lovlar qolmadi.")
+    await send_payment_page(callback.message, 0)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("payments_page_"))
+async def next_payments_page_callback(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
         return
-        
-    for p in payments:
-        builder = InlineKeyboardBuilder()
-        builder.button(text="✅ Tasdiqlash", callback_data=f"approve_{p['payment_id']}")
-        builder.button(text="❌ Rad etish", callback_data=f"reject_{p['payment_id']}")
-        builder.adjust(2)
-        
-        file_id = p['admin_note']
-        caption = (f"👤 Foydalanuvchi: {p['card_holder']}\n"
-                   f"🆔 ID: {p['tg_id']}\n"
-                   f"💰 Summa: {p['amount']} so'm\n"
-                   f"📅 Vaqt: {p['created']}")
-        
-        if file_id and len(file_id) > 10:
-            await callback.message.answer_photo(
-                photo=file_id,
-                caption=caption,
-                reply_markup=builder.as_markup()
-            )
-        else:
-            await callback.message.answer(
-                text=caption,
-                reply_markup=builder.as_markup()
-            )
+    await send_payment_page(callback.message, int(callback.data.rsplit("_", 1)[1]))
     await callback.answer()
 
-@router.callback_query(F.data.startswith("approve_"))
-async def approve_payment_handler(callback: CallbackQuery):
-    payment_id = callback.data.split("_")[1]
+@router.callback_query(F.data.startswith("pay_"))
+async def review_payment_page_callback(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        return
+    action, *ids = callback.data.split("_")[1:]
+    first_id, last_id = int(ids[-2]), int(ids[-1])
+    status = "approved" if action.startswith("ok") else "rejected"
+    id_range = (first_id, last_id) if action.endswith("all") else (int(ids[0]), int(ids[0]))
+
+    changed = await db.review_payments(status, id_range=id_range)
+    await notify_reviewed(changed, status)
+
+    text, markup = payment_page_view(await db.get_pending_payments_range(first_id, last_id), first_id, last_id)
+    await callback.message.edit_text(text, reply_markup=markup)
+    await callback.answer(f"{'✅' if status == 'approved' else '❌'} {len(changed)} ta to'lov")
+
+async def review_single_payment(callback: CallbackQuery, status: str):
+    if callback.from_user.id != ADMIN_ID:
+        return
+    payment_id = callback.data.split("_", 1)[1]
     payment = await db.get_payment(payment_id)
-    
-    if payment:
-        await db.update_payment_status(payment_id, "approved")
-        await db.set_premium(payment['tg_id'])
-        
-        try:
-            await bot.send_message(payment['tg_id'], "✅ Sizning to'lovingiz tasdiqlandi! Premium status faollashtirildi.")
-        except:
-            pass
-            
+    if not payment:
+        await callback.message.answer("❌ To'lov topilmadi")
+        return
+
+    changed = await db.review_payments(status, payment_ids=[payment_id])
+    await notify_reviewed(changed, status)
+    await callback.answer(None if changed else "Bu to'lov allaqachon ko'rib chiqilgan")
+    if status == "approved":
         new_text = f"✅ To'lov tasdiqlandi ({payment['amount']} so'm)\n👤 {payment['card_holder']}"
-        if callback.message.photo:
-            await callback.message.edit_caption(caption=new_text, reply_markup=None)
-        else:
-            await callback.message.edit_text(text=new_text, reply_markup=None)
     else:
-        await callback.message.answer("❌ To'lov topilmadi")
+        new_text = f"❌ To'lov rad etildi\n👤 {payment['card_holder']}"
+    if callback.message.photo:
+        await callback.message.edit_caption(caption=new_text, reply_markup=None)
+    else:
+        await callback.message.edit_text(text=new_text, reply_markup=None)
+
+@router.callback_query(F.data.startswith("approve_"))
+async def approve_payment_handler(callback: CallbackQuery):
+    await review_single_payment(callback, "approved")
 
 @router.callback_query(F.data.startswith("reject_"))
 async def reject_payment_handler(callback: CallbackQuery):
-    payment_id = callback.data.split("_")[1]
-    payment = await db.get_payment(payment_id)
-    
-    if payment:
-        await db.update_payment_status(payment_id, "rejected")
-        try:
-            await bot.send_message(payment['tg_id'], "❌ Sizning to'lovingiz rad etildi.")
-        except:
-            pass
-            
-        new_text = f"❌ To'lov rad etildi\n👤 {payment['card_holder']}"
-        if callback.message.photo:
-            await callback.message.edit_caption(caption=new_text, reply_markup=None)
-        else:
-            await callback.message.edit_text(text=new_text, reply_markup=None)
-    else:
-        await callback.message.answer("❌ To'lov topilmadi")
+    await review_single_payment(callback, "rejected")
 
 # Main Function
 async def main():
-    # Initialize DB
-    await db.init_db()
-    
-    # Include Router
-    dp.include_router(router)
+    """Polling mode: bot and Web App share one process and one event loop."""
+    await start_services()
     
     # Start Web App Server in Background
-    # NOTE: In production, run uvicorn separately. Here we run it in a task for the bot process.
-    config = uvicorn.Config(app, host="0.0.0.0", port=8081, log_level="info")
+    config = uvicorn.Config(app, host=WEB_HOST, port=WEB_PORT, log_level="info",
+                            timeout_graceful_shutdown=SHUTDOWN_DRAIN_SECONDS)
     server = uvicorn.Server(config)
     
     # Run server and bot concurrently
-    await asyncio.gather(
-        server.serve(),
-        dp.start_polling(bot)
-    )
+    try:
+        await bot.delete_webhook()
+        await asyncio.gather(
+            server.serve(),
+            dp.start_polling(bot)
+        )
+    finally:
+        await stop_services()
+
+async def prepare_webhook():
+    # Migrate once here so the workers don't all start on a fresh schema at the same time
+    migrator = Database(db.db_name, readers=1)
+    await migrator.init_db()
+    await migrator.close()
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                                  allowed_updates=dp.resolve_used_update_types())
+            logger.info(f"Webhook set: {WEBHOOK_URL + WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL is not set; register the webhook with Telegram yourself")
+    finally:
+        await bot.session.close()
+
+def run_webhook():
+    """Webhook mode: Telegram posts updates to the Web App, served by WEB_WORKERS processes."""
+    asyncio.run(prepare_webhook())
+    uvicorn.run("main:app", host=WEB_HOST, port=WEB_PORT, workers=WEB_WORKERS, log_level="info",
+                timeout_graceful_shutdown=SHUTDOWN_DRAIN_SECONDS)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if BOT_MODE == "webhook":
+            run_webhook()
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Bot stopped")
     except Exception as e:
@@ -0,0 +1,378 @@
+let currentUser = null;
+let currentResult = '';
+// Signed by Telegram; the API identifies the user from it
+const initData = window.Telegram?.WebApp?.initData || '';
+
+function apiHeaders() {
+    return { 'Content-Type': 'application/json', 'X-Telegram-Init-Data': initData };
+}
+
+// Initialize
+document.addEventListener('DOMContentLoaded', function () {
+    loadUserInfo();
+});
+
+// Tab switching
+function showTab(tabName) {
+    // Hide all tabs
+    document.querySelectorAll('.tab-content').forEach(tab => {
+        tab.classList.add('hidden');
+    });
+
+    // Remove active class from all buttons
+    document.querySelectorAll('.tab-btn').forEach(btn => {
+        btn.classList.remove('active', 'border-purple-500', 'text-purple-600');
+        btn.classList.add('border-transparent', 'text-gray-500');
+    });
+
+    // Show selected tab
+    document.getElementById(tabName + '-tab').classList.remove('hidden');
+
+    // Add active class to clicked button
+    event.target.classList.remove('border-transparent', 'text-gray-500');
+    event.target.classList.add('active', 'border-purple-500', 'text-purple-600');
+}
+
+// Payment functions removed as per request
+
+
+// Content Generation
+async function generateReferat() {
+    const topic = document.getElementById('referat-topic').value;
+    const size = document.getElementById('referat-size').value;
+
+    if (!topic) {
+        alert('❌ Iltimos, mavzuni kiriting!');
+        return;
+    }
+
+    await generateContent('referat', topic, { size });
+}
+
+async function generatePrezentatsiya() {
+    const topic = document.getElementById('prez-topic').value;
+    const slides = document.getElementById('prez-slides').value;
+
+    if (!topic) {
+        alert('❌ Iltimos, mavzuni kiriting!');
+        return;
+    }
+
+    await generateContent('prezentatsiya', topic, { slides });
+}
+
+async function generateInsho() {
+    const topic = document.getElementById('insho-topic').value;
+    const type = document.getElementById('insho-type').value;
+
+    if (!topic) {
+        alert('❌ Iltimos, mavzuni kiriting!');
+        return;
+    }
+
+    await generateContent('insho', topic, { type });
+}
+
+async function generateTest() {
+    const topic = document.getElementById('test-topic').value;
+    const count = document.getElementById('test-count').value;
+
+    if (!topic) {
+        alert('❌ Iltimos, mavzuni kiriting!');
+        return;
+    }
+
+    await generateContent('test', topic, { count });
+}
+
+function showLoading() {
+    document.getElementById('loading-text').textContent = 'AI kontent yaratmoqda...';
+    document.getElementById('loading').classList.remove('hidden');
+    document.getElementById('result').classList.add('hidden');
+}
+
+function hideLoading() {
+    document.getElementById('loading').classList.add('hidden');
+}
+
+async function generateContent(type, topic, params) {
+    showLoading();
+
+    // Stream the text as it is generated when the browser can read response bodies
+    if (window.ReadableStream && window.TextDecoder) {
+        try {
+            await generateContentStream(type, topic, params);
+            return;
+        } catch (error) {
+            console.error('Streaming failed, falling back:', error);
+            showLoading();
+        }
+    }
+
+    const response = await fetch('/api/generate', {
+        method: 'POST',
+        headers: apiHeaders(),
+        body: JSON.stringify({
+            type: type,
+            topic: topic,
+            params: params
+        })
+    });
+
+    const result = await response.json();
+
+    hideLoading();
+
+    if (result.success) {
+        currentResult = result.content;
+        showResult(result.content);
+        updateContentCount();
+    } else {
+        alert('❌ Xatolik: ' + result.message);
+    }
+}
+
+async function generateContentStream(type, topic, params) {
+    const response = await fetch('/api/generate-stream', {
+        method: 'POST',
+        headers: apiHeaders(),
+        body: JSON.stringify({
+            type: type,
+            topic: topic,
+            params: params
+        })
+    });
+
+    if (!response.ok || !response.body) {
+        const result = await response.json().catch(() => ({}));
+        hideLoading();
+        alert('❌ Xatolik: ' + (result.message || response.status));
+        return;
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let started = false;
+    currentResult = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSE events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const raw = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = 'message';
+            let data = '';
+            raw.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            if (!data) continue;
+            const payload = JSON.parse(data);
+
+            if (event === 'error') {
+                hideLoading();
+                alert('❌ Xatolik: ' + payload.message);
+                return;
+            }
+            if (event === 'queued') {
+                document.getElementById('loading-text').textContent =
+                    `Navbatda: ${payload.position}-o'rin (~${Math.ceil(payload.estimated_wait)} soniya)`;
+                continue;
+            }
+            if (event === 'done') {
+                renderResult(currentResult, true);
+                updateContentCount();
+                return;
+            }
+
+            currentResult += payload.delta;
+            if (!started) {
+                started = true;
+                hideLoading();
+                showResult(currentResult);
+            } else {
+                renderResult(currentResult);
+            }
+        }
+    }
+}
+
+function showResult(content) {
+    // Updated showResult logic to handle PPTX button visibility
+    const pptxBtn = document.getElementById('pptxBtn');
+    const prezTab = document.getElementById('prezentatsiya-tab');
+    const isPresentation = prezTab && !prezTab.classList.contains('hidden');
+
+    if (isPresentation) {
+        pptxBtn.classList.remove('hidden');
+    } else {
+        if (pptxBtn) pptxBtn.classList.add('hidden');
+    }
+    document.querySelectorAll('.document-btn').forEach(btn => btn.classList.toggle('hidden', isPresentation));
+
+    renderResult(content, true);
+    document.getElementById('result').classList.remove('hidden');
+
+    // Scroll to result
+    document.getElementById('result').scrollIntoView({ behavior: 'smooth' });
+}
+
+let renderPending = false;
+
+// Re-render at most once per animation frame while chunks are streaming in
+function renderResult(content, immediate) {
+    if (immediate) {
+        document.getElementById('result-content').innerHTML = markdownToHtml(content);
+        return;
+    }
+    if (renderPending) return;
+    renderPending = true;
+    requestAnimationFrame(() => {
+        renderPending = false;
+        document.getElementById('result-content').innerHTML = markdownToHtml(currentResult);
+    });
+}
+
+function markdownToHtml(content) {
+    // Use marked library if available, otherwise fallback to simple replacement
+    if (typeof marked !== 'undefined' && marked.parse) {
+        return marked.parse(content);
+    }
+    return content.replace(/\n/g, '<br>').replace(/\*\*(.*?)\*\*/g, '<strong>$1</strong>');
+}
+
+async function downloadPptx() {
+    if (!currentResult) return;
+
+    // Get current topic
+    let topic = "Presentation";
+    const topicInput = document.getElementById('prez-topic');
+    if (topicInput && topicInput.value) topic = topicInput.value;
+
+    showLoading();
+
+    try {
+        const response = await fetch('/api/download-pptx', {
+            method: 'POST',
+            headers: apiHeaders(),
+            body: JSON.stringify({
+                content: currentResult,
+                topic: topic
+            })
+        });
+
+        if (response.ok) {
+            const blob = await response.blob();
+            const url = window.URL.createObjectURL(blob);
+            const a = document.createElement('a');
+            a.href = url;
+            a.download = topic.replace(/[^\w]/gi, '_') + ".pptx";
+            document.body.appendChild(a);
+            a.click();
+            window.URL.revokeObjectURL(url);
+            a.remove();
+        } else {
+            alert("Fayl yaratishda xatolik!");
+        }
+    } catch (e) {
+        alert("Xatolik: " + e);
+    } finally {
+        hideLoading();
+        document.getElementById('result').classList.remove('hidden');
+    }
+}
+
+async function downloadDocument(format) {
+    if (!currentResult) return;
+
+    // Name the file after the document's first heading
+    const heading = currentResult.match(/^#{1,3}\s+(.+)$/m);
+    const topic = heading ? heading[1].replace(/[*_`]/g, '').trim() : "Hujjat";
+
+    showLoading();
+
+    try {
+        const response = await fetch('/api/download-' + format, {
+            method: 'POST',
+            headers: apiHeaders(),
+            body: JSON.stringify({
+                content: currentResult,
+                topic: topic
+            })
+        });
+
+        if (response.ok) {
+            const blob = await response.blob();
+            const url = window.URL.createObjectURL(blob);
+            const a = document.createElement('a');
+            a.href = url;
+            a.download = topic.replace(/[^\w]/gi, '_') + "." + format;
+            document.body.appendChild(a);
+            a.click();
+            window.URL.revokeObjectURL(url);
+            a.remove();
+        } else {
+            alert("Fayl yaratishda xatolik!");
+        }
+    } catch (e) {
+        alert("Xatolik: " + e);
+    } finally {
+        hideLoading();
+        document.getElementById('result').classList.remove('hidden');
+    }
+}
+
+function copyResult() {
+    navigator.clipboard.writeText(currentResult);
+    alert('✅ Nusxa olindi!');
+}
+
+function downloadResult() {
+    const blob = new Blob([currentResult], { type: 'text/plain' });
+    const url = window.URL.createObjectURL(blob);
+    const a = document.createElement('a');
+    a.href = url;
+    a.download = `talaba_bot_${Date.now()}.txt`;
+    a.click();
+    window.URL.revokeObjectURL(url);
+}
+
+function shareResult() {
+    if (navigator.share) {
+        navigator.share({
+            title: 'Talaba Bot - Professional Kontent',
+            text: 'Professional AI yordamida yaratilgan kontent',
+            url: window.location.href
+        });
+    } else {
+        alert('📱 Ushbu brauzerda ulashish funksiyasi mavjud emas');
+    }
+}
+
+async function loadUserInfo() {
+    try {
+        const response = await fetch('/api/user-info', { method: 'POST', headers: apiHeaders() });
+        const user = await response.json();
+        currentUser = user;
+
+        document.getElementById('balance').textContent = user.balance.toLocaleString() + ' so\'m';
+        document.getElementById('status').textContent = user.is_premium ? 'Premium 👑' : 'Oddiy';
+        document.getElementById('status').className = user.is_premium ? 'font-bold text-green-600' : 'font-bold text-orange-600';
+        document.getElementById('contentCount').textContent = user.content_count + ' ta';
+    } catch (error) {
+        console.error('Failed to load user info:', error);
+    }
+}
+
+function updateContentCount() {
+    const countElement = document.getElementById('contentCount');
+    const currentCount = parseInt(countElement.textContent);
+    countElement.textContent = (currentCount + 1) + ' ta';
+}
@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+import pytest
+
+from main import AIProvider, AIProviderError, AIRouter, CircuitBreaker, ProviderStats
+
+
+class ScriptedProvider(AIProvider):
+    """Answers after `delay` seconds, or raises while `failing` is set."""
+
+    def __init__(self, name: str, delay: float = 0.0, failing: bool = False):
+        self.name = name
+        self.delay = delay
+        self.failing = failing
+        self.calls = 0
+        self.cancelled = 0
+
+    async def generate(self, prompt: str) -> str:
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.failing:
+            raise RuntimeError(f"{self.name} is down")
+        return f"{self.name}: {prompt}"
+
+
+def test_failover_follows_rank_order():
+    first = ScriptedProvider("first", failing=True)
+    second = ScriptedProvider("second", failing=True)
+    third = ScriptedProvider("third")
+    router = AIRouter([first, second, third], hedge_delay=10)
+
+    assert asyncio.run(router.generate("mavzu")) == "third: mavzu"
+    assert (first.calls, second.calls, third.calls) == (1, 1, 1)
+    # The failed providers now rank behind the one that answered
+    assert [p.name for p in router.ranked()] == ["third", "first", "second"]
+
+
+def test_all_providers_failing_raises():
+    router = AIRouter([ScriptedProvider("a", failing=True), ScriptedProvider("b", failing=True)], hedge_delay=10)
+    with pytest.raises(AIProviderError, match="a is down.*b is down"):
+        asyncio.run(router.generate("mavzu"))
+
+
+def test_hedge_fires_after_delay_and_cancels_loser():
+    slow = ScriptedProvider("slow", delay=5)
+    fast = ScriptedProvider("fast", delay=0.01)
+    router = AIRouter([slow, fast], hedge_delay=0.1)
+
+    async def scenario():
+        start = time.monotonic()
+        result = await router.generate("mavzu")
+        elapsed = time.monotonic() - start
+        await asyncio.sleep(0)  # let the loser's cancellation run
+        return result, elapsed
+
+    result, elapsed = asyncio.run(scenario())
+    assert result == "fast: mavzu"
+    assert 0.1 <= elapsed < 1
+    assert router.hedges == 1
+    assert slow.cancelled == 1
+    assert router.breakers["slow"].state == "closed"
+
+
+def test_no_hedge_when_primary_answers_in_time():
+    primary = ScriptedProvider("primary", delay=0.01)
+    backup = ScriptedProvider("backup")
+    router = AIRouter([primary, backup], hedge_delay=1)
+
+    assert asyncio.run(router.generate("mavzu")) == "primary: mavzu"
+    assert backup.calls == 0
+    assert router.hedges == 0
+
+
+def test_breaker_opens_after_threshold_failures():
+    flaky = ScriptedProvider("flaky", failing=True)
+    backup = ScriptedProvider("backup")
+    router = AIRouter([flaky, backup], hedge_delay=10)
+    router.breakers["flaky"] = CircuitBreaker(failure_threshold=3, reset_seconds=60)
+
+    async def scenario():
+        for _ in range(3):
+            # Failed providers rank last, so call flaky directly as the router would on failover
+            with pytest.raises(AIProviderError):
+                await router._call(flaky, "mavzu")
+        return await router.generate("mavzu")
+
+    assert asyncio.run(scenario()) == "backup: mavzu"
+    assert router.breakers["flaky"].state == "open"
+    assert [p.name for p in router.ranked()] == ["backup"]
+    assert flaky.calls == 3
+
+
+def test_half_open_probe_closes_breaker_once_provider_recovers():
+    flaky = ScriptedProvider("flaky", failing=True)
+    backup = ScriptedProvider("backup", delay=0.01)
+    router = AIRouter([flaky, backup], hedge_delay=10)
+    router.breakers["flaky"] = CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(AIProviderError):
+                await router._call(flaky, "mavzu")
+        assert router.breakers["flaky"].state == "open"
+        await router.generate("mavzu")  # served by backup meanwhile
+
+        flaky.failing = False
+        await asyncio.sleep(0.06)
+        assert router.breakers["flaky"].state == "half_open"
+        return await router.generate("mavzu")
+
+    assert asyncio.run(scenario()) == "flaky: mavzu"
+    assert router.breakers["flaky"].state == "closed"
+    assert router.ranked()[0].name == "flaky"
+
+
+def test_failed_half_open_probe_reopens_breaker():
+    flaky = ScriptedProvider("flaky", failing=True)
+    backup = ScriptedProvider("backup")
+    router = AIRouter([flaky, backup], hedge_delay=10)
+    router.breakers["flaky"] = CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+
+    async def scenario():
+        with pytest.raises(AIProviderError):
+            await router._call(flaky, "mavzu")
+        await asyncio.sleep(0.06)
+        return await router.generate("mavzu")
+
+    assert asyncio.run(scenario()) == "backup: mavzu"
+    assert flaky.calls == 2
+    assert router.breakers["flaky"].state == "open"
+
+
+def test_provider_stats_age_out():
+    stats = ProviderStats(max_age=0.05)
+    stats.record(False)
+    assert stats.score() == float("inf")
+    time.sleep(0.06)
+    assert stats.score() == 0.0
+    assert stats.error_rate == 0.0
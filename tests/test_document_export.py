@@ -0,0 +1,96 @@
+import asyncio
+import io
+import re
+import zipfile
+
+import httpx
+import pytest
+
+import main
+from documents import iter_blocks, write_docx, write_pdf
+from fake_bot_api import sign_init_data
+from main import DocumentExporter
+
+MARKDOWN = "# Referat\n\n## Kirish\n\nBu **muhim** mavzu.\n\n1. Bir\n2. Ikki\n"
+
+
+def post(path, body, headers=None):
+    async def request():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            return await client.post(path, json=body, headers=headers)
+
+    return asyncio.run(request())
+
+
+@pytest.mark.parametrize("fmt", ["docx", "pdf", "pptx"])
+def test_download_requires_init_data(monkeypatch, fmt):
+    monkeypatch.setattr(main, "WEBAPP_DEV_USER_ID", 0)
+    assert post(f"/api/download-{fmt}", {"content": MARKDOWN, "topic": "Referat"}).status_code == 401
+    forged = sign_init_data(1, "654321:another-bot")
+    response = post(f"/api/download-{fmt}", {"content": MARKDOWN, "topic": "Referat"},
+                    headers={"X-Telegram-Init-Data": forged})
+    assert response.status_code == 401
+
+
+def test_signed_user_downloads_docx_and_pdf(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "WEBAPP_DEV_USER_ID", 0)
+    renderer = main.PptxRenderer(workers=1)
+    monkeypatch.setattr(main, "document_exporter", DocumentExporter(renderer, str(tmp_path)))
+    headers = {"X-Telegram-Init-Data": sign_init_data(1, main.BOT_TOKEN)}
+    try:
+        docx = post("/api/download-docx", {"content": MARKDOWN, "topic": "Referat"}, headers=headers)
+        pdf = post("/api/download-pdf", {"content": MARKDOWN, "topic": "Referat"}, headers=headers)
+    finally:
+        renderer.shutdown()
+
+    assert docx.status_code == 200
+    assert "word/document.xml" in zipfile.ZipFile(io.BytesIO(docx.content)).namelist()
+    assert pdf.status_code == 200
+    assert pdf.content.startswith(b"%PDF-") and pdf.content.rstrip().endswith(b"%%EOF")
+
+
+LISTS = """1. **Kirish**
+   Bu bo'lim mavzuni tanishtiradi.
+2. Asosiy qism
+   - birinchi fikr
+   - ikkinchi fikr
+3. Xulosa
+
+- a
+- b
+1. yangi ro'yxat
+2. davomi
+
+Oraliq matn.
+
+4. to'rtinchi
+5. beshinchi
+"""
+
+
+def test_list_items_keep_their_numbers():
+    items = [(block.text, block.number) for block in iter_blocks(LISTS.splitlines())
+             if block.kind == "bullet" and block.ordered]
+    assert items == [("Kirish Bu bo'lim mavzuni tanishtiradi.", 1), ("Asosiy qism", 2), ("Xulosa", 3),
+                     ("yangi ro'yxat", 1), ("davomi", 2), ("to'rtinchi", 4), ("beshinchi", 5)]
+
+
+def test_pdf_list_markers():
+    output = io.BytesIO()
+    write_pdf(iter_blocks(LISTS.splitlines()), output)
+    markers = re.findall(rb"\((\d+\.|\x95)\) Tj", output.getvalue())
+    assert markers == [b"1.", b"2.", b"\x95", b"\x95", b"3.", b"\x95", b"\x95", b"1.", b"2.", b"4.", b"5."]
+
+
+def test_docx_numbered_lists():
+    output = io.BytesIO()
+    write_docx(iter_blocks(LISTS.splitlines()), output)
+    archive = zipfile.ZipFile(output)
+    document = archive.read("word/document.xml").decode()
+    num_ids = re.findall(r'<w:ilvl w:val="(\d)"/><w:numId w:val="(\d+)"/>', document)
+    assert num_ids == [("0", "2"), ("0", "2"), ("1", "1"), ("1", "1"), ("0", "2"),
+                       ("0", "1"), ("0", "1"), ("0", "3"), ("0", "3"), ("0", "4"), ("0", "4")]
+    numbering = archive.read("word/numbering.xml").decode()
+    starts = re.findall(r'<w:num w:numId="(\d+)"><w:abstractNumId w:val="1"/>'
+                        r'<w:lvlOverride w:ilvl="0"><w:startOverride w:val="(\d+)"/>', numbering)
+    assert starts == [("2", "1"), ("3", "1"), ("4", "4")]
@@ -0,0 +1,78 @@
+import asyncio
+import itertools
+
+import pytest
+
+import main
+from main import AIProvider, AIRouter, AIService, GenerationScheduler, fan_out_ordered, parse_generation_request
+
+question_ids = itertools.count()
+
+
+class CountingProvider(AIProvider):
+    """Answers every prompt with fresh test questions, tracking how many calls overlap."""
+
+    name = "counting"
+
+    def __init__(self):
+        self.running = 0
+        self.peak = 0
+        self.calls = 0
+
+    async def generate(self, prompt: str) -> str:
+        self.calls += 1
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(0.01)
+            return "\n".join(f"### Savol {i}\nSavol matni {next(question_ids)}?\nA) ha\nB) yo'q\n"
+                             for i in range(1, 16))
+        finally:
+            self.running -= 1
+
+
+@pytest.mark.parametrize("content_type, params, expected", [
+    ("test", {"count": "1000000"}, "50"),
+    ("test", {"count": "-5"}, "1"),
+    ("test", {"count": "abc"}, "10"),
+    ("referat", {"size": "1000"}, "20"),
+    ("referat", {}, "10"),
+    ("prezentatsiya", {"slides": "99"}, "15"),
+    ("insho", {"type": "tahliliy"}, "tahliliy"),
+])
+def test_numeric_params_are_clamped(content_type, params, expected):
+    assert parse_generation_request({"type": content_type, "topic": "Mavzu", "params": params})[2] == expected
+
+
+def test_fan_out_creates_tasks_lazily():
+    alive = peak = 0
+
+    async def job(i):
+        nonlocal alive, peak
+        alive += 1
+        peak = max(peak, alive)
+        await asyncio.sleep(0)
+        alive -= 1
+        return i
+
+    async def scenario():
+        factories = ((lambda i=i: job(i)) for i in range(1000))
+        return [result async for result in fan_out_ordered(factories, 4)]
+
+    assert asyncio.run(scenario()) == list(range(1000))
+    assert peak <= 4
+
+
+def test_fanned_out_test_takes_a_scheduler_slot_per_call(monkeypatch):
+    provider = CountingProvider()
+    scheduler = GenerationScheduler(concurrency=2, rate_per_minute=60_000, burst=100)
+    monkeypatch.setattr(main, "generation_scheduler", scheduler)
+    monkeypatch.setattr(main, "ai_router", AIRouter([provider], throttle=scheduler.throttle, hedge_delay=10))
+    monkeypatch.setattr(main, "AI_FANOUT_CONCURRENCY", 4)
+
+    content = asyncio.run(AIService.generate("test", "Mavzu", "50"))
+
+    assert content.count("### Savol") == 50
+    assert provider.calls >= 4
+    assert provider.peak == 2
+    assert scheduler.stats()["completed"] == provider.calls
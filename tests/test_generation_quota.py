@@ -0,0 +1,117 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from main import AIProvider, AIRouter, GenerationQuota
+
+USER_ID = 42
+
+
+class StubProvider(AIProvider):
+    name = "stub"
+
+    def __init__(self, failing: bool = False):
+        self.failing = failing
+        self.calls = 0
+
+    async def generate(self, prompt: str) -> str:
+        self.calls += 1
+        if self.failing:
+            raise RuntimeError("stub is down")
+        return "# Insho\n\nMatn"
+
+
+@pytest.fixture
+def quota(monkeypatch):
+    quota = GenerationQuota(main.db, burst_free=100, daily_free=5)
+    monkeypatch.setattr(main, "generation_quota", quota)
+    monkeypatch.setattr(main, "WEBAPP_DEV_USER_ID", USER_ID)
+    return quota
+
+
+def use_provider(monkeypatch, provider):
+    monkeypatch.setattr(main, "ai_router", AIRouter([provider], hedge_delay=10))
+
+
+def post(path, body):
+    async def request():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            return await client.post(path, json=body)
+
+    return asyncio.run(request())
+
+
+def generation(content_type="insho", topic="Vatan", **extra):
+    return {"type": content_type, "topic": topic, "params": {}, "cache": False, **extra}
+
+
+@pytest.mark.parametrize("path", ["/api/generate", "/api/generate-stream", "/api/jobs"])
+@pytest.mark.parametrize("body", [generation(content_type="she'r"), generation(topic=""),
+                                  generation(params="10"), ["insho"]])
+def test_invalid_request_is_not_charged(quota, monkeypatch, path, body):
+    provider = StubProvider()
+    use_provider(monkeypatch, provider)
+    response = post(path, body)
+    assert response.json()["success"] is False
+    assert quota.used_today(USER_ID) == 0
+    assert provider.calls == 0
+
+
+def test_generation_is_charged_once(quota, monkeypatch):
+    use_provider(monkeypatch, StubProvider())
+    assert post("/api/generate", generation()).json()["success"] is True
+    assert quota.used_today(USER_ID) == 1
+
+
+def test_failed_generation_is_refunded(quota, monkeypatch):
+    use_provider(monkeypatch, StubProvider(failing=True))
+    content = post("/api/generate", generation()).json()["content"]
+    assert content.startswith(main.AI_ERROR_PREFIX)
+    assert quota.used_today(USER_ID) == 0
+
+
+def test_stream_is_charged_once(quota, monkeypatch):
+    use_provider(monkeypatch, StubProvider())
+    response = post("/api/generate-stream", generation())
+    assert "event: done" in response.text
+    assert quota.used_today(USER_ID) == 1
+
+
+def test_failed_stream_is_refunded_before_fallback(quota, monkeypatch):
+    use_provider(monkeypatch, StubProvider(failing=True))
+    response = post("/api/generate-stream", generation())
+    assert "event: error" in response.text
+    assert quota.used_today(USER_ID) == 0
+
+    # The Web App then retries on /api/generate, which is the only charge
+    use_provider(monkeypatch, StubProvider())
+    post("/api/generate", generation())
+    assert quota.used_today(USER_ID) == 1
+
+
+def test_stream_abandoned_by_client_is_still_charged(quota, monkeypatch):
+    use_provider(monkeypatch, StubProvider())
+
+    class Request:
+        async def json(self):
+            return generation()
+
+    async def abandon():
+        response = await main.generate_content_stream_api(Request(), USER_ID)
+        async for event in response.body_iterator:
+            if "delta" in event:
+                break
+        # What Starlette does when the client disconnects mid-stream
+        await response.body_iterator.aclose()
+
+    asyncio.run(abandon())
+    assert quota.used_today(USER_ID) == 1
+
+
+def test_quota_still_enforced(quota, monkeypatch):
+    use_provider(monkeypatch, StubProvider())
+    for _ in range(5):
+        assert post("/api/generate", generation()).status_code == 200
+    assert post("/api/generate", generation()).status_code == 429
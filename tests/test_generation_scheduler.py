@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from fake_gemini import FakeGenerativeModel
+from main import GeminiProvider, GenerationScheduler, SingleFlight
+
+
+def test_single_flight_coalesces_identical_calls():
+    async def scenario():
+        flight = SingleFlight()
+        model = FakeGenerativeModel(latency=0.05, tokens_per_second=10_000, tokens=10)
+
+        async def call():
+            return (await model.generate_content_async("mavzu")).text
+
+        results = await asyncio.gather(*(flight.do("mavzu", call) for _ in range(10)))
+        return flight, model, results
+
+    flight, model, results = asyncio.run(scenario())
+    assert model.calls == 1
+    assert len(set(results)) == 1
+    assert flight.stats() == {"in_flight": 0, "calls": 1, "coalesced": 9}
+
+
+def test_single_flight_propagates_error_to_every_waiter():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def fail():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream down")
+
+        results = await asyncio.gather(*(flight.do("k", fail) for _ in range(5)), return_exceptions=True)
+        # The failed call is forgotten, so the next caller tries again
+        with pytest.raises(RuntimeError):
+            await flight.do("k", fail)
+        return calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert calls == 2
+    assert all(isinstance(r, RuntimeError) and str(r) == "upstream down" for r in results)
+
+
+def test_single_flight_survives_one_caller_cancelling():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "ok"
+
+        first = asyncio.create_task(flight.do("k", slow))
+        second = asyncio.create_task(flight.do("k", slow))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) == "ok"
+
+
+def test_scheduler_bounds_concurrency_against_fake_model():
+    async def scenario():
+        scheduler = GenerationScheduler(concurrency=2, rate_per_minute=60_000, burst=100)
+        provider = GeminiProvider(FakeGenerativeModel(latency=0.02, tokens_per_second=10_000, tokens=10))
+        running = peak = 0
+
+        async def generate():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            try:
+                await scheduler.throttle(provider.name)
+                return await provider.generate("mavzu")
+            finally:
+                running -= 1
+
+        results = await asyncio.gather(*(scheduler.run(generate, premium=False) for _ in range(6)))
+        return scheduler, peak, results
+
+    scheduler, peak, results = asyncio.run(scenario())
+    assert peak == 2
+    assert len(results) == 6
+    assert scheduler.stats()["completed"] == 6
+    assert scheduler.stats()["active"] == 0
+
+
+def test_scheduler_serves_premium_first():
+    async def scenario():
+        scheduler = GenerationScheduler(concurrency=1)
+        holder = scheduler.enqueue(premium=False)
+        free = scheduler.enqueue(premium=False)
+        premium = scheduler.enqueue(premium=True)
+        positions = (scheduler.position(premium), scheduler.position(free))
+        order = []
+
+        async def take(ticket, name):
+            await scheduler.wait(ticket)
+            order.append(name)
+            scheduler.release(ticket)
+
+        waiters = [asyncio.create_task(take(free, "free")), asyncio.create_task(take(premium, "premium"))]
+        await asyncio.sleep(0)
+        scheduler.release(holder)
+        await asyncio.gather(*waiters)
+        return positions, order
+
+    positions, order = asyncio.run(scenario())
+    assert positions == (1, 2)
+    assert order == ["premium", "free"]
@@ -0,0 +1,72 @@
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+import main
+from fake_bot_api import sign_init_data
+from main import InitDataVerifier, InvalidInitData
+
+TOKEN = "123456:test-token"
+USER_ID = 42
+
+
+def signed(fields, token=TOKEN):
+    """urlencoded initData with Telegram's hash over `fields`."""
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", token.encode(), hashlib.sha256).digest()
+    return urlencode({**fields, "hash": hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()})
+
+
+def user_fields(auth_date=None):
+    return {"user": json.dumps({"id": USER_ID, "first_name": "Ali"}),
+            "auth_date": str(int(time.time() if auth_date is None else auth_date))}
+
+
+def test_valid_signature():
+    verifier = InitDataVerifier(TOKEN)
+    assert verifier.verify(sign_init_data(USER_ID, TOKEN)) == USER_ID
+    assert verifier.verify(signed(user_fields())) == USER_ID
+
+
+def test_tampered_field():
+    init_data = signed(user_fields()).replace("Ali", "Vali")
+    with pytest.raises(InvalidInitData, match="signature"):
+        InitDataVerifier(TOKEN).verify(init_data)
+
+
+def test_wrong_bot_token():
+    with pytest.raises(InvalidInitData, match="signature"):
+        InitDataVerifier(TOKEN).verify(sign_init_data(USER_ID, "654321:other-token"))
+
+
+def test_expired_auth_date():
+    init_data = signed(user_fields(auth_date=time.time() - 120))
+    with pytest.raises(InvalidInitData, match="expired"):
+        InitDataVerifier(TOKEN, max_age_seconds=60).verify(init_data)
+    # max_age 0 turns the check off
+    assert InitDataVerifier(TOKEN, max_age_seconds=0).verify(init_data) == USER_ID
+
+
+def test_cached_entry_expires(monkeypatch):
+    verifier = InitDataVerifier(TOKEN, max_age_seconds=60)
+    init_data = signed(user_fields())
+    assert verifier.verify(init_data) == USER_ID
+    assert verifier.verify(init_data) == USER_ID
+    assert verifier.stats()["hits"] == 1
+
+    now = time.time()
+    monkeypatch.setattr(main.time, "time", lambda: now + 120)
+    with pytest.raises(InvalidInitData, match="expired"):
+        verifier.verify(init_data)
+    assert verifier.stats()["entries"] == 0
+
+
+def test_missing_user():
+    fields = user_fields()
+    del fields["user"]
+    with pytest.raises(InvalidInitData, match="no user"):
+        InitDataVerifier(TOKEN).verify(signed(fields))
@@ -0,0 +1,81 @@
+import asyncio
+
+import main
+from main import Database, JobQueue
+
+
+def run_with_queue(tmp_path, monkeypatch, generation, scenario):
+    async def run():
+        database = Database(str(tmp_path / "jobs.db"), readers=1)
+        await database.init_db()
+        queue = JobQueue(database, workers=2, poll_seconds=0.05)
+        monkeypatch.setattr(main, "run_generation", generation)
+        try:
+            return await scenario(database, queue)
+        finally:
+            await queue.stop()
+            await database.close()
+
+    return asyncio.run(run())
+
+
+async def wait_for_status(database, job_id, status, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while (await database.get_job(job_id))["status"] != status:
+        assert asyncio.get_running_loop().time() < deadline, f"job never reached {status!r}"
+        await asyncio.sleep(0.01)
+
+
+def test_stop_requeues_running_job(tmp_path, monkeypatch):
+    started = []
+
+    async def hang(tg_id, content_type, topic, param):
+        started.append(topic)
+        await asyncio.sleep(3600)
+
+    async def scenario(database, queue):
+        job_id = await queue.submit(1, "referat", "Mavzu", "10", notify=False)
+        queue.start()
+        await wait_for_status(database, job_id, "running")
+        while not started:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return (await database.get_job(job_id))["status"], queue.stats()["running"]
+
+    assert run_with_queue(tmp_path, monkeypatch, hang, scenario) == ("queued", 0)
+
+
+def test_requeued_job_runs_after_restart(tmp_path, monkeypatch):
+    attempts = []
+
+    async def generate(tg_id, content_type, topic, param):
+        attempts.append(topic)
+        if len(attempts) == 1:
+            await asyncio.sleep(3600)
+        return "# Referat\n\nMatn", False
+
+    async def scenario(database, queue):
+        job_id = await queue.submit(1, "referat", "Mavzu", "10", notify=False)
+        queue.start()
+        while not attempts:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        queue.start()
+        await wait_for_status(database, job_id, "done")
+        return len(attempts)
+
+    assert run_with_queue(tmp_path, monkeypatch, generate, scenario) == 2
+
+
+def test_stop_leaves_finished_jobs_alone(tmp_path, monkeypatch):
+    async def generate(tg_id, content_type, topic, param):
+        return "# Insho\n\nMatn", False
+
+    async def scenario(database, queue):
+        job_id = await queue.submit(1, "insho", "Mavzu", "argumentativ", notify=False)
+        queue.start()
+        await wait_for_status(database, job_id, "done")
+        await queue.stop()
+        return (await database.get_job(job_id))["status"]
+
+    assert run_with_queue(tmp_path, monkeypatch, generate, scenario) == "done"
@@ -0,0 +1,37 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+def get(path, headers=None):
+    async def request():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            return await client.get(path, headers=headers)
+
+    return asyncio.run(request())
+
+
+def test_metrics_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(main, "METRICS_TOKEN", "")
+    assert get("/metrics").status_code == 404
+    assert get("/api/health").json() == {"status": "ok"}
+
+
+@pytest.mark.parametrize("header", [None, "Bearer wrong", "secret"])
+def test_metrics_rejects_missing_or_wrong_token(monkeypatch, header):
+    monkeypatch.setattr(main, "METRICS_TOKEN", "secret")
+    response = get("/metrics", headers={"Authorization": header} if header else None)
+    assert response.status_code == 401
+    assert get("/api/health", headers={"Authorization": header} if header else None).json() == {"status": "ok"}
+
+
+def test_metrics_and_health_details_with_token(monkeypatch):
+    monkeypatch.setattr(main, "METRICS_TOKEN", "secret")
+    headers = {"Authorization": "Bearer secret"}
+    response = get("/metrics", headers=headers)
+    assert response.status_code == 200
+    assert "app_queue_depth" in response.text
+    assert "jobs" in get("/api/health", headers=headers).json()
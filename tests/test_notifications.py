@@ -0,0 +1,151 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+import main
+from fake_bot_api import build_app
+from main import Database, NotificationQueue
+
+TOKEN = "123456:test-token"
+
+
+def run_against_fake_api(tmp_path, monkeypatch, scenario, flood_limits=None, server_errors=None, **queue_options):
+    """Run `scenario(database, queue, counters)` with main.bot talking to an in-process fake Bot API."""
+    counters = SimpleNamespace(replies=SimpleNamespace(value=0), last_reply=SimpleNamespace(value=0.0),
+                               rejected=SimpleNamespace(value=0))
+
+    async def run():
+        runner = web.AppRunner(build_app(counters.replies, counters.last_reply, counters.rejected,
+                                         flood_limits, server_errors))
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")))
+        monkeypatch.setattr(main, "bot", bot)
+
+        database = Database(str(tmp_path / "outbox.db"), readers=1)
+        await database.init_db()
+        queue = NotificationQueue(database, poll_seconds=0.05, **queue_options)
+        queue.start()
+        try:
+            return await scenario(database, queue, counters)
+        finally:
+            await queue.stop()
+            await database.close()
+            await bot.session.close()
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+async def outbox_rows(database):
+    async with database.pool.read() as conn:
+        cursor = await conn.execute("SELECT chat_id, status, attempts FROM outbox ORDER BY id")
+        return [tuple(row) for row in await cursor.fetchall()]
+
+
+async def wait_until_settled(database, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        rows = await outbox_rows(database)
+        if rows and all(status != "pending" and status != "sending" for _, status, _ in rows):
+            return rows
+        assert time.monotonic() < deadline, f"outbox did not settle: {rows}"
+        await asyncio.sleep(0.05)
+
+
+def test_delivers_every_message(tmp_path, monkeypatch):
+    async def scenario(database, queue, counters):
+        await queue.send_many([(100 + i, f"Xabar {i}") for i in range(20)])
+        return await wait_until_settled(database), counters
+
+    rows, counters = run_against_fake_api(tmp_path, monkeypatch, scenario, rate_per_second=1000)
+    assert [status for _, status, _ in rows] == ["sent"] * 20
+    assert counters.replies.value == 20
+
+
+def test_server_errors_are_retried_with_backoff(tmp_path, monkeypatch):
+    async def scenario(database, queue, counters):
+        start = time.monotonic()
+        await queue.send_many([(1, "a"), (2, "b")])
+        rows = await wait_until_settled(database)
+        return rows, time.monotonic() - start, queue.stats()
+
+    rows, elapsed, stats = run_against_fake_api(tmp_path, monkeypatch, scenario, server_errors={1: 2},
+                                                rate_per_second=1000, retry_seconds=0.2)
+    assert rows == [(1, "sent", 3), (2, "sent", 1)]
+    # Two failures back off 0.2s then 0.4s before the third attempt
+    assert elapsed >= 0.6
+    assert stats["sent"] == 2 and stats["failed"] == 0
+
+
+def test_gives_up_after_max_attempts(tmp_path, monkeypatch):
+    async def scenario(database, queue, counters):
+        await queue.send_many([(1, "a")])
+        return await wait_until_settled(database), counters
+
+    rows, counters = run_against_fake_api(tmp_path, monkeypatch, scenario, server_errors={1: 10},
+                                          rate_per_second=1000, retry_seconds=0.01, max_attempts=3)
+    assert rows == [(1, "failed", 3)]
+    assert counters.replies.value == 0
+
+
+def test_honours_retry_after(tmp_path, monkeypatch):
+    async def scenario(database, queue, counters):
+        start = time.monotonic()
+        await queue.send_many([(7, "birinchi"), (7, "ikkinchi"), (8, "boshqa")])
+        rows = await wait_until_settled(database)
+        return rows, time.monotonic() - start, queue.stats(), counters
+
+    # The queue's own per-chat pacing is off, so only the fake API's flood control holds chat 7 back
+    rows, elapsed, stats, counters = run_against_fake_api(
+        tmp_path, monkeypatch, scenario, flood_limits={"global": 100, "per_chat": 1},
+        rate_per_second=1000, per_chat_seconds=0)
+    assert [status for _, status, _ in rows] == ["sent"] * 3
+    assert counters.replies.value == 3
+    assert counters.rejected.value >= 1
+    assert stats["retried"] == counters.rejected.value
+    # The second message to chat 7 could only go out after the 1s retry_after
+    assert elapsed >= 1.0
+    # A 429 pauses sending instead of counting as a failed attempt
+    assert all(attempts == 1 for _, _, attempts in rows)
+
+
+def test_one_sender_across_workers(tmp_path, monkeypatch):
+    async def scenario(database, queue, counters):
+        # A second web worker: its own connection pool and queue on the same database
+        other_db = Database(str(tmp_path / "outbox.db"), readers=1)
+        await other_db.init_db()
+        other = NotificationQueue(other_db, poll_seconds=0.05, rate_per_second=20, sender_lease_seconds=0.6)
+        other.start()
+        try:
+            start = time.monotonic()
+            await queue.send_many([(100 + i, "a") for i in range(20)])
+            await other.send_many([(200 + i, "b") for i in range(20)])
+            rows = await wait_until_settled(database)
+            elapsed = time.monotonic() - start
+            leaders = [queue.leader, other.leader]
+
+            # Stopping the sender hands its lease straight to the other worker
+            sender, standby = (queue, other) if queue.leader else (other, queue)
+            await sender.stop()
+            await standby.send_many([(300, "c")])
+            rows += (await wait_until_settled(database))[len(rows):]
+            return rows, elapsed, leaders, standby.leader
+        finally:
+            await other.stop()
+            await other_db.close()
+
+    rows, elapsed, leaders, took_over = run_against_fake_api(tmp_path, monkeypatch, scenario,
+                                                             rate_per_second=20, sender_lease_seconds=0.6)
+    assert [status for _, status, _ in rows] == ["sent"] * 41
+    assert sorted(leaders) == [False, True]
+    # 40 messages at 20/s: two independent senders would take about half as long
+    assert elapsed >= 1.8
+    assert took_over
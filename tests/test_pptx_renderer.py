@@ -0,0 +1,37 @@
+import asyncio
+import time
+
+import pytest
+
+from main import PptxRenderer, RendererBusyError
+
+
+def test_timed_out_renders_keep_occupying_the_queue():
+    renderer = PptxRenderer(workers=1, max_queue=2, timeout=60)
+
+    async def scenario():
+        # Let the worker finish spawning so timeouts measure the job, not the start-up
+        renderer.start()
+        await renderer.run(time.sleep, 0)
+        renderer.timeout = 0.2
+        for _ in range(2):
+            with pytest.raises(asyncio.TimeoutError):
+                await renderer.run(time.sleep, 0.6)
+        # Both abandoned jobs are still queued or running in the pool
+        busy = renderer.stats()["in_flight"]
+        with pytest.raises(RendererBusyError):
+            await renderer.run(time.sleep, 0)
+        deadline = time.monotonic() + 10
+        while renderer.stats()["in_flight"] and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await renderer.run(time.sleep, 0)
+        return busy, renderer.stats()
+
+    try:
+        busy, stats = asyncio.run(scenario())
+    finally:
+        renderer.shutdown()
+    assert busy == 2
+    assert stats["in_flight"] == 0
+    assert stats["timeouts"] == 2
+    assert stats["rejected"] == 1